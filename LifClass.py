@@ -1,15 +1,27 @@
 import os
+import csv
 import time
 import enum
+import threading
+from functools import partial
 from pathlib import Path
 import tkinter as tk
 from tkinter import filedialog
 import numpy as np
 import cv2  # install with pip install opencv-python
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from basic_gui import basic_flag
-from reader import LifFile  # This supersedes the install with pip install readlif
+from reader import LifFile, DEFAULT_CHUNK_BYTES  # This supersedes the install with pip install readlif
+from rescale import get_lut
+from compositor import plan_composites, composite, channel_suffix, depth_colors, composite_depth
+from projection import project_stack, projection_bytes, StackProjector
+from mosaic import tile_positions, mosaic_size, tiles_in_region, stitch
+from tiff_writer import StripTiffWriter, PyramidTiffWriter, DEFAULT_STRIP_BYTES, DEFAULT_TILE_SIZE
+from jpeg_writer import TiledJpegWriter, needs_tiles, grid_size, tile_path
+from image_writer import WholeImageWriter, ThumbnailWriter
+from write_pool import WritePool
 
 
 class LifClass:
@@ -22,6 +34,11 @@ class LifClass:
             xml = 0
             jpg = 1
             tiff = 2
+            ome_tiff = 3  # Tiled, multi-resolution OME-TIFF, for viewing huge images in QuPath or napari
+
+            def extension(self):
+                """Returns extension of output files in this format"""
+                return {"xml": ".xml", "jpg": ".jpg", "tiff": ".tiff", "ome_tiff": ".ome.tif"}[self.name]
 
         class ColorOptions(enum.Enum):
             all_together = 0
@@ -31,15 +48,87 @@ class LifClass:
         class ZStackOptions(enum.Enum):
             max_project = 0
             separate = 1
+            min_project = 2
+            mean_project = 3
+            sum_project = 4
+            std_project = 5
+            depth_map = 6  # Gray level shows z plane of brightest value of each pixel
+            depth_coded = 7  # Maximum projection, colored by z plane of brightest value
+
+            def reducers(self):
+                """Returns names of projections (see projection.REDUCERS) needed for this option"""
+                if self is type(self).separate:
+                    return ()
+                elif self is type(self).depth_map:
+                    return ("argmax",)
+                elif self is type(self).depth_coded:
+                    return ("max", "argmax")
+                return (self.name[:-len("_project")],)
+
+            def file_tag(self):
+                """Returns text appended to names of files with projected z-stacks, or None"""
+                if self in (type(self).max_project, type(self).separate):
+                    return None
+                return self.name.replace("_project", "")
+
+        class MosaicOptions(enum.Enum):
+            stitch = 0  # Stitch tile scans (dims.m > 1) into a single image
+            separate_tiles = 1  # Write each tile to its own files, with a CSV file of tile positions
+            skip = 2
+
+        class Target:
+            """
+            One set of output files. All targets from Options.targets() are written in the same pass,
+            so each plane is read once, however many formats are written, e.g. 16-bit TIFF for analysis
+            and JPG thumbnails for a wiki.
+
+            Args:
+                convert_format (Format): output format
+                color_format (ColorOptions): which channels go into which file
+                zstack_format (ZStackOptions): projection of z-stacks, or a file per z plane
+                thumbnail_size (int): if given, images are shrunk to fit within this many pixels,
+                    and "_thumb" is appended to file names. JPG and TIFF only.
+            """
+
+            def __init__(self, convert_format, color_format, zstack_format, thumbnail_size=None):
+                if thumbnail_size is not None and convert_format not in (LifClass.Options.Format.jpg,
+                                                                          LifClass.Options.Format.tiff):
+                    raise ValueError(f"Thumbnails can't be written as {convert_format.name}")
+                self.convert_format = convert_format
+                self.color_format = color_format
+                self.zstack_format = zstack_format
+                self.thumbnail_size = thumbnail_size
 
         overwrite_existing = True
         rotate180 = True
+        stream_tiff = False  # Always write TIFF files in strips, see export_image_streamed()
+        memory_budget = 1024 ** 3  # Bytes. TIFF images bigger than this are written in strips that fit within it
+        tiff_compression = None  # None, or "deflate" for smaller but slower TIFF files written in strips or tiles
+        jpg_tile_size = 4096  # Width and height of tiles, for images too big for a single JPG file
+        tile_workers = None  # Threads for exporting separate tiles of tile scans. None uses one per CPU
+        write_workers = 2  # Threads writing whole images in the background, see write_pool.py. 0 writes in turn
+        write_queue = 2  # Images that can wait to be written. Each holds a whole output image in memory
+        batch_workers = None  # Processes converting files of a folder in parallel, see batch.py. None uses one per CPU
+        batch_memory = None  # Bytes that files converted in parallel may use together. None uses 3/4 of physical memory
+        use_index_cache = True  # Cache LIF file offsets and image list, so reopening files is faster
+        lazy_xml = False  # Parse XML header incrementally. Uses far less memory for huge headers, but is slower
+        mosaic_temp_dir = None  # Folder for temporary stitching canvases. None uses the folder of the LIF file
 #        separate_CMY = True  # Put cyan, magenta and yellow into their own file if needed to avoid overlap
 
         def __init__(self):
             self.convert_format = self.Format.jpg
             self.color_format = self.ColorOptions.RGB_CMY
             self.zstack_format = self.ZStackOptions.max_project
+            self.mosaic_format = self.MosaicOptions.stitch
+            # Region (x, y, width, height) to export, in pixels of the original (unrotated) image.
+            # None exports the whole image. Only the rows within the region are read from disk.
+            self.crop = None
+            # More Target objects, written in the same pass as the output selected above
+            self.extra_targets = []
+
+        def targets(self):
+            """Returns all outputs to be written, starting with the one given by the format options above"""
+            return [self.Target(self.convert_format, self.color_format, self.zstack_format)] + list(self.extra_targets)
 
     # The following variables are cumulative, i.e. if you convert more than one file with the same object
     # they will not be reset between conversions.
@@ -55,6 +144,9 @@ class LifClass:
     file_base_name = None
 
     lif_file_object: Optional[LifFile] = None
+    output_buffers: Optional[dict] = None  # Reused between images, see get_output_buffer()
+    write_pool: Optional[WritePool] = None  # Writes whole images in the background during convert()
+    image_callback = None  # Called with (image name, error or None) once all files of an image are written
 
     class UserCanceled(Exception):
         # Custom exception class, no code needed.
@@ -66,6 +158,8 @@ class LifClass:
             self.root_window = root_window
 
         self.stopFlag = basic_flag(self.root_window)  # Used to stop ongoing conversion
+        # Counters are updated by writing threads, see image_done()
+        self.counter_lock = threading.Lock()
 
         if conversion_options is not None:
             self.conversion_options = conversion_options
@@ -86,17 +180,27 @@ class LifClass:
 
     def open_file(self, file_path):
 
+        # Release file handle of previously opened file, if any
+        self.close_file()
+
         self.file_path = file_path
         self.file_base_name = os.path.basename(file_path)
         self.lif_modified_time = os.path.getmtime(file_path)
 
         try:
-            self.lif_file_object = LifFile(file_path)
+            self.lif_file_object = LifFile(file_path, use_cache=self.conversion_options.use_index_cache,
+                                           lazy_xml=self.conversion_options.lazy_xml)
         except Exception as e:
             print(f'  Error encountered while opening LIF file: {e}')
             print('  Please check whether file is corrupted.')
             self.num_images_error += 1
 
+    def close_file(self):
+
+        if self.lif_file_object is not None:
+            self.lif_file_object.close()
+            self.lif_file_object = None
+
     def prompt_select_image_from_single_file(self):
 
         img_list = [i for i in self.lif_file_object.get_iter_image()]
@@ -112,8 +216,13 @@ class LifClass:
     def stop_conversion(self):
         self.stopFlag.set()
 
-    # Convert one or more images in a single file
-    def convert(self, n: int = -1):
+    # Convert one or more images in a single file. write_xml=False skips the XML file, e.g. when
+    # images of a file are converted by separate jobs, see batch.py.
+    def convert(self, n: int = -1, write_xml: bool = True):
+
+        if self.lif_file_object is None:
+            # open_file() failed, and has already reported the error
+            return
 
         # Access a specific image directly
         # img_0 = new.get_image(0)
@@ -126,11 +235,9 @@ class LifClass:
             self.num_images_error += 1
             return
 
-        xml_metadata = self._recursive_metadata_find(
-            self.lif_file_object.xml_root, )  # self.xml_root.findall("./Element/Children/Element/Data/Image")
-
-        if self.conversion_options.convert_format == LifClass.Options.Format.xml:
-            # Extract xml header info only
+        if write_xml and any(target.convert_format == LifClass.Options.Format.xml
+                             for target in self.conversion_options.targets()):
+            # Extract xml header info
             paths = os.path.splitext(self.file_path)
             xml_path = paths[0] + ".xml"
 
@@ -139,50 +246,258 @@ class LifClass:
 
             print(f'  Wrote XML file "{os.path.basename(xml_path)}"')
             self.num_xml_written += 1
+
+        if not self.image_targets():
+            # XML only
             return
 
-        if n < 0:
-            # Convert all images in file
-            print(f'  Found {len(img_list)} image(s) in file "{self.file_base_name}".')
-            for n in range(len(img_list)):
-                if self.stopFlag.check():
-                    raise self.UserCanceled
-                print(f'   {n + 1}: ', end="")
-                self.convert_image(img_list[n], xml_metadata[n])
-        else:
-            # Convert single image
-            self.convert_image(img_list[n], xml_metadata[n])
+        # Whole images are written in the background while the next one is read.
+        # Counters are updated as each image is finished, see image_done().
+        if self.conversion_options.write_workers:
+            self.write_pool = WritePool(workers=self.conversion_options.write_workers,
+                                        max_pending=self.conversion_options.write_queue)
+        try:
+            if n < 0:
+                # Convert all images in file
+                print(f'  Found {len(img_list)} image(s) in file "{self.file_base_name}".')
+                for n in range(len(img_list)):
+                    if self.stopFlag.check():
+                        raise self.UserCanceled
+                    print(f'   {n + 1}: ', end="")
+                    if self.skip_image(img_list[n]):
+                        continue
+                    self.convert_image(img_list[n])
+            else:
+                # Convert single image
+                if not self.skip_image(img_list[n]):
+                    self.convert_image(img_list[n])
+        finally:
+            if self.write_pool is not None:
+                # Let images already built finish writing, even if conversion was canceled
+                self.write_pool.close()
+                self.write_pool = None
 
         return
 
-    # Convert a single image within this file.
-    def convert_image(self, img, xml_metadata):
+    # Check whether image should be skipped, either because it can't be converted, or was already converted.
+    def skip_image(self, img):
 
+        tiles = False
         if img.dims.m > 1:
-            print(f'SKIPPING image which consists of {img.dims.m} unmerged tiles: "{img.name}"')
-            # This is a set of unmerged tiles. Just skip
-            self.num_images_skipped += 1
-            return
+            # This is a set of unmerged tiles. Stitch them if we know where they go, or export each one, or skip
+            mosaic_format = self.conversion_options.mosaic_format
+            reason = None
+            if mosaic_format == self.Options.MosaicOptions.skip:
+                reason = "tile scans are set to be skipped"
+            elif mosaic_format == self.Options.MosaicOptions.stitch:
+                try:
+                    tile_positions(img)
+                except ValueError as e:
+                    reason = str(e)
+            else:
+                tiles = True
+            if reason is not None:
+                print(f'SKIPPING image which consists of {img.dims.m} unmerged tiles ({reason}): "{img.name}"')
+                self.num_images_skipped += 1
+                return True
 
-        f_path = self.generate_filepath(img.name)
+        if not self.is_converted(img, tiles):
+            return False
+
+        print(f'SKIPPING image already converted: "{img.name}"')  # "{os.path.basename(f_path)}"')
+        self.num_images_skipped += 1
+        return True
+
+    # Returns True if image doesn't need converting again, because the files of every target are newer than
+    # the LIF file, and existing files are not to be overwritten. tiles is as for last_output_path().
+    def is_converted(self, img, tiles=False):
+
+        for target in self.image_targets():
+            f_path = self.last_output_path(img, target, tiles)
+            if not Path(f_path).is_file() or self.conversion_options.overwrite_existing:
+                return False
 
-        if Path(f_path).is_file() and not self.conversion_options.overwrite_existing:
             # File already exists. Now check timestamp
-            ts = os.path.getmtime(f_path)
+            if os.path.getmtime(f_path) <= self.lif_modified_time:
+                return False
 
-            if ts > self.lif_modified_time:
-                print(f'SKIPPING image already converted: "{img.name}"')  # "{os.path.basename(f_path)}"')
-                self.num_images_skipped += 1
-                return
+        return True
+
+    # Returns path of the file of a target that is checked by skip_image(). If tiles is True, this is
+    # the file of the last tile of a tile scan, which is written last, so if it exists, the others do too.
+    def last_output_path(self, img, target, tiles=False):
+
+        img_name = self.output_name(img, target.zstack_format)
+        if tiles:
+            img_name += self.tile_label(img, img.dims.m - 1)
+        f_path = self.target_path(target, img_name)
+
+        if self.jpg_tiles(target, *self.output_size(img)):
+            # Image is split into a grid of tiles, and the bottom right tile is written last
+            columns, rows = grid_size(*self.output_size(img), self.conversion_options.jpg_tile_size)
+            f_path = tile_path(f_path, columns - 1, rows - 1)
+
+        return f_path
+
+    # Returns targets that write images, i.e. all except XML.
+    def image_targets(self):
+
+        return [target for target in self.conversion_options.targets()
+                if target.convert_format != self.Options.Format.xml]
+
+    # Returns True if image is a tile scan that is to be stitched into a single image.
+    def is_stitched(self, img):
+
+        return img.dims.m > 1 and self.conversion_options.mosaic_format == self.Options.MosaicOptions.stitch
+
+    # Returns (width, height) of image, or of the stitched mosaic if the image consists of tiles.
+    def image_size(self, img):
+
+        if self.is_stitched(img):
+            return mosaic_size(img, tile_positions(img))
+        return img.dims.x, img.dims.y
+
+    # Returns (width, height) of output image, i.e. of the crop region if there is one.
+    def output_size(self, img):
+
+        region = self.get_crop_region(img)
+        if region is None:
+            return self.image_size(img)
+        return region[2], region[3]
+
+    # Returns True if output image of target is too big for a single JPG file, and will be split into tiles.
+    def jpg_tiles(self, target, width, height):
+
+        return (target.convert_format == self.Options.Format.jpg and target.thumbnail_size is None
+                and needs_tiles(width, height))
+
+    # Returns crop region clipped to image bounds, or None if the whole image is to be converted.
+    # When tiles are exported separately, the region applies to each tile.
+    def get_crop_region(self, img):
+
+        if self.conversion_options.crop is None:
+            return None
+
+        width, height = self.image_size(img)
+        x, y, w, h = [int(v) for v in self.conversion_options.crop]
+        x0 = min(max(x, 0), width)
+        y0 = min(max(y, 0), height)
+        x1 = min(max(x + w, 0), width)
+        y1 = min(max(y + h, 0), height)
+
+        return x0, y0, x1 - x0, y1 - y0
+
+    # Image name used for output files. Cropped images get the crop region appended, and z-stacks
+    # the type of projection, unless it is the default maximum intensity projection.
+    def output_name(self, img, zstack_format=None):
+
+        name = img.name
+        region = self.get_crop_region(img)
+        if region is not None:
+            name += f"_crop{region[0]}-{region[1]}-{region[2]}x{region[3]}"
+
+        if zstack_format is None:
+            zstack_format = self.conversion_options.zstack_format
+        tag = zstack_format.file_tag()
+        if img.dims.z > 1 and tag is not None:
+            name += f"_{tag}"
+
+        return name
+
+    # Text appended to output name of tile m, with its grid position if known.
+    @staticmethod
+    def tile_label(img, m):
+
+        if len(img.mosaic_position) == img.dims.m:
+            field_x, field_y = img.mosaic_position[m][:2]
+            return f"_tile_X{field_x}_Y{field_y}"
+        return f"_tile{m + 1}"
+
+    # Convert a single image within this file. Call skip_image() first to check whether this is necessary.
+    def convert_image(self, img):
 
         print(f'Processing image: "{img.name}"')
 
-        # Determine whether this is a z-stack
-        z_depth = img.dims.z
+        region = self.get_crop_region(img)
+        if region is not None:
+            if region[2] == 0 or region[3] == 0:
+                print('      Crop region is outside of image, skipping')
+                self.num_images_skipped += 1
+                return
+            if region != tuple(self.conversion_options.crop):
+                print(f'      Crop region {tuple(self.conversion_options.crop)} extends beyond image, clipping to {region}')
+
+        full_width, full_height = self.image_size(img)
+        if self.is_stitched(img):
+            print(f'      Stitching {img.dims.m} tiles of width {img.dims.x} x height {img.dims.y} into mosaic')
+            if region is not None and not tiles_in_region(tile_positions(img), (img.dims.x, img.dims.y), region):
+                print('      Crop region falls between tiles, skipping')
+                self.num_images_skipped += 1
+                return
 
-        xml_chans = xml_metadata['metadata_xml'].findall("./Data/Image/ImageDescription/Channels/ChannelDescription")
+        # Channel metadata comes from the LifFile image descriptor, so no XML needs to be searched here
+        xml_chans = img.info["channel_descriptions"]
         n_chan = len(xml_chans)
-        xml_scales = xml_metadata['metadata_xml'].findall("./Data/Image/Attachment/ChannelScalingInfo")
+        xml_scales = img.info["channel_scaling"]
+
+        bit_depth, max_val, pixel_type = self.pixel_format(img)
+
+        if region is None:
+            width, height = full_width, full_height
+            print(f'      Image size is: width {width} x height {height}')
+        else:
+            width, height = region[2], region[3]
+            print(f'      Image size is: width {full_width} x height {full_height}, '
+                  f'cropping to width {width} x height {height} at ({region[0]}, {region[1]})')
+        print(f'      Found {n_chan} color channels, bit depth is {bit_depth}')
+
+        targets = self.image_targets()
+        if any(self.jpg_tiles(target, width, height) for target in targets):
+            tile_size = self.conversion_options.jpg_tile_size
+            columns, rows = grid_size(width, height, tile_size)
+            print(f'        JPG only supports up to 65,535 x 65,535 pixels, will split into {columns} x {rows} '
+                  f'tiles of up to {tile_size} x {tile_size} pixels')
+
+        levels = []
+        for m in range(n_chan):
+            if (n_chan - m) <= len(xml_scales):
+                xml_scale = xml_scales[-(n_chan - m)]
+                white_value = xml_scale["WhiteValue"]
+                black_value = xml_scale["BlackValue"]
+            else:
+                # Some images, like snapshots, may not have ChannelScalingInfo. Just use defaults.
+                white_value = 1
+                black_value = 0
+            levels.append((float(black_value), float(white_value)))
+
+        outputs = self.plan_outputs(img, targets, levels, bit_depth, max_val, pixel_type)
+        if not outputs:
+            print('      No colors are present, will not write file')
+            return
+
+        if img.dims.m > 1 and not self.is_stitched(img):
+            self.export_tiles(img, outputs, region)
+            self.image_done(img.name)
+            return
+
+        group = self.write_pool.group() if self.write_pool is not None else None
+        try:
+            self.export_image(img, outputs, region, group=group)
+        except BaseException:
+            if group is not None:
+                # Files already handed over are still written, but the image isn't counted as converted
+                group.close()
+            raise
+        if group is None:
+            self.image_done(img.name)
+        else:
+            # Image is counted once its last file has been written
+            group.close(partial(self.image_done, img.name))
+        return
+
+    # Returns (bit depth, maximum value, numpy type) of the raw pixels of an image.
+    @staticmethod
+    def pixel_format(img):
 
         bit_depth = img.bit_depth
 
@@ -191,315 +506,651 @@ class LifClass:
             bit_depth = bit_depth[0]
 
         if bit_depth == 16:
-            pixel_type_string = "uint16"
-            max_val = 65535
             # Must use unsigned ints, otherwise values above 50% will become negative and truncated to black.
-            pixel_type = np.uint16
+            return bit_depth, 65535, np.uint16
         elif bit_depth == 8:
-            pixel_type_string = "uint8"
-            max_val = 255
-            pixel_type = np.uint8
+            return bit_depth, 255, np.uint8
+        return bit_depth, 65535, np.uint16
+
+    def estimate_memory(self, img):
+        """
+        Estimates peak memory of convert_image(), from the dimensions and bit depth of the image and the
+        conversion options, without reading any pixels. Used to decide which images can be converted at
+        the same time, see batch.py.
+
+        Counts the same buffers that export_image() sizes its bands by. Memory-mapped pixels and stitching
+        canvases are read through the page cache, which the OS can reclaim, so they aren't counted.
+
+        Returns:
+            bytes, or 0 if the image will be skipped
+        """
+        if img.dims.m > 1:
+            mosaic_format = self.conversion_options.mosaic_format
+            if mosaic_format == self.Options.MosaicOptions.skip:
+                return 0
+            if mosaic_format == self.Options.MosaicOptions.stitch:
+                try:
+                    tile_positions(img)
+                except ValueError:
+                    return 0
+
+        region = self.get_crop_region(img)
+        if region is not None and (region[2] == 0 or region[3] == 0):
+            return 0
+        # Tiles that aren't stitched are exported separately, with the crop region applied to each
+        width, height = self.output_size(img)
+        stitched = self.is_stitched(img)
+        tiles = img.dims.m > 1 and not stitched
+
+        n_chan = len(img.info["channel_descriptions"])
+        bit_depth, max_val, pixel_type = self.pixel_format(img)
+        # Levels don't change the size of anything
+        outputs = self.plan_outputs(img, self.image_targets(), [(0, 1)] * n_chan, bit_depth, max_val, pixel_type,
+                                    verbose=False)
+        if not outputs:
+            return 0
+
+        reducers = self.projection_reducers(outputs)
+        project_tiles = stitched and all(output["source"] is not None for output in outputs)
+        layout = self.band_layout(img, outputs, self.output_files(img, outputs), width, height, reducers,
+                                  project=not project_tiles)
+        out_row_bytes = layout["out_row_bytes"]
+        image_bytes = height * max(out_row_bytes.values())
+
+        memory = layout["band_rows"] * layout["row_bytes"] + layout["writer_bytes"]
+        if layout["whole"] and not tiles and self.conversion_options.write_workers and \
+                self.write_pool_fits(image_bytes):
+            # Up to write_queue + 1 whole images are held by the write pool, instead of the reusable buffers
+            memory += (self.conversion_options.write_queue + 1) * image_bytes - height * sum(out_row_bytes.values())
+
+        plane_bytes = img.dims.x * img.dims.y * np.dtype(pixel_type).itemsize
+        if project_tiles:
+            # Each tile is projected in memory before it is stitched, see stitch_mosaic()
+            memory += n_chan * img.dims.x * img.dims.y * projection_bytes(reducers, pixel_type, img.dims.z)
+        if reducers and (project_tiles or (not stitched and region is None and layout["band_rows"] >= img.dims.y)):
+            # Whole stacks are read in chunks, see reader.LifImage.iter_stack_chunks()
+            memory += min(img.dims.z * n_chan * plane_bytes, max(DEFAULT_CHUNK_BYTES, n_chan * plane_bytes))
+
+        if tiles:
+            # Tiles are exported in parallel, each with its own buffers, see export_tiles()
+            memory *= min(img.dims.m, self.conversion_options.tile_workers or os.cpu_count() or 1)
+        return memory
+
+    # Counts an image whose files have all been written, and reports it. Called on a writing thread
+    # if files were written in the background, see write_pool.py.
+    def image_done(self, img_name, error=None):
+
+        with self.counter_lock:
+            if error is None:
+                self.num_images_converted += 1
+            else:
+                self.num_images_error += 1
+
+        if error is not None:
+            print(f'      Error while writing image "{img_name}": {error}')
+        if self.image_callback is not None:
+            self.image_callback(img_name, error)
+
+    # Returns (numpy type of output pixels, depth_factor that converts raw values to it) for an output format.
+    def output_type(self, convert_format, bit_depth, pixel_type):
+
+        # Bit depth of output is converted by the same lookup table that rescales intensity,
+        # so raw pixels go straight to output values in a single pass per channel.
+        if convert_format == self.Options.Format.jpg:
+            # JPG only supports 8-bit depth, so divide 16-bit by 256 and 12-bit by 16
+            return np.uint8, {16: 1 / 256, 12: 1 / 16}.get(bit_depth, 1)
+        elif bit_depth == 12:
+            # TIFF supports either 8 or 16 bit depth. 12-bit will need to be multiplied by 16
+            return np.uint16, 16
+        return pixel_type, 1
+
+    def plan_outputs(self, img, targets, levels, bit_depth, max_val, pixel_type, verbose=True):
+        """
+        Decides which images are built from the planes or projections of an image, and which files each goes to.
+
+        Targets often need the same image, e.g. a JPG and its thumbnail, or TIFF and OME-TIFF of the same
+        bit depth. Such images are built once, and written to the files of all of them.
+
+        Args:
+            targets (list): Options.Target of each set of files
+            levels (list): (black value, white value) of each channel
+            bit_depth (int): bit depth of raw pixels
+            max_val, pixel_type: maximum value and numpy type of raw pixels, see rescale.get_lut()
+            verbose (bool): print how z-stacks will be projected
+
+        Returns:
+            List of dictionaries, one per image to build, with keys:
+                "source": None to build an image from each z plane, or name of projection to build it from
+                "channels": [(channel index, [blue lut, green lut, red lut]), ...], see compositor.composite()
+                "depth": (channel index, colors, lut) for depth maps, see compositor.composite_depth(), or None
+                "out_type": numpy type of output pixels
+                "files": [(target, image name, suffix), ...], one per file the image is written to
+        """
+        z_depth = img.dims.z
+        lut_names = [chan["LUTName"] for chan in img.info["channel_descriptions"]]
+        n_chan = len(lut_names)
+
+        composites = {}
+        announced = set()
+        outputs = {}
+        paths = set()
+        for target in targets:
+            out_type, depth_factor = self.output_type(target.convert_format, bit_depth, pixel_type)
+            name = self.output_name(img, target.zstack_format)
+            reducers = target.zstack_format.reducers() if z_depth > 1 else ()
+
+            if verbose and reducers and target.zstack_format not in announced:
+                if reducers == ("max",):
+                    print(f'        Found z-stack of depth {z_depth}, will scan all images and select brightest value '
+                          f'for each pixel (which may come from different z-planes).')
+                else:
+                    print(f'        Found z-stack of depth {z_depth}, will scan all images and calculate '
+                          f'{target.zstack_format.file_tag().replace("_", " ")} projection.')
+
+            images = []
+            if "argmax" in reducers:
+                # One file per channel, colored by z plane of the brightest value of each pixel
+                coded = target.zstack_format == self.Options.ZStackOptions.depth_coded
+                if verbose and target.zstack_format not in announced:
+                    print(f'        First z plane is {"blue" if coded else "black"}, last is {"red" if coded else "white"}')
+                colors = depth_colors(z_depth, out_type, coded=coded)
+                for m in range(n_chan):
+                    black_value, white_value = levels[m]
+                    lut = get_lut(black_value, white_value, max_val, pixel_type, depth_factor, out_type) if coded else None
+                    key = ("argmax", coded, m, np.dtype(out_type).str, depth_factor)
+                    images.append((key, channel_suffix(lut_names[m], m),
+                                   {"source": "argmax", "channels": None, "depth": (m, colors, lut)}))
+            else:
+                if target.color_format not in composites:
+                    # Decide which channels go into which file. Colors that overlap others are put into their
+                    # own file (RGB_CMY), or added to the existing colors at reduced intensity (all_together).
+                    composites[target.color_format] = plan_composites(
+                        lut_names, separate_all=target.color_format == self.Options.ColorOptions.all_separate,
+                        separate_overlaps=target.color_format == self.Options.ColorOptions.RGB_CMY)
+                source = reducers[0] if reducers else None
+                for suffix, channels in composites[target.color_format]:
+                    sources = []
+                    for m, weights in channels:
+                        black_value, white_value = levels[m]
+                        # Rescaling, bit depth conversion and channel weight are all done by one table,
+                        # which is built once per setting and shared with other channels and images.
+                        luts = [get_lut(black_value, white_value, max_val, pixel_type, depth_factor, out_type, w)
+                                if w > 0 else None for w in weights]
+                        sources.append((m, luts))
+                    key = (source, tuple((m, tuple(weights)) for m, weights in channels),
+                           np.dtype(out_type).str, depth_factor)
+                    images.append((key, suffix, {"source": source, "channels": sources, "depth": None}))
+            announced.add(target.zstack_format)
+
+            for key, suffix, image in images:
+                # Targets can ask for the same file, e.g. z-stack options of single plane images. Write it once.
+                path = (self.target_path(target, name, suffix), image["source"] is None)
+                if path in paths:
+                    continue
+                paths.add(path)
+                if key not in outputs:
+                    outputs[key] = dict(image, out_type=out_type, files=[])
+                outputs[key]["files"].append((target, name, suffix))
+
+        return list(outputs.values())
+
+    def export_image(self, img, outputs, region=None, tile=None, label="", worker=False, group=None):
+        """
+        Builds and writes all output files of one image, in a single pass over its planes.
+
+        The image is processed a band of rows at a time. Each band of each z plane is read once, added to
+        the projections, and composited into every image that is built from single planes. Images built
+        from projections are composited once all planes of the band have been added. Each band goes from
+        reading through projection, rescaling, compositing and rotation to every writer before the next
+        one is read. Bands are sized to fit within memory_budget, unless some file can only be written
+        whole (JPG, or TIFF smaller than memory_budget), in which case the band is the whole image.
+
+        Rotated images are written from top to bottom like any other, by reading the source bands
+        from the bottom up and rotating each one.
+
+        Args:
+            outputs (list): images to build, and the files they go to, from plan_outputs()
+            region (tuple): (x, y, width, height) to export, or None for the whole image
+            tile (int): mosaic tile to export on its own. If None, a tile scan is stitched.
+            label (str): text appended to image names, e.g. tile_label() of the tile
+            worker (bool): True if running on a worker thread, see export_tiles(). Workers don't print
+                progress or check the stop flag, and don't share the reusable output buffers.
+            group (WriteGroup): if given, whole images are written in the background, see write_pool.py
+        """
+        z_depth = img.dims.z
+        rotate180 = self.conversion_options.rotate180
+        stitched = tile is None and self.is_stitched(img)
+        if tile is None:
+            tile = 0
+
+        if region is None:
+            x0, y0 = 0, 0
+            width, height = self.image_size(img)
         else:
-            pixel_type_string = "uint16"
-            max_val = 65535
-            pixel_type = np.uint16
-
-        img_green = None
-        img_red = None
-        img_blue = None
-        img_cyan = None
-        img_magenta = None
-        img_yellow = None
-        img_grey = None
-
-        make_cyan_file = False
-        make_magenta_file = False
-        make_yellow_file = False
-
-        print(f'      Image size is: width {img.dims.x} x height {img.dims.y}')
-        print(f'      Found {n_chan} color channels, bit depth is {bit_depth}')
+            x0, y0, width, height = region
+
+        plane_outputs = [k for k, output in enumerate(outputs) if output["source"] is None]
+        projected_outputs = [k for k, output in enumerate(outputs) if output["source"] is not None]
+        reducers = self.projection_reducers(outputs)
+        files = self.output_files(img, outputs, label)
+
+        stitched_planes = None
+        stitched_projections = None
+        if stitched and plane_outputs:
+            # Every plane is needed, so all of them are stitched in one pass over the tiles,
+            # and projections are calculated from the stitched planes
+            stitched_planes = self.stitch_mosaic(img, lambda m: dict(enumerate(img.get_stack(t=0, m=m))), region)
+        elif stitched:
+            # Project each tile, then stitch the projections. Stitched projections are kept on disk, see stitch_mosaic()
+            stitched_projections = self.stitch_mosaic(img, lambda m: self.project_stack(img, reducers, m=m), region)
+
+        layout = self.band_layout(img, outputs, files, width, height, reducers, project=stitched_projections is None)
+        whole = layout["whole"]
+        band_rows = layout["band_rows"]
+        strip_rows = layout["strip_rows"]
+        out_types = list(layout["out_row_bytes"])
+        if not whole and not worker:
+            print(f'        Converting in strips of {band_rows} rows, to stay within memory budget '
+                  f'of {self.conversion_options.memory_budget / 1024 ** 2:.0f} MB')
+
+        # Whole images can be handed to the write pool, so the next one is built in another buffer while they
+        # are written
+        if whole and group is not None and self.write_pool_fits(height * max(layout["out_row_bytes"].values())):
+            # Buffers come from the pool, see emit()
+            buffers = None
+        else:
+            group = None
+            if worker:
+                # Other threads are using the shared buffers
+                buffers = {dtype: np.empty((band_rows, width, 3), dtype=dtype) for dtype in out_types}
+            else:
+                # Output buffers are reused for every file written from this image, and for following images
+                # of the same size
+                buffers = {dtype: self.get_output_buffer((band_rows, width, 3), dtype) for dtype in out_types}
+
+        writers = {}
+        written = []
+
+        def emit(k, z, frames, projections, n):
+            # Composites output k of a band, and writes it to every file of output k for z plane z. Writers are
+            # opened at the first band, and closed after the last, so a file per z plane is only open while its
+            # plane is written.
+            dtype = np.dtype(outputs[k]["out_type"])
+            band = group.pool.get_buffer((n, width, 3), dtype) if group is not None else buffers[dtype][:n]
+            try:
+                if outputs[k]["depth"] is not None:
+                    m, colors, lut = outputs[k]["depth"]
+                    raw = projections["max"][m] if lut is not None else None
+                    composite_depth(projections["argmax"][m], colors, band, raw=raw, lut=lut, rotate180=rotate180)
+                else:
+                    composite([(frames[m], luts) for m, luts in outputs[k]["channels"]], band, rotate180=rotate180)
+
+                for file_z, target, suffix, path in files[k]:
+                    if file_z != z:
+                        continue
+                    writer = writers.get(path)
+                    if writer is None:
+                        writer = writers[path] = self.open_writer(img, target, path, width, height, dtype,
+                                                                  strip_rows, group)
+                    writer.write(band)
+                    if writer.rows_written == height:
+                        del writers[path]
+                        writer.close()
+                        background = group is not None and isinstance(writer, WholeImageWriter)
+                        written.append((target, suffix, path, background))
+            finally:
+                if group is not None:
+                    # Buffer is reused once the writes have finished
+                    group.pool.release(band)
+
+        if not worker:
+            suffixes = dict.fromkeys(suffix for output in outputs for target, name, suffix in output["files"])
+            print(f'        Generating {", ".join(suffixes)} image(s): ', end="")
+        start = time.time()
 
-        if self.conversion_options.convert_format == self.Options.Format.jpg:
-            if img.dims.x > 65535 or img.dims.y > 65535:
-                print(f'        JPG only supports up to 65,535 x 65,535 pixels, skipping')
-                return
+        try:
+            for row in range(0, height, band_rows):
+                if not worker:
+                    if self.stopFlag.check():
+                        raise self.UserCanceled
+                    print('.', end="")
+
+                n = min(band_rows, height - row)
+                # Source rows of this band. Rotated output starts with the last source rows.
+                src = height - row - n if rotate180 else row
+
+                if stitched_projections is not None:
+                    projections = {key: canvas[:, src:src + n] for key, canvas in stitched_projections.items()}
+                else:
+                    projector = StackProjector(reducers, n_planes=z_depth) if reducers else None
+                    if stitched_planes is not None:
+                        planes = (stitched_planes[z][:, src:src + n] for z in range(z_depth))
+                    elif projector is not None and n == img.dims.y and width == img.dims.x:
+                        # Whole stack, so read the memory block once, in on-disk order
+                        planes = (chunk[k] for z_start, chunk in img.iter_stack_chunks(t=0, m=tile)
+                                  for k in range(len(chunk)))
+                    else:
+                        # Read-only memory-mapped views, so only this band is read
+                        planes = (plane[:, y0 + src:y0 + src + n, x0:x0 + width]
+                                  for plane in img.get_stack(t=0, m=tile))
+
+                    for z, plane in enumerate(planes):
+                        if not worker:
+                            # Keep GUI responsive and check for user interruption
+                            if self.stopFlag.check():
+                                raise self.UserCanceled
+                            if band_rows >= height and projector is not None:
+                                print('.', end="")
+                        if projector is not None:
+                            projector.add(plane)
+                        for k in plane_outputs:
+                            emit(k, z if z_depth > 1 else None, plane, None, n)
+                    projections = projector.result() if projector is not None else None
+
+                for k in projected_outputs:
+                    emit(k, None, projections[outputs[k]["source"]], projections, n)
+        except BaseException:
+            # Unfinished files are deleted, so they can't be mistaken for converted images
+            for writer in writers.values():
+                writer.abort()
+            raise
+
+        if not worker:
+            print(f'\n          Completed in {time.time() - start:.1f} seconds.')
+            for target, suffix, path, background in written:
+                if background:
+                    print(f'      Writing {suffix} file in background: "{os.path.basename(path)}"')
+                elif target.thumbnail_size is not None:
+                    print(f'      Wrote {suffix} thumbnail: "{os.path.basename(path)}"')
+                elif self.jpg_tiles(target, width, height):
+                    columns, rows = grid_size(width, height, self.conversion_options.jpg_tile_size)
+                    print(f'      Wrote {columns * rows} {suffix} tiles: "{os.path.basename(tile_path(path, 0, 0))}" '
+                          f'to "{os.path.basename(tile_path(path, columns - 1, rows - 1))}"')
+                else:
+                    print(f'      Wrote {suffix} file: "{os.path.basename(path)}"')
+
+    @staticmethod
+    def projection_reducers(outputs):
+        """Returns the projections that are calculated for outputs of plan_outputs(), see projection.REDUCERS."""
+        reducers = set(output["source"] for output in outputs if output["source"] is not None)
+        if any(output["depth"] is not None and output["depth"][2] is not None
+               for output in outputs if output["source"] is not None):
+            # Depth-coded maps are scaled by the brightness of the maximum projection
+            reducers.add("max")
+        return tuple(sorted(reducers))
+
+    def output_files(self, img, outputs, label=""):
+        """
+        Returns the files written from each output of plan_outputs(), as lists of (z plane, target, suffix, path).
+        Images built from single planes of a z-stack are written to a file per plane, with the plane number
+        appended to the name. label is appended to every image name, see export_image().
+        """
+        files = []
+        for output in outputs:
+            planes = range(img.dims.z) if output["source"] is None and img.dims.z > 1 else [None]
+            files.append([(z, target, suffix,
+                           self.target_path(target, name + label + ("" if z is None else f"_Z{z + 1}"), suffix))
+                          for target, name, suffix in output["files"] for z in planes])
+        return files
+
+    def band_layout(self, img, outputs, files, width, height, reducers, project=True):
+        """
+        Decides how many rows of an image are built at a time, see export_image(). Bands are sized to fit
+        within memory_budget, unless some file can only be written whole.
+
+        Args:
+            outputs (list): images to build, from plan_outputs()
+            files (list): files of each output, from output_files()
+            width, height (int): size of output images
+            reducers (tuple): projections that are calculated, from projection_reducers()
+            project (bool): True if projections are calculated a band at a time, False if they are stitched
+                beforehand
+
+        Returns:
+            Dictionary with keys:
+                "whole": True if some file can only be written whole, so the band is the whole image
+                "band_rows": number of rows per band
+                "strip_rows": rows per TIFF strip
+                "out_row_bytes": {numpy dtype: bytes per row of output images of that type}
+                "row_bytes": memory needed per row of a band
+                "writer_bytes": memory held by writers that collect rows of tiles
+        """
+        out_types = list(dict.fromkeys(np.dtype(output["out_type"]) for output in outputs))
+
+        # Memory needed per row: the output bands, plus projection accumulators and their temporaries.
+        # Memory-mapped pixels are read through the page cache, which the OS can reclaim.
+        out_row_bytes = {dtype: width * 3 * dtype.itemsize for dtype in out_types}
+        row_bytes = sum(out_row_bytes.values())
+        if reducers and project:
+            n_chan = len(img.info["channel_descriptions"])
+            row_bytes += n_chan * width * projection_bytes(reducers, self.pixel_format(img)[2], img.dims.z)
+        whole = False
+        writer_bytes = 0
+        for output, output_files in zip(outputs, files):
+            for z, target, suffix, path in output_files:
+                if not self.streams(target, width, height, output["out_type"]):
+                    whole = True
+                elif target.convert_format == self.Options.Format.ome_tiff:
+                    # Each pyramid writer holds about two rows of tiles, see tiff_writer.PyramidTiffWriter
+                    writer_bytes += 2 * DEFAULT_TILE_SIZE * out_row_bytes[np.dtype(output["out_type"])]
+                elif self.jpg_tiles(target, width, height):
+                    # So does each tiled JPG writer, see jpeg_writer.TiledJpegWriter
+                    tile_size = self.conversion_options.jpg_tile_size
+                    writer_bytes += 2 * tile_size * out_row_bytes[np.dtype(output["out_type"])]
+
+        # TIFF strips are sized for the widest pixels
+        strip_rows = max(1, DEFAULT_STRIP_BYTES // max(out_row_bytes.values()))
+        if whole:
+            # Some files are written with cv2.imwrite(), which needs the whole image
+            band_rows = height
+        else:
+            band_rows = max(1, min(height, (self.conversion_options.memory_budget - writer_bytes) // row_bytes))
+            # Bands must be a whole number of TIFF strips
+            if band_rows >= strip_rows:
+                band_rows -= band_rows % strip_rows
+            else:
+                strip_rows = band_rows
+
+        return {"whole": whole, "band_rows": band_rows, "strip_rows": strip_rows, "out_row_bytes": out_row_bytes,
+                "row_bytes": row_bytes, "writer_bytes": writer_bytes}
+
+    def write_pool_fits(self, image_bytes):
+        """
+        Returns True if whole images of image_bytes can be written in the background. Up to write_queue
+        of them wait to be written while the next is built, so they must all fit within memory_budget.
+        """
+        return (self.conversion_options.write_queue + 1) * image_bytes <= self.conversion_options.memory_budget
+
+    def streams(self, target, width, height, out_type):
+        """
+        Returns True if files of target are written a band of rows at a time, see export_image(),
+        or False if they can only be written whole.
+        """
+        if target.thumbnail_size is not None:
+            # Thumbnails are shrunk as rows arrive
+            return True
+        if target.convert_format == self.Options.Format.ome_tiff:
+            # Pyramids are always built as rows arrive
+            return True
+        if target.convert_format == self.Options.Format.jpg:
+            # JPG images that are too big for one file are split into tiles as rows arrive
+            return self.jpg_tiles(target, width, height)
+        image_bytes = width * height * 3 * np.dtype(out_type).itemsize
+        return self.conversion_options.stream_tiff or image_bytes > self.conversion_options.memory_budget
+
+    def open_writer(self, img, target, path, width, height, out_type, strip_rows, group=None):
+        """
+        Returns writer for a file of target, see export_image(): tiled and pyramidal for OME-TIFF,
+        a grid of tiles for JPG images too big for one file, strips for TIFF images that are streamed,
+        and cv2.imwrite() for the rest, in the background if group is given.
+        """
+        # JPG quality is the same for whole images, tiles and thumbnails
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), 90] if target.convert_format == self.Options.Format.jpg else []
+        if target.thumbnail_size is not None:
+            return ThumbnailWriter(path, width, height, target.thumbnail_size, params)
+
+        if target.convert_format == self.Options.Format.jpg:
+            if self.jpg_tiles(target, width, height):
+                return TiledJpegWriter(path, width, height, tile_size=self.conversion_options.jpg_tile_size, quality=90)
+            return WholeImageWriter(path, width, height, out_type, params, pool=group)
+
+        compression = self.conversion_options.tiff_compression
+        if target.convert_format == self.Options.Format.ome_tiff:
+            scale_x = img.scale_n.get(1)
+            scale_y = img.scale_n.get(2)
+            # scale_n is in pixels per micrometer
+            pixel_size = (1 / scale_x, 1 / scale_y) if scale_x and scale_y else None
+            return PyramidTiffWriter(path, width, height, out_type, compression=compression,
+                                     name=img.name, pixel_size=pixel_size)
+        if self.streams(target, width, height, out_type):
+            return StripTiffWriter(path, width, height, out_type, compression=compression, rows_per_strip=strip_rows)
+        return WholeImageWriter(path, width, height, out_type, pool=group)
+
+    def export_tiles(self, img, outputs, region=None):
+        """
+        Exports every tile of a tile scan to its own files, in parallel on a pool of worker threads,
+        and writes the position of each tile to a CSV file.
+
+        Reading is memory-mapped, and numpy and OpenCV release the GIL while rescaling and encoding,
+        so threads scale well without copying the image to other processes.
+
+        Args:
+            see export_image()
+        """
+        labels = [self.tile_label(img, m) for m in range(img.dims.m)]
+        base_name = self.output_name(img)
+        self.write_tile_table(img, base_name, [base_name + label for label in labels])
+
+        n_workers = self.conversion_options.tile_workers or os.cpu_count() or 1
+        print(f'      Exporting {img.dims.m} tiles of width {img.dims.x} x height {img.dims.y}, '
+              f'using {n_workers} threads')
+        start = time.time()
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(self.export_image, img, outputs, region, m, labels[m], True)
+                       for m in range(img.dims.m)]
+            try:
+                for future in as_completed(futures):
+                    # Re-raises any exception from the worker
+                    future.result()
+                    print('.', end="")
+                    if self.stopFlag.check():
+                        raise self.UserCanceled
+            except BaseException:
+                # Don't start any more tiles. Tiles already being written are allowed to finish.
+                for future in futures:
+                    future.cancel()
+                raise
+            finally:
+                print()
+
+        print(f'      Completed in {time.time() - start:.1f} seconds.')
+
+    def write_tile_table(self, img, base_name, names):
+        """
+        Writes mosaic_position of each tile to a CSV file next to the tile images, for registration tools.
+        Pixel positions are included if the tile positions and pixel size are known, see mosaic.tile_positions().
+        """
+        csv_path = self.generate_filepath(base_name, suffix="tiles", ext=".csv")
+
+        try:
+            pixels = tile_positions(img)
+        except ValueError:
+            pixels = None
+
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["tile", "name", "FieldX", "FieldY", "PosX", "PosY", "x_pixels", "y_pixels"])
+            for m, name in enumerate(names):
+                position = list(img.mosaic_position[m]) if m < len(img.mosaic_position) else ["", "", "", ""]
+                pixel = list(pixels[m]) if pixels is not None else ["", ""]
+                writer.writerow([m + 1, name] + position + pixel)
 
-        d = None
+        print(f'      Wrote tile positions to "{os.path.basename(csv_path)}"')
 
-        separate_CMY = self.conversion_options.color_format == self.Options.ColorOptions.RGB_CMY
-        separate_ALL = self.conversion_options.color_format == self.Options.ColorOptions.all_separate
-        do_max_project = self.conversion_options.zstack_format == self.Options.ZStackOptions.max_project
+    def get_output_buffer(self, shape, dtype):
+        """
+        Returns contiguous array for building output images. The same array is returned
+        for consecutive requests with the same shape and dtype, so it is only allocated once.
+        One array is kept per dtype, for targets with different bit depths.
+        """
+        dtype = np.dtype(dtype)
+        if self.output_buffers is None:
+            self.output_buffers = {}
+        buffer = self.output_buffers.get(dtype)
+        if buffer is None or buffer.shape != shape:
+            # Release old buffer before allocating new one, to keep peak memory down
+            self.output_buffers[dtype] = None
+            buffer = self.output_buffers[dtype] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def project_stack(self, img, reducers=("max",), t=0, m=0, region=None, verbose=True):
+        """
+        Calculates projections (e.g. maximum intensity) of all channels of a z-stack.
 
-        if do_max_project:
-            export_z_loop_count = 1
+        The memory block is read once, in on-disk order, rather than once per channel,
+        and all projections are calculated in the same pass.
+        If region (x, y, width, height) is given, only that part of each plane is read.
+
+        Args:
+            reducers (tuple): types of projection, from projection.REDUCERS
+            verbose (bool): print progress and check the stop flag. Turned off on worker threads.
+
+        Returns:
+            dictionary of numpy arrays of shape (c, y, x), one per reducer
+        """
+        if region is None:
+            planes = (chunk[k] for z_start, chunk in img.iter_stack_chunks(t=t, m=m) for k in range(len(chunk)))
         else:
-            export_z_loop_count = z_depth
+            x, y, w, h = region
+            planes = (plane[:, y:y + h, x:x + w] for plane in img.get_stack(t=t, m=m))
 
-        for z in range(export_z_loop_count):
+        def progress():
+            # Keep GUI responsive and check for user interruption
+            if self.stopFlag.check():
+                raise self.UserCanceled
+            print('.', end="")
 
-            for m in range(n_chan):
+        if not verbose:
+            return project_stack(planes, reducers, n_planes=img.dims.z)
 
-                if self.stopFlag.check():
-                    raise self.UserCanceled
+        projections = project_stack(planes, reducers, n_planes=img.dims.z, progress=progress)
+        print()
 
-                color = xml_chans[m].attrib["LUTName"]
-                print(f'        Generating image for channel {color}: ')
-                if (n_chan - m) <= len(xml_scales):
-                    xml_scale = xml_scales[-(n_chan - m)]
-                    white_value = xml_scale.attrib["WhiteValue"]
-                    black_value = xml_scale.attrib["BlackValue"]
-                else:
-                    # Some images, like snapshots, may not have ChannelScalingInfo. Just use defaults.
-                    white_value = 1
-                    black_value = 0
-
-                white_value = float(white_value)
-                black_value = float(black_value)
-
-                start = time.time()
-
-                # Access a specific item, after possibly calculating z-stack
-                if z_depth > 1 and do_max_project:
-                    print(f'        Found z-stack of depth {z_depth}, will scan all images and select brightest value for '
-                          f'each pixel (which may come from different z-planes).')
-
-                    ar = None
-
-                    for k in range(z_depth):
-                        # Keep GUI responsive and check for user interruption
-                        if self.stopFlag.check():
-                            raise self.UserCanceled
-                        print('.', end="")
-                        f = img.get_frame(z=k, t=0, c=m)
-                        if k == 0:
-                            ar = np.array(f)
-                        else:
-                            ar = np.maximum(ar, np.array(f))
-                    print()
-                else:
-                    f = img.get_frame(z=z, t=0, c=m)
-                    ar = np.array(f)
-
-                # Iterate over different items
-                # frame_list   = [i for i in img_0.get_iter_t(c=0, z=0)]
-                # z_list       = [i for i in img_0.get_iter_z(t=0, c=0)]
-                # channel_list = [i for i in img_0.get_iter_c(t=0, z=0)]
-
-                d = ar.shape
-
-                scale = 1.0 / (white_value - black_value)
-
-                offset1 = round(black_value * max_val)  # Using round() because that seems to match LASX
-
-                # Bin several rows together to speed up processing. This is more advantageous
-                # if rows are small. As they get bigger, the advantage diminishes, and may even
-                # reverse for unknown reasons (memory limit?)
-                chunk_h = img.dims.x  # * bit_depth / 8
-                if chunk_h < 4000:
-                    chunk_v = 32
-                elif chunk_h < 8000:
-                    chunk_v = 16
-                elif chunk_h < 16000:
-                    chunk_v = 8
-                elif chunk_h < 32000:
-                    chunk_v = 4
-                else:
-                    chunk_v = 2
-
-                row = 0
-
-                # Rescale image intensity with respect to black_level and white_level.
-                while row < d[0]:
-                    if row + chunk_v > d[0]:
-                        # Final chunk may be smaller than the previous ones.
-                        chunk_v = d[0] - row
-                    # Convert one chunk to float
-                    one_row = ar[row:row + chunk_v, ].astype(float)
-                    one_row = (one_row - offset1) * scale
-                    # Truncate underflow and overflow values.
-                    one_row[one_row < 0] = 0
-                    one_row[one_row > max_val] = max_val
-                    # Demote back to original data type and rewrite
-                    ar[row:row + chunk_v, ] = one_row.astype(pixel_type)
-                    row += chunk_v
-
-                end = time.time()
-                print(f'          Completed in {end - start:.1f} seconds.')
-
-                if separate_ALL:
-                    img_zeros = np.zeros(d, dtype=pixel_type_string)
-                    if color == "Green":
-                        self.write_file(np.dstack((img_zeros, ar, img_zeros)), img.name, bit_depth, suffix="green")
-                    elif color == "Red":
-                        self.write_file(np.dstack((img_zeros, img_zeros, ar)), img.name, bit_depth, suffix="red")
-                    elif color == "Blue":
-                        self.write_file(np.dstack((ar, img_zeros, img_zeros)), img.name, bit_depth, suffix="blue")
-                    elif color == "Cyan":
-                        self.write_file(np.dstack((ar, ar, img_zeros)), img.name, bit_depth, suffix="cyan")
-                    elif color == "Magenta":
-                        self.write_file(np.dstack((ar, img_zeros, ar)), img.name, bit_depth, suffix="magenta")
-                    elif color == "Yellow":
-                        self.write_file(np.dstack((img_zeros, ar, ar)), img.name, bit_depth, suffix="yellow")
+        return projections
 
-                    continue
+    def stitch_mosaic(self, img, get_tile, region=None):
+        """
+        Stitches the tiles of a tile scan into memory-mapped canvases, one tile at a time, see mosaic.py.
 
-                if color == "Green":
-                    img_green = ar
-                elif color == "Red":
-                    img_red = ar
-                elif color == "Blue":
-                    img_blue = ar
-                elif color == "Cyan":
-                    img_cyan = ar
-                elif color == "Magenta":
-                    img_magenta = ar
-                elif color == "Yellow":
-                    img_yellow = ar
-                elif color == "Gray" or color == "Grey":
-                    img_grey = ar
-                else:
-                    print(f'        Unrecognized color {color}, will skip this channel')
-                    continue
+        Canvases are backed by temporary files in mosaic_temp_dir, which are deleted once
+        the returned arrays are no longer used.
 
-            if not separate_ALL:
-                # Write merged file
-                if self.stopFlag.check():
-                    raise self.UserCanceled
-
-                if img_magenta is not None:
-                    if img_red is None and img_blue is None:
-                        # Neither red nor blue channels already exist, so just write normally
-                        img_red = img_magenta
-                        img_blue = img_magenta
-                    elif img_red is None and img_blue is not None:
-                        # If blue already exists, but red is empty, then just put this into red channel
-                        img_red = img_magenta
-                    elif img_blue is None and img_red is not None:
-                        # If red already exists, and blue is empty, then put into blue
-                        img_blue = img_magenta
-                    else:
-                        if separate_CMY:
-                            make_magenta_file = True
-                        else:
-                            # Both red and blue exist ... just bite the bullet and add it to the existing colors,
-                            # at reduced intensity
-                            im = img_magenta.astype(np.uint32) >> 1  # divide by two
-                            img_red = img_red.astype(np.uint32) + im
-                            img_blue = img_blue.astype(np.uint32) + im
-
-                            img_red[img_red > max_val] = max_val
-                            img_blue[img_blue > max_val] = max_val
-
-                            # Have to "demote" type back down to original 8 or 16-bit.
-                            img_red = img_red.astype(pixel_type)
-                            img_blue = img_blue.astype(pixel_type)
-
-                if img_cyan is not None:
-                    if img_green is None and img_blue is None:
-                        # Neither green nor blue exists, so write normally
-                        img_green = img_cyan
-                        img_blue = img_cyan
-                    elif img_blue is None:
-                        # Green channel is occupied but not blue. Put cyan channel in blue only
-                        print('    Converting cyan to blue, to avoid overlap with green channel')
-                        img_blue = img_cyan
-                    elif img_green is None:
-                        # Blue channel is occupied but not green. Put cyan channel in green only
-                        print('    Converting cyan to green, to avoid overlap with blue')
-                        img_blue = img_cyan
-                    else:
-                        # Have both blue and cyan channels. Merge cyan into main image, at reduced brightness
-                        if separate_CMY:
-                            make_cyan_file = True
-                        else:
-                            # If we have both blue and cyan, then merge it into green and blue channels.
-                            # Note: we have to temporarily promote datatype to 32-bit, or else numbers will overflow,
-                            # and then demote back to original datatype.
-                            im = img_cyan.astype(np.uint32) >> 1  # divide by two
-                            img_green = img_green.astype(np.uint32) + im
-                            img_blue = img_blue.astype(np.uint32) + im
-
-                            img_green[img_green > max_val] = max_val
-                            img_blue[img_blue > max_val] = max_val
-
-                            # Have to "demote" type back down to original 8 or 16-bit.
-                            img_green = img_green.astype(pixel_type)
-                            img_blue = img_blue.astype(pixel_type)
-
-                if img_grey is not None:
-                    # Neither red nor green channel exists, just write normally.
-                    img_red = img_grey
-                    img_green = img_grey
-                    img_blue = img_grey
-
-                if img_yellow is not None:
-                    if img_red is None and img_green is None:
-                        # Neither red nor green channel exists, just write normally.
-                        img_red = img_yellow
-                        img_green = img_yellow
-                    elif img_red is None:
-                        print('    Converting yellow to red, to avoid overlap with green')
-                        img_red = img_yellow
-                    elif img_green is None:
-                        print('    Converting yellow to green, to avoid overlap with red')
-                        img_green = img_yellow
-                    else:
-                        if separate_CMY:
-                            make_yellow_file = True
-                        else:
-                            # Have both red and green.
-                            im = img_yellow.astype(np.uint32) >> 1  # divide by two
-                            img_green = img_green.astype(np.uint32) + im
-                            img_red = img_red.astype(np.uint32) + im
-
-                            img_green[img_green > max_val] = max_val
-                            img_red[img_red > max_val] = max_val
-
-                            # Have to "demote" type back down to original 8 or 16-bit.
-                            img_green = img_green.astype(pixel_type)
-                            img_red = img_red.astype(pixel_type)
-
-                if img_red is None and img_green is None and img_blue is None:
-                    print('      No colors are present, will not write file')
-                    return
-
-                if img_red is None:
-                    img_red = np.zeros(d, dtype=pixel_type_string)
-                if img_green is None:
-                    img_green = np.zeros(d, dtype=pixel_type_string)
-                if img_blue is None:
-                    img_blue = np.zeros(d, dtype=pixel_type_string)
-
-                if self.stopFlag.check():
-                    raise self.UserCanceled
-
-                # imwrite requires BGR order, backwards from usual RGB
-                merged = np.dstack((img_blue, img_green, img_red))
-
-                if self.conversion_options.rotate180:
-                    merged = np.flip(merged, (0, 1))
-
-                if export_z_loop_count > 1:
-                    # Append z layer number to filename
-                    img_name = img.name + "_Z" + str(z+1)
-                else:
-                    img_name = img.name
+        Args:
+            get_tile (function): get_tile(m) returns dictionary of (c, y, x) arrays for tile m
+            region (tuple): (x, y, width, height) of the part of the mosaic to stitch, or None for all of it
 
-                self.write_file(merged, img_name, bit_depth)
+        Returns:
+            dictionary of numpy memmaps of shape (c, y, x), with the same keys as the tiles
+        """
+        positions = tile_positions(img)
+        if region is None:
+            region = (0, 0) + mosaic_size(img, positions)
 
-                if separate_CMY:
-                    img_zeros = np.zeros(d, dtype=pixel_type_string)
-                    if make_cyan_file:
-                        self.write_file(np.dstack((img_cyan, img_cyan, img_zeros)), img.name, bit_depth, suffix="cyan")
-                    if make_magenta_file:
-                        self.write_file(np.dstack((img_magenta, img_zeros, img_magenta)), img.name, bit_depth, suffix="magenta")
-                    if make_yellow_file:
-                        self.write_file(np.dstack((img_zeros, img_yellow, img_yellow)), img.name, bit_depth, suffix="yellow")
+        temp_dir = self.conversion_options.mosaic_temp_dir
+        if temp_dir is None:
+            # Mosaics can be bigger than the system temporary folder, but the LIF file was there already
+            temp_dir = os.path.dirname(os.path.abspath(self.file_path))
 
-        self.num_images_converted += 1
-        return
+        def progress():
+            # Keep GUI responsive and check for user interruption
+            if self.stopFlag.check():
+                raise self.UserCanceled
 
-    def generate_filepath(self, img_name, suffix="RGB"):
+        return stitch(get_tile, positions, (img.dims.x, img.dims.y), region, temp_dir, progress)
+
+    # Returns output path for an image. Extension depends on output format, unless ext is given.
+    def generate_filepath(self, img_name, suffix="RGB", ext=None):
 
         suffix = "_" + suffix
 
@@ -509,125 +1160,14 @@ class LifClass:
         img_name = img_name.replace('\\', '-')
         # Split path into root and extension
         paths = os.path.splitext(self.file_path)
-        if self.conversion_options.convert_format == self.Options.Format.jpg:
-            ext = ".jpg"
-        elif self.conversion_options.convert_format == self.Options.Format.tiff:
-            ext = ".tiff"
-        elif self.conversion_options.convert_format == self.Options.Format.xml:
-            ext = ".xml"
-        else:
-            raise f"Unknown format {self.conversion_options.convert_format}"
+        if ext is None:
+            ext = self.conversion_options.convert_format.extension()
 
         return paths[0] + "_" + img_name + suffix + ext
 
-    def write_file(self, merged, img_name, source_bit_depth, suffix="RGB"):
-
-        new_path = self.generate_filepath(img_name, suffix)
-        print(f'      Writing {suffix} file: "' + os.path.basename(new_path) + '"')
-        start = time.time()
-
-        if self.conversion_options.convert_format == self.Options.Format.jpg:
-            if source_bit_depth == 16:
-                # JPG only supports 8-bit depth, so divide by 256 using
-                # memory-efficient method
-                chunk_v = 4
-                row = 0
-                d = merged.shape
-                while row < d[0]:
-                    if row + chunk_v > d[0]:
-                        # Final chunk may be smaller than the previous ones.
-                        chunk_v = d[0] - row
-                    # Convert one chunk to float
-                    one_row = merged[row:row + chunk_v, ].astype(float)
-                    one_row = one_row / 256
-                    # Truncate underflow and overflow values.
-                    one_row[one_row > 255] = 255
-                    # Demote back to original data type and rewrite
-                    merged[row:row + chunk_v, ] = one_row.astype(np.uint16)
-                    row += chunk_v
-            elif source_bit_depth == 12:
-                # JPG only supports 8-bit depth, so divide by 16 using
-                # memory-efficient method
-                chunk_v = 4
-                row = 0
-                d = merged.shape
-                num_rows = d[0]
-                while row < num_rows:
-                    if row + chunk_v > num_rows:
-                        # Final chunk may be smaller than the previous ones.
-                        chunk_v = num_rows - row
-                    # Convert one chunk to float
-                    one_row = merged[row:row + chunk_v, ].astype(float)
-                    one_row = one_row / 16
-                    # Truncate underflow and overflow values.
-                    one_row[one_row > 255] = 255
-                    # Demote back to original data type and rewrite
-                    merged[row:row + chunk_v, ] = one_row.astype(np.uint16)
-                    row += chunk_v
-
-            cv2.imwrite(new_path, merged, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
-        elif self.conversion_options.convert_format == self.Options.Format.tiff:
-
-            if source_bit_depth == 12:
-                # TIFF supports either 8 or 16 bit depth. 12-bit will need to be multiplied by 16
-                # using memory-efficient method
-                chunk_v = 4
-                row = 0
-                d = merged.shape
-                num_rows = d[0]
-                while row < num_rows:
-                    if row + chunk_v > num_rows:
-                        # Final chunk may be smaller than the previous ones.
-                        chunk_v = num_rows - row
-                    # Convert one chunk to float
-                    one_row = merged[row:row + chunk_v, ].astype(float)
-                    one_row = one_row * 16
-                    # Truncate underflow and overflow values.
-                    one_row[one_row > 65535] = 65535
-                    # Demote back to original data type and rewrite
-                    merged[row:row + chunk_v, ] = one_row.astype(np.uint16)
-                    row += chunk_v
-
-            cv2.imwrite(new_path, merged)
-
-        end = time.time()
-        print(f'      Completed in {end - start:.1f} seconds.')
-
-    # Recursively finds metadata for all elements having a "Data/Image" subunit.
-    def _recursive_metadata_find(self, tree, return_list=None, path=""):
-        """Creates list of images by parsing the XML header recursively"""
-
-        if return_list is None:
-            return_list = []
-
-        children = tree.findall("./Children/Element")
-        if len(children) < 1:  # Fix for 'first round'
-            children = tree.findall("./Element")
-        for item in children:
-            folder_name = item.attrib["Name"]
-            # Grab the .lif filename name on the first execution
-            if path == "":
-                appended_path = folder_name
-            else:
-                appended_path = path + "/" + folder_name
-            # This finds empty folders
-            has_sub_children = len(item.findall("./Children/Element/Data")) > 0
-
-            is_image = (
-                    len(item.findall("./Data/Image")) > 0
-            )
-
-            if is_image:
-                # If additional XML data extraction is needed, add it here.
-
-                data_dict = {
-                    "metadata_xml": item
-                }
-
-                return_list.append(data_dict)
-
-            # An image can have sub_children, it is not mutually exclusive
-            if has_sub_children:
-                self._recursive_metadata_find(item, return_list, appended_path)
+    # Returns output path for an image of a target. Thumbnails have "_thumb" appended to the suffix.
+    def target_path(self, target, img_name, suffix="RGB"):
 
-        return return_list
+        if target.thumbnail_size is not None:
+            suffix += "_thumb"
+        return self.generate_filepath(img_name, suffix, ext=target.convert_format.extension())
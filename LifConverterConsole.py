@@ -1,85 +1,102 @@
 from LifClass import LifClass
+from batch import BatchConverter
 import tkinter as tk
 from tkinter import filedialog
 import os
 
-print('\nSelect what to convert:')
-print('1. All .LIF files in one folder (DEFAULT)')
-print('2. Single .LIF file')
-print('3. Single image within single .LIF file')
-answer_source = input('Make selection (default = 1): ')
-if answer_source == '':
-    answer_source = '1'
-
-conversion_options = LifClass.Options()
-
-print('\nSelect format to convert to:')
-print('1. JPG (90% quality, much smaller files, highly recommended, DEFAULT)')
-print('2. TIFF (larger files, but compression is lossless. Only use if higher quality is absolutely necessary. Not tested for BigTIFF >4GB files')
-answer = input('Make selection (default = 1): ')
-if answer == '' or answer == '1':
-    conversion_options.convert_format = LifClass.Options.Format.jpg
-elif answer == '2':
-    conversion_options.convert_format = LifClass.Options.Format.tiff
-else:
-    conversion_options.convert_format = LifClass.Options.Format.jpg
-
-if answer_source == 1:
-    print('\nOverwrite files that already exist?')
-    print('y. Use this if files have changed')
-    print('n. This saves time by skipping files that were already converte earlier (DEFAULT)')
-    answer = input('Make selection (default = n): ')
-    conversion_options.overwrite_existing = (answer == 'y')
-else:
-    # If converting just one file, then always overwrite
-    conversion_options.overwrite_existing = True
-
-answer = input('\nWrite each LIF file\'s metadata to XML file? (y/n, default = n):')
-conversion_options.write_xml_metadata = (answer == 'y')
-
-if answer_source == '1':
-    root = tk.Tk()  # pointing root to Tk() to use it as Tk() in program.
-    root.withdraw()  # Hides small tkinter window.
-    root.attributes('-topmost', True)  # Opened windows will be active above all windows in spite of selection.
-    folder_path = filedialog.askdirectory()
-
-    if folder_path != '':
-        files = os.scandir(folder_path)
-
-        num_files_done = 0
-        num_images_done = 0
-
-        for f in files:
-            if f.is_dir():
-                continue
-
-            path_ext = os.path.splitext(f)
-            if path_ext[1] != '.lif':
-                continue
-
-            print(f'\nProcessing file {f.name}')
-            l1 = LifClass(f.path, conversion_options=conversion_options)
-            r = l1.convert()
-            num_files_done += r[0]
-            num_images_done += r[1]
-
-        print(f'\nCompleted conversion of {num_images_done} images in {num_files_done} LIF files in folder\n')
+
+def main():
+
+    print('\nSelect what to convert:')
+    print('1. All .LIF files in one folder (DEFAULT)')
+    print('2. Single .LIF file')
+    print('3. Single image within single .LIF file')
+    answer_source = input('Make selection (default = 1): ')
+    if answer_source == '':
+        answer_source = '1'
+
+    conversion_options = LifClass.Options()
+
+    print('\nSelect format to convert to:')
+    print('1. JPG (90% quality, much smaller files, highly recommended, DEFAULT)')
+    print('2. TIFF (larger files, but compression is lossless. Only use if higher quality is absolutely necessary. Files >4GB are written as BigTIFF')
+    print('3. OME-TIFF (tiled, with lower resolution levels, for viewing huge images in QuPath or napari)')
+    answer = input('Make selection (default = 1): ')
+    if answer == '' or answer == '1':
+        conversion_options.convert_format = LifClass.Options.Format.jpg
+    elif answer == '2':
+        conversion_options.convert_format = LifClass.Options.Format.tiff
+    elif answer == '3':
+        conversion_options.convert_format = LifClass.Options.Format.ome_tiff
+    else:
+        conversion_options.convert_format = LifClass.Options.Format.jpg
+
+    if answer_source == '1':
+        print('\nOverwrite files that already exist?')
+        print('y. Use this if files have changed')
+        print('n. This saves time by skipping files that were already converte earlier (DEFAULT)')
+        answer = input('Make selection (default = n): ')
+        conversion_options.overwrite_existing = (answer == 'y')
     else:
-        print('\nNo folder chosen.\n')
+        # If converting just one file, then always overwrite
+        conversion_options.overwrite_existing = True
+
+    answer = input('\nWrite each LIF file\'s metadata to XML file? (y/n, default = n):')
+    if answer == 'y':
+        # XML file is written in the same pass as the images
+        conversion_options.extra_targets.append(LifClass.Options.Target(LifClass.Options.Format.xml,
+                                                                        conversion_options.color_format,
+                                                                        conversion_options.zstack_format))
+
+    if answer_source == '1':
+        root = tk.Tk()  # pointing root to Tk() to use it as Tk() in program.
+        root.withdraw()  # Hides small tkinter window.
+        root.attributes('-topmost', True)  # Opened windows will be active above all windows in spite of selection.
+        folder_path = filedialog.askdirectory()
+
+        if folder_path != '':
+            files = os.scandir(folder_path)
 
-elif answer_source == '2':
+            file_paths = []
+            for f in files:
+                if f.is_dir():
+                    continue
 
-    l1 = LifClass(conversion_options=conversion_options)
-    l1.convert()
+                path_ext = os.path.splitext(f)
+                if path_ext[1] != '.lif':
+                    continue
 
-elif answer_source == '3':
+                file_paths.append(f.path)
 
-    l1 = LifClass(conversion_options=conversion_options)
-    n = l1.prompt_select_image_from_single_file()
-    l1.convert(n)
+            # Files, or images of files, are converted in parallel by worker processes, see batch.py
+            batch = BatchConverter(conversion_options)
+            batch.convert_files(file_paths)
 
-else:
-    print('No valid option selected. Will not do anything')
+            print(f'\nCompleted conversion of {batch.num_images_converted} images in {batch.num_files_done} LIF files '
+                  f'in folder. Skipped {batch.num_images_skipped} images, '
+                  f'encountered errors in {batch.num_images_error} images/files\n')
+        else:
+            print('\nNo folder chosen.\n')
 
+    elif answer_source == '2':
+
+        l1 = LifClass(conversion_options=conversion_options)
+        l1.open_file(l1.prompt_select_file())
+        l1.convert()
+        l1.close_file()
+
+    elif answer_source == '3':
+
+        l1 = LifClass(conversion_options=conversion_options)
+        l1.open_file(l1.prompt_select_file())
+        n = l1.prompt_select_image_from_single_file()
+        l1.convert(n)
+        l1.close_file()
+
+    else:
+        print('No valid option selected. Will not do anything')
 
 
+# Worker processes of batch.py import this script, so they must not ask for input
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 import os
+import queue
 import tkinter as tk
 from tkinter import ttk, filedialog
 
 from LifClass import LifClass
+from batch import BatchConverter
 from basic_gui import basic_gui, basic_flag
 
 PADDING_PIXELS = 5  # How much padding to put around GUI buttons
@@ -29,9 +31,13 @@ class gui(basic_gui):
         self.format2_string_var = tk.StringVar(self.root, LifClass.Options.ColorOptions.RGB_CMY.name)  # "RGB_CMY")
         # This is set by radio buttons in z-stack format
         self.format3_string_var = tk.StringVar(self.root, LifClass.Options.ZStackOptions.max_project.name)
+        # This is set by radio buttons in tile scan format
+        self.format4_string_var = tk.StringVar(self.root, LifClass.Options.MosaicOptions.stitch.name)
 
         self.conversion_options = LifClass.Options()
         self.file_path = None
+        # Status messages from writing threads, which must not touch Tk widgets. See show_image_messages()
+        self.image_messages = queue.SimpleQueue()
 
     def do_open_output_folder(self):
 
@@ -43,6 +49,7 @@ class gui(basic_gui):
         v1 = self.format1_string_var.get()
         v2 = self.format2_string_var.get()
         v3 = self.format3_string_var.get()
+        v4 = self.format4_string_var.get()
 
         # Determine whether to export jpg, tif, or xml
         self.conversion_options.convert_format = LifClass.Options.Format[v1]
@@ -54,6 +61,33 @@ class gui(basic_gui):
 
         self.conversion_options.zstack_format = LifClass.Options.ZStackOptions[v3]
 
+        self.conversion_options.mosaic_format = LifClass.Options.MosaicOptions[v4]
+
+    def create_lif_object(self):
+
+        lif_object = LifClass(conversion_options=self.conversion_options, root_window=self.root)
+        # Images are written in the background, so report each one when its files are done
+        lif_object.image_callback = self.image_converted
+        return lif_object
+
+    # Called on a writing thread if images are written in the background, so only queues the message
+    def image_converted(self, img_name, error):
+
+        if error is None:
+            self.image_messages.put(f'Converted {self.lif_object.num_images_converted} images, last was "{img_name}"')
+        else:
+            self.image_messages.put(f'Error while writing "{img_name}": {error}')
+
+    # Shows messages queued by image_converted(). Runs on the Tk thread, and reschedules itself
+    def show_image_messages(self):
+
+        text = None
+        while not self.image_messages.empty():
+            text = self.image_messages.get()
+        if text is not None:
+            self.status.set_text(1, text)
+        self.root.after(100, self.show_image_messages)
+
     def get_file_list(self, folder_path):
 
         final_list = []
@@ -98,11 +132,6 @@ class gui(basic_gui):
 
         self.get_options_from_gui()
 
-        num_files_done = 0
-        num_files = len(file_list)
-
-        self.lif_object = LifClass(conversion_options=self.conversion_options, root_window=self.root)
-
         if self.conversion_options.overwrite_existing:
             string1 = "all files"
         else:
@@ -115,29 +144,26 @@ class gui(basic_gui):
 
         print(f'\nProcessing {string1} in folder "{folder_path}"{string2}')
 
+        # Files, or images of files, are converted in parallel by worker processes
+        batch = BatchConverter(self.conversion_options, progress=self.batch_progress, stop_flag=self.stopFlag)
         try:
-            for x in range(num_files):
-
-                if self.stopFlag.check():
-                    raise LifClass.UserCanceled
-
-                f = file_list[x]
-                print(f'\nProcessing file "{f.name}"')
-                self.status.set_text(0, f'({x + 1} of {num_files}) {f.name}')
-                self.status.set_text(1, ("Folder:", os.path.dirname(f.path)))
-
-                self.root.update()
-                self.lif_object.open_file(f.path)
-                self.lif_object.convert()
-                num_files_done += 1
+            batch.convert_files([f.path for f in file_list])
         except LifClass.UserCanceled:
             pass
         except Exception as e:
             print('Unexpected exception ' + str(e))
         else:
-            self.print_results(self.lif_object, num_files_done)
+            self.print_results(batch, batch.num_files_done)
+
+    def batch_progress(self, worker, text):
+
+        if worker is None:
+            self.status.set_text(0, text)
+        else:
+            self.status.set_text(1, (f"Worker {worker}:", text))
 
-    def print_results(self, lo: LifClass, num_files: int = 0):
+    # lo is a LifClass, or a BatchConverter, which has the same counters
+    def print_results(self, lo, num_files: int = 0):
 
         print(f'\nConverted {lo.num_images_converted} images ', end='')
         if num_files > 0:
@@ -146,15 +172,15 @@ class gui(basic_gui):
             print('. ', end='')
         if lo.num_xml_written > 0:
             print(f'Wrote {lo.num_xml_written} XML files. ', end='')
-        print(f'Skipped {self.lif_object.num_images_skipped} images, '
-              f'encountered errors in {self.lif_object.num_images_error} images/files\n')
+        print(f'Skipped {lo.num_images_skipped} images, '
+              f'encountered errors in {lo.num_images_error} images/files\n')
 
     def start_convert_single_image_in_file(self):
 
         self.get_options_from_gui()
         # If converting just one file, then always overwrite
         self.conversion_options.overwrite_existing = True
-        self.lif_object = LifClass(conversion_options=self.conversion_options, root_window=self.root)
+        self.lif_object = self.create_lif_object()
 
         try:
             file_path = self.lif_object.prompt_select_file()
@@ -177,13 +203,15 @@ class gui(basic_gui):
             print("Error during conversion: " + str(e))
         else:
             self.print_results(self.lif_object)
+        finally:
+            self.lif_object.close_file()
 
     def start_convert_file(self):
 
         self.get_options_from_gui()
         # If converting just one file, then always overwrite
         self.conversion_options.overwrite_existing = True
-        self.lif_object = LifClass(conversion_options=self.conversion_options, root_window=self.root)
+        self.lif_object = self.create_lif_object()
 
         try:
             file_path = self.lif_object.prompt_select_file()
@@ -205,11 +233,13 @@ class gui(basic_gui):
             print("Error during conversion: " + str(e))
         else:
             self.print_results(self.lif_object)
+        finally:
+            self.lif_object.close_file()
 
     def start_convert_image(self):
 
         self.get_options_from_gui()
-        self.lif_object = LifClass(conversion_options=self.conversion_options, root_window=self.root)
+        self.lif_object = self.create_lif_object()
         try:
             file_path = self.lif_object.prompt_select_file()
         except LifClass.UserCanceled:
@@ -227,6 +257,8 @@ class gui(basic_gui):
             print("Error during conversion: " + str(e))
         else:
             print(f'\nConverted {self.lif_object.num_images_converted} images')
+        finally:
+            self.lif_object.close_file()
 
     def operation_end(self):
         # Re-enable the "stop conversion" button
@@ -280,6 +312,8 @@ class gui(basic_gui):
         # ****** Output options
         values = [("JPG (smallest files)", LifClass.Options.Format.jpg),
                   ("TIFF (highest quality - best for importing to Illustrator)", LifClass.Options.Format.tiff),
+                  ("OME-TIFF (tiled with lower resolution levels - opens fast in QuPath and napari)",
+                   LifClass.Options.Format.ome_tiff),
                   ("XML (extracts header info only)", LifClass.Options.Format.xml)]
 
         (f, elt) = self.add_boxed_radio_button_column(frame1b, values, backing_var=self.format1_string_var,
@@ -302,6 +336,12 @@ class gui(basic_gui):
 
         # ****** Z-stack options
         values = [("Generate max projection", LifClass.Options.ZStackOptions.max_project),
+                  ("Generate min projection", LifClass.Options.ZStackOptions.min_project),
+                  ("Generate mean projection", LifClass.Options.ZStackOptions.mean_project),
+                  ("Generate sum projection (saturates at maximum brightness)", LifClass.Options.ZStackOptions.sum_project),
+                  ("Generate standard deviation projection", LifClass.Options.ZStackOptions.std_project),
+                  ("Generate depth map (z-plane of brightest pixel)", LifClass.Options.ZStackOptions.depth_map),
+                  ("Generate max projection color-coded by depth", LifClass.Options.ZStackOptions.depth_coded),
                   ("Generate separate image for each z-stack layer", LifClass.Options.ZStackOptions.separate)]
 
         (f, elt) = self.add_boxed_radio_button_column(frame1b, values, backing_var=self.format3_string_var,
@@ -309,6 +349,17 @@ class gui(basic_gui):
                                                       padx=15, pady=8,
                                                       text="How to handle z-stacks?")
 
+        # ****** Tile scan options
+        values = [("Stitch tiles into single image", LifClass.Options.MosaicOptions.stitch),
+                  ("Export each tile separately, with CSV file of tile positions",
+                   LifClass.Options.MosaicOptions.separate_tiles),
+                  ("Skip tile scans", LifClass.Options.MosaicOptions.skip)]
+
+        (f, elt) = self.add_boxed_radio_button_column(frame1b, values, backing_var=self.format4_string_var,
+                                                      side=tk.TOP, fill=tk.X,
+                                                      padx=15, pady=8,
+                                                      text="How to handle tile scans?")
+
         # ****** File convert options
         values = [("Skip already converted files (recommended)", "skip"),
                   ("Convert all (overwrites old output)", "all")]
@@ -357,12 +408,17 @@ class gui(basic_gui):
 
         self.root.minsize(self.root.winfo_width(), self.root.winfo_height())
 
+        # Conversion calls root.update() regularly, see basic_flag.check(), so messages are also shown while it runs
+        self.show_image_messages()
+
         super().run_gui()
 
         print("Finished")
 
 
-print('Creating GUI object')
-obj = gui()
-print('Launching GUI')
-obj.run_gui()
+# Worker processes of batch.py import this script, so they must not start the GUI
+if __name__ == '__main__':
+    print('Creating GUI object')
+    obj = gui()
+    print('Launching GUI')
+    obj.run_gui()
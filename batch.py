@@ -0,0 +1,492 @@
+"""
+Converts many LIF files at once, on a pool of worker processes.
+
+Reading, rescaling and compositing mostly run one CPU at a time, so a folder converted file after
+file leaves the other CPUs idle. BatchConverter splits a folder into jobs of one file, or of one
+image within a file, and runs them in separate processes. Each job opens its own LifFile, so only
+options, counters and progress messages pass between processes.
+
+Several huge images converted at once could run out of memory, so the peak memory of each job is
+estimated beforehand from the dimensions and bit depth in the image list, see
+LifClass.estimate_memory(). Jobs are only started while the estimates of all running jobs add up to
+less than Options.batch_memory. A job that needs more than that on its own runs alone, with TIFF
+files written in strips.
+
+Jobs are ordered by their estimated cost, see image_cost(), biggest first, and files that are more
+than a fair share of the work of all workers are split into a job per image, so that a big file at
+the end of a folder doesn't keep one worker busy long after the others have finished.
+
+Worker processes are started with "spawn" on every platform, as they are on Windows, so they
+begin by importing the main script. Scripts that use BatchConverter must therefore only start
+their GUI or console under if __name__ == '__main__', see LifConverterGUI.py.
+"""
+import io
+import os
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import redirect_stdout
+
+from basic_gui import basic_flag
+from LifClass import LifClass
+from reader import LifFile
+
+# Counters of LifClass that are added up over all jobs
+COUNTERS = ("num_images_converted", "num_images_skipped", "num_images_error", "num_xml_written")
+
+# Memory of a worker process before it converts anything: Python, numpy and OpenCV
+PROCESS_MEMORY = 100 * 1024 ** 2
+
+# Smallest memory_budget given to jobs that have to fit within less memory, see BatchConverter.low_memory_settings()
+MIN_JOB_BUDGET = 64 * 1024 ** 2
+
+# Cost of each raw sample (pixel of one channel and z plane), for rescaling and projection, and of each output
+# pixel, for compositing and encoding, in bytes read from disk that take the same time. See image_cost().
+SAMPLE_COST = 1
+OUTPUT_PIXEL_COST = 16
+
+# Set in each worker process by _init_worker()
+_messages = None
+_stop_event = None
+
+
+class EventFlag:
+    """
+    Stop flag of a worker process, which works like basic_flag, but is set from the parent process.
+
+    Args:
+        event (multiprocessing.Event): shared with the parent process
+    """
+
+    def __init__(self, event):
+        self.event = event
+
+    def set(self):
+        self.event.set()
+
+    def check(self):
+        return self.event.is_set()
+
+
+class Job:
+    """
+    One file, or one image within a file, to be converted by run_job().
+
+    Args:
+        path (str): LIF file
+        image (int): image number, or None for all images of the file
+        write_xml (bool): write the XML file of the LIF file, if selected. Only the first job of each file does.
+        memory (int): estimated peak memory of the worker process in bytes, see LifClass.estimate_memory()
+        settings (dict): options that are changed for this job only, see BatchConverter.low_memory_settings()
+        cost (float): estimated time to convert, see image_cost()
+    """
+
+    def __init__(self, path, image=None, write_xml=True, memory=0, settings=None, cost=0):
+        self.path = path
+        self.image = image
+        self.write_xml = write_xml
+        self.memory = memory
+        self.settings = settings or {}
+        self.cost = cost
+
+    def __repr__(self):
+        return f"Job({self.path!r}, image={self.image}, memory={self.memory}, cost={self.cost})"
+
+
+def image_cost(img, n_targets=1):
+    """
+    Returns estimated time to convert an image, in bytes read from disk that take the same time.
+
+    Reading the memory block of the image (LifFile.offsets) usually takes longest, so that is the base.
+    Every raw sample of every z plane is then rescaled or projected, and every output pixel is
+    composited and encoded, once for each target.
+
+    Args:
+        img (LifImage): image, from LifFile.get_image()
+        n_targets (int): number of output targets, see LifClass.Options.targets()
+    """
+    dims = img.dims
+    samples = dims.x * dims.y * dims.z * img.channels * dims.m
+    # Only the first time point is converted
+    read_bytes = img.offsets[1] / max(1, dims.t)
+    return read_bytes + SAMPLE_COST * samples + OUTPUT_PIXEL_COST * dims.x * dims.y * dims.m * n_targets
+
+
+def physical_memory():
+    """Returns bytes of physical memory, or None if unknown."""
+    if hasattr(os, "sysconf"):
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (ValueError, OSError):
+            return None
+    if os.name == "nt":
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                        ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                        ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                        ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                        ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(status)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+    return None
+
+
+def options_state(options):
+    """
+    Returns dict of the settings of LifClass.Options, for sending to worker processes.
+    This includes class attributes, which are not pickled with the object.
+    """
+    state = {}
+    for name in dir(options):
+        if name.startswith("_"):
+            continue
+        value = getattr(options, name)
+        # Skip methods and nested classes
+        if not callable(value):
+            state[name] = value
+    return state
+
+
+def make_options(state):
+    """Returns LifClass.Options with the settings from options_state()."""
+    options = LifClass.Options()
+    for name, value in state.items():
+        setattr(options, name, value)
+    return options
+
+
+def run_job(job, state, report=None, stop_flag=None):
+    """
+    Converts one file, or one image within a file.
+
+    Args:
+        job (Job): what to convert
+        state (dict): conversion options, from options_state()
+        report (function): report(text) is called with progress messages
+        stop_flag: basic_flag or EventFlag that stops conversion
+
+    Returns:
+        dict of COUNTERS, and "canceled", which is True if the stop flag was set
+    """
+    name = os.path.basename(job.path)
+
+    lif = LifClass(conversion_options=make_options(dict(state, **job.settings)))
+    if stop_flag is not None:
+        lif.stopFlag = stop_flag
+    if report is not None:
+        def image_done(img_name, error):
+            if error is None:
+                report(f'{name}: converted "{img_name}"')
+            else:
+                report(f'{name}: error while writing "{img_name}": {error}')
+        lif.image_callback = image_done
+        report(name if job.image is None else f'{name}, image {job.image + 1}')
+
+    if job.image is None:
+        print(f'\nProcessing file "{name}"')
+    else:
+        print(f'\nProcessing image {job.image + 1} of file "{name}"')
+    canceled = False
+    try:
+        lif.open_file(job.path)
+        lif.convert(-1 if job.image is None else job.image, write_xml=job.write_xml)
+    except LifClass.UserCanceled:
+        print('  Conversion canceled')
+        canceled = True
+    except Exception as e:
+        print(f'  Error while converting "{name}": {e}')
+        lif.num_images_error += 1
+    finally:
+        lif.close_file()
+
+    result = {counter: getattr(lif, counter) for counter in COUNTERS}
+    result["canceled"] = canceled
+    return result
+
+
+def _init_worker(messages, stop_event):
+    """Runs at the start of each worker process (private)."""
+    global _messages, _stop_event
+    _messages = messages
+    _stop_event = stop_event
+
+
+def _process_job(job, state):
+    """
+    Runs job in a worker process (private). Printed output is returned instead, so that
+    the output of jobs running at the same time isn't mixed together.
+    """
+    pid = os.getpid()
+    log = io.StringIO()
+    with redirect_stdout(log):
+        result = run_job(job, state, lambda text: _messages.put((pid, text)), EventFlag(_stop_event))
+    result["log"] = log.getvalue()
+    return result
+
+
+class BatchConverter:
+    """
+    Converts a list of LIF files on a pool of worker processes, and adds up their counters.
+
+    Example:
+        batch = BatchConverter(conversion_options, progress=report)
+        batch.convert_files(file_paths)
+        print(batch.num_images_converted)
+
+    Args:
+        conversion_options (LifClass.Options): options for all files
+        workers (int): worker processes. None uses Options.batch_workers. 1 converts files in turn, in
+            this process.
+        split_images (bool): run each image of a file as a separate job. None splits files that are more
+            than a fair share of the work of all workers, see plan_jobs().
+        progress (function): progress(worker, text) is called with messages from each worker, numbered
+            from 1, and with worker None for the overall progress. Called on the thread of convert_files().
+        stop_flag (basic_flag): checked while waiting, stops conversion when set
+    """
+
+    # Cumulative over calls to convert_files(), like the counters of LifClass
+    num_images_converted = 0
+    num_images_skipped = 0
+    num_images_error = 0
+    num_xml_written = 0
+    num_files_done = 0
+
+    def __init__(self, conversion_options, workers=None, split_images=None, progress=None, stop_flag=None):
+        self.conversion_options = conversion_options
+        if workers is None:
+            workers = conversion_options.batch_workers or os.cpu_count() or 1
+        self.workers = workers
+        self.split_images = split_images
+        self.progress = progress
+        self.stop_flag = stop_flag if stop_flag is not None else basic_flag()
+        self._worker_numbers = {}
+
+    def memory_limit(self):
+        """Returns bytes that running jobs may use together, see Options.batch_memory."""
+        limit = self.conversion_options.batch_memory
+        if limit is None:
+            total = physical_memory()
+            if total:
+                # Leave some for the OS, the GUI and the page cache
+                limit = total * 3 // 4
+            else:
+                limit = self.workers * (PROCESS_MEMORY + self.conversion_options.memory_budget)
+        return limit
+
+    def low_memory_settings(self, limit):
+        """
+        Returns options for jobs that need more than limit bytes with the normal options. TIFF files
+        are written in strips, within what is left after the process itself, and whole images are
+        written one at a time. JPG and OME-TIFF images already need less, so they are converted as before.
+        """
+        budget = min(self.conversion_options.memory_budget, limit - PROCESS_MEMORY)
+        return {"stream_tiff": True, "write_workers": 0, "tile_workers": 1,
+                "memory_budget": max(MIN_JOB_BUDGET, budget)}
+
+    def plan_jobs(self, file_paths, state=None, limit=None):
+        """
+        Returns list of Job, in the order they should be started, with their estimated peak memory and cost.
+
+        A file is split into a job per image if split_images is True, or if it is None and the file is more
+        than a fair share of the work of all workers. With more than one worker, jobs are ordered longest
+        first (LPT): each worker that becomes free takes the biggest job left, so big jobs start early, and
+        small ones fill the gaps at the end. Images that are already converted, or will be skipped, cost
+        nothing.
+
+        Args:
+            file_paths (list): paths of LIF files
+            state (dict): conversion options of the workers, from options_state(). None uses conversion_options.
+            limit (int): jobs that need more than this many bytes get low_memory_settings(). None uses
+                memory_limit().
+        """
+        if state is None:
+            state = options_state(self.conversion_options)
+        if limit is None:
+            limit = self.memory_limit()
+
+        low_settings = self.low_memory_settings(limit)
+        estimator = LifClass(conversion_options=make_options(state))
+        low_estimator = LifClass(conversion_options=make_options(dict(state, **low_settings)))
+        n_targets = len(estimator.image_targets())
+
+        # (memory, memory with low_settings, cost) of each image of each file, or None if it can't be read
+        files = []
+        for path in file_paths:
+            estimator.file_path = low_estimator.file_path = path
+            try:
+                estimator.lif_modified_time = os.path.getmtime(path)
+                # Also fills the index cache, so that workers don't each scan the file
+                with LifFile(path, use_cache=self.conversion_options.use_index_cache,
+                             lazy_xml=self.conversion_options.lazy_xml) as lif:
+                    images = []
+                    for img in lif.get_iter_image():
+                        memory = estimator.estimate_memory(img)
+                        tiles = img.dims.m > 1 and not estimator.is_stitched(img)
+                        if memory == 0 or estimator.is_converted(img, tiles):
+                            # Skipped
+                            images.append((PROCESS_MEMORY, PROCESS_MEMORY, 0))
+                        else:
+                            images.append((PROCESS_MEMORY + memory, PROCESS_MEMORY + low_estimator.estimate_memory(img),
+                                           image_cost(img, n_targets)))
+            except Exception:
+                # Let the worker report the error
+                images = None
+            files.append((path, images))
+
+        # Work each worker would do if it was shared out evenly
+        share = sum(cost for path, images in files for memory, low_memory, cost in images or []) / self.workers
+
+        jobs = []
+        for path, images in files:
+            if not images:
+                jobs.append(Job(path, memory=PROCESS_MEMORY))
+                continue
+
+            split = self.split_images
+            if split is None:
+                split = self.workers > 1 and len(images) > 1 and sum(cost for _, _, cost in images) > share
+            if split:
+                # XML file is written by the first job of each file
+                file_jobs = [(Job(path, n, n == 0, memory, cost=cost), low_memory)
+                             for n, (memory, low_memory, cost) in enumerate(images)]
+            else:
+                # Images of a file are converted one after another, so the biggest one counts
+                memory, low_memory, costs = zip(*images)
+                file_jobs = [(Job(path, memory=max(memory), cost=sum(costs)), max(low_memory))]
+
+            for job, low_memory in file_jobs:
+                if job.memory > limit:
+                    name = os.path.basename(path)
+                    label = name if job.image is None else f'image {job.image + 1} of "{name}"'
+                    print(f'  {label} needs about {job.memory / 1024 ** 3:.1f} GB, more than the limit of '
+                          f'{limit / 1024 ** 3:.1f} GB for all workers, so it will be converted on its own, '
+                          f'with TIFF files written in strips')
+                    job.memory = low_memory
+                    job.settings = low_settings
+                jobs.append(job)
+
+        if self.workers > 1:
+            # Longest processing time first. Sorting is stable, so equal jobs stay in order.
+            jobs.sort(key=lambda job: job.cost, reverse=True)
+        return jobs
+
+    def convert_files(self, file_paths):
+        """
+        Converts files, and adds their results to the counters.
+
+        Args:
+            file_paths (list): paths of LIF files
+        """
+        file_paths = [os.fspath(path) for path in file_paths]
+        state = options_state(self.conversion_options)
+        if self.workers > 1 and state.get("tile_workers") is None:
+            # Share CPUs between the tile threads of all workers
+            state["tile_workers"] = max(1, (os.cpu_count() or 1) // self.workers)
+        limit = self.memory_limit()
+
+        jobs = self.plan_jobs(file_paths, state, limit)
+        # Jobs left for each file, which is done when they all are
+        self._jobs_left = {}
+        for job in jobs:
+            self._jobs_left[job.path] = self._jobs_left.get(job.path, 0) + 1
+        self._num_files = len(self._jobs_left)
+        self._files_finished = 0
+
+        workers = min(self.workers, len(jobs))
+        if workers <= 1:
+            self._convert_in_turn(jobs, state)
+        else:
+            self._convert_parallel(jobs, state, workers, limit)
+
+    def _convert_in_turn(self, jobs, state):
+        """Runs jobs one after another in this process (private)."""
+        for job in jobs:
+            if self.stop_flag.check():
+                raise LifClass.UserCanceled
+            result = run_job(job, state, lambda text: self._message(0, text), self.stop_flag)
+            self._job_done(job, result)
+            if result["canceled"]:
+                raise LifClass.UserCanceled
+
+    def _convert_parallel(self, jobs, state, workers, limit):
+        """
+        Runs jobs on a pool of worker processes (private). Jobs are started in order while their estimated
+        memory fits within limit. A job that doesn't fit waits for running jobs to finish, while smaller jobs
+        after it may still start. A job that needs more than limit on its own runs alone.
+        """
+        context = multiprocessing.get_context("spawn")
+        messages = context.Queue()
+        stop_event = context.Event()
+        print(f'\nConverting {len(jobs)} jobs with {workers} worker processes, '
+              f'within {limit / 1024 ** 3:.1f} GB of memory')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(messages, stop_event)) as executor:
+            queued = list(jobs)
+            running = {}
+            used = 0
+            try:
+                while queued or running:
+                    for job in list(queued):
+                        if len(running) >= workers:
+                            break
+                        if running and used + job.memory > limit:
+                            continue
+                        queued.remove(job)
+                        running[executor.submit(_process_job, job, state)] = job
+                        used += job.memory
+
+                    done, _ = wait(running, timeout=0.2, return_when=FIRST_COMPLETED)
+                    self._read_messages(messages)
+                    for future in done:
+                        job = running.pop(future)
+                        used -= job.memory
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            # Worker process died, e.g. ran out of memory
+                            print(f'\nError while converting "{os.path.basename(job.path)}": {e!r}')
+                            result = {"num_images_error": 1}
+                        print(result.pop("log", ""), end="")
+                        self._job_done(job, result)
+                    if self.stop_flag.check():
+                        raise LifClass.UserCanceled
+            except BaseException:
+                # Canceled. Running jobs stop at their next check of the stop flag, and the pool waits for them.
+                stop_event.set()
+                for future in running:
+                    future.cancel()
+                raise
+            finally:
+                self._read_messages(messages)
+
+    def _read_messages(self, messages):
+        """Passes progress messages from workers to the progress callback (private)."""
+        while True:
+            try:
+                pid, text = messages.get_nowait()
+            except queue.Empty:
+                return
+            self._message(pid, text)
+
+    def _message(self, worker_id, text):
+        """Reports a message from a worker, numbering workers in the order they are first heard from (private)."""
+        number = self._worker_numbers.setdefault(worker_id, len(self._worker_numbers) + 1)
+        if self.progress is not None:
+            self.progress(number, text)
+
+    def _job_done(self, job, result):
+        """Adds results of a job to the counters (private)."""
+        for counter in COUNTERS:
+            setattr(self, counter, getattr(self, counter) + result.get(counter, 0))
+        self._jobs_left[job.path] -= 1
+        if self._jobs_left[job.path] == 0:
+            self._files_finished += 1
+            self.num_files_done += 1
+        if self.progress is not None:
+            self.progress(None, f'({self._files_finished} of {self._num_files} files) '
+                                f'{os.path.basename(job.path)}')
@@ -0,0 +1,461 @@
+"""
+Benchmarks for reading and converting LIF files, using synthetic LIF files so that
+no microscope data is needed. Run all benchmarks with:
+
+    python benchmark.py
+
+or a subset by name, e.g.
+
+    python benchmark.py block_scan
+"""
+import io
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import reader
+import rescale
+from reader import LIF_MAGIC, _check_mem, _read_int, _read_long, _get_len
+
+
+def _image_xml(name, x, y, z, c, bit_depth, memory_size, settings_elements=0):
+    """
+    Returns XML element describing one image, with enough detail for LifFile to parse it.
+    settings_elements adds that many elements to the confocal settings, to make the header bigger.
+    """
+    bytes_per_pixel = 1 if bit_depth == 8 else 2
+    plane_bytes = x * y * bytes_per_pixel
+    luts = ["Red", "Green", "Blue", "Gray"]
+
+    channels = "".join(
+        f'<ChannelDescription DataType="0" Resolution="{bit_depth}" LUTName="{luts[k % len(luts)]}" '
+        f'BytesInc="{k * plane_bytes}"/>'
+        for k in range(c)
+    )
+    dims = (f'<DimensionDescription DimID="1" NumberOfElements="{x}" Length="{(x - 1) * 1e-6}" '
+            f'BytesInc="{bytes_per_pixel}"/>'
+            f'<DimensionDescription DimID="2" NumberOfElements="{y}" Length="{(y - 1) * 1e-6}" '
+            f'BytesInc="{x * bytes_per_pixel}"/>')
+    if z > 1:
+        dims += (f'<DimensionDescription DimID="3" NumberOfElements="{z}" Length="{z * 1e-6}" '
+                 f'BytesInc="{plane_bytes * c}"/>')
+    scaling = "".join('<ChannelScalingInfo WhiteValue="0.8" BlackValue="0.1"/>' for _ in range(c))
+    settings = "".join(
+        f'<DetectorSetting Index="{k}" Gain="{k * 0.5}" Offset="0" Name="Detector {k}" Active="1"/>'
+        for k in range(settings_elements)
+    )
+
+    return (f'<Element Name="{name}"><Data><Image><ImageDescription><Channels>{channels}</Channels>'
+            f'<Dimensions>{dims}</Dimensions></ImageDescription>'
+            f'<Attachment Name="ATLConfocalSettingDefinition"><ATLConfocalSettingDefinition Magnification="20">'
+            f'{settings}</ATLConfocalSettingDefinition></Attachment>'
+            f'<TimeStampList NumberOfTimeStamps="{z * c}">{" ".join("1d8f3e2a5b4c000" for _ in range(z * c))}'
+            f'</TimeStampList>'
+            f'<Attachment Name="ChannelScalingInfo">{scaling}</Attachment></Image></Data>'
+            f'<Memory Size="{memory_size}" MemoryBlockID="MemBlock_{name}"/><Children/></Element>')
+
+
+def write_synthetic_lif(path, n_images=1, x=256, y=256, z=1, c=1, bit_depth=8, seed=0, settings_elements=0):
+    """
+    Writes a LIF file with n_images identically shaped images of random pixels.
+
+    Returns:
+        Number of bytes written
+    """
+    bytes_per_pixel = 1 if bit_depth == 8 else 2
+    image_bytes = x * y * z * c * bytes_per_pixel
+    rng = np.random.default_rng(seed)
+
+    xml = ('<LMSDataContainerHeader Version="2"><Element Name="synthetic"><Data><Experiment/></Data>'
+           '<Memory Size="0" MemoryBlockID="MemBlock_0"/><Children>'
+           + "".join(_image_xml(f"image{n}", x, y, z, c, bit_depth, image_bytes, settings_elements)
+                     for n in range(n_images))
+           + '</Children></Element></LMSDataContainerHeader>')
+    xml_bytes = xml.encode("utf-16-le")
+
+    with open(path, "wb") as f:
+        f.write(LIF_MAGIC + struct.pack("<I", len(xml_bytes) + 5) + b"\x2a" + struct.pack("<I", len(xml)))
+        f.write(xml_bytes)
+        for n in range(n_images):
+            description = f"MemBlock_image{n}".encode("utf-16-le")
+            f.write(LIF_MAGIC + struct.pack("<I", 0) + b"\x2a" + struct.pack("<Q", image_bytes) + b"\x2a"
+                    + struct.pack("<I", len(description) // 2) + description)
+            if bit_depth == 8:
+                f.write(rng.integers(0, 256, image_bytes, dtype=np.uint8).tobytes())
+            else:
+                f.write(rng.integers(0, 1 << bit_depth, image_bytes // 2, dtype=np.uint16).astype("<u2").tobytes())
+        return f.tell()
+
+
+class _CountingFile(io.FileIO):
+    """Unbuffered file that counts read() and seek() calls, i.e. actual system calls."""
+
+    num_reads = 0
+    num_seeks = 0
+
+    def read(self, *args):
+        self.num_reads += 1
+        return super().read(*args)
+
+    def readinto(self, *args):
+        self.num_reads += 1
+        return super().readinto(*args)
+
+    def seek(self, *args):
+        self.num_seeks += 1
+        return super().seek(*args)
+
+
+def _legacy_scan_memory_blocks(f, f_len):
+    """The memory block loop from LifFile.__init__ before it was replaced by reader._scan_memory_blocks()."""
+    offsets = []
+    while f.tell() < f_len:
+        check = f.read(4)
+        if check != LIF_MAGIC:
+            if check == b"\x00\x00\x00\x00" and len(offsets) > 0:
+                break
+            else:
+                raise ValueError(f"Invalid memory block at {f.tell()}")
+
+        f.seek(4, 1)
+        _check_mem(f)
+        block_len = _read_int(f)
+        if not _check_mem(f, True):
+            f.seek(-5, 1)
+            block_len = _read_long(f)
+            _check_mem(f)
+
+        description_len = _read_int(f) * 2
+
+        if block_len > 0:
+            offsets.append((f.tell() + description_len, block_len))
+
+        f.seek(description_len + block_len, 1)
+    return offsets
+
+
+def _header_end(f):
+    """Returns position of first memory block, i.e. just after the XML header."""
+    f.seek(9)
+    header_len = _read_int(f)
+    return 13 + header_len * 2
+
+
+def bench_block_scan(n_blocks=10000):
+    """Compares the old per-field memory block loop with the buffered scanner, on a file with n_blocks blocks."""
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "blocks.lif")
+        write_synthetic_lif(path, n_images=n_blocks, x=16, y=16)
+
+        results = {}
+        for name in ["legacy loop", "scanner (mmap)", "scanner (windowed reads)"]:
+            with _CountingFile(path) as f:
+                f_len = _get_len(f)
+                start_pos = _header_end(f)
+                f.num_reads = f.num_seeks = 0
+                f.seek(start_pos)
+
+                start = time.perf_counter()
+                if name == "legacy loop":
+                    offsets = _legacy_scan_memory_blocks(f, f_len)
+                else:
+                    offsets, _ = reader._scan_memory_blocks(f, start_pos, f_len, use_mmap=(name == "scanner (mmap)"))
+                elapsed = time.perf_counter() - start
+
+            results[name] = offsets
+            print(f'  {name:26s} {elapsed * 1000:8.1f} ms, {f.num_reads:6d} reads, {f.num_seeks:6d} seeks')
+
+        assert all(offsets == results["legacy loop"] for offsets in results.values()), "Offsets differ"
+        assert len(results["legacy loop"]) == n_blocks
+
+
+def bench_xml_parse(n_images=100, settings_elements=2000):
+    """Compares parse time and peak memory of LifFile with and without lazy_xml, on a file with a large XML header."""
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "header.lif")
+        write_synthetic_lif(path, n_images=n_images, x=16, y=16, settings_elements=settings_elements)
+        with open(path, "rb") as f:
+            header_bytes = _header_end(f) - 13
+        print(f'  XML header is {header_bytes / 1e6:.1f} MB')
+
+        image_lists = []
+        for lazy_xml in [False, True]:
+            # Time and memory are measured in separate runs, because tracemalloc slows everything down
+            start = time.perf_counter()
+            with reader.LifFile(path, use_cache=False, lazy_xml=lazy_xml):
+                elapsed = time.perf_counter() - start
+
+            tracemalloc.start()
+            with reader.LifFile(path, use_cache=False, lazy_xml=lazy_xml) as lif:
+                _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            image_lists.append(lif.image_list)
+            print(f'  lazy_xml={str(lazy_xml):5s} {elapsed * 1000:8.1f} ms, peak memory {peak / 1e6:7.1f} MB')
+
+        # Lazy mode leaves out settings, everything else must match
+        assert [{k: v for k, v in d.items() if k != "settings"} for d in image_lists[0]] == image_lists[1]
+
+
+def bench_reslice(x=512, y=512, z=64, c=2):
+    """Times an orthogonal XZ reslice of a 16-bit z-stack with get_plane_array(), one plane per row."""
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "stack.lif")
+        write_synthetic_lif(path, x=x, y=y, z=z, c=c, bit_depth=16)
+
+        with reader.LifFile(path, use_cache=False) as lif:
+            img = lif.get_image(0)
+            start = time.perf_counter()
+            reslice = np.stack([img.get_plane_array((1, 3), c=1, requested_dims={2: row}) for row in range(y)])
+            elapsed = time.perf_counter() - start
+
+            assert np.array_equal(reslice[:, 5, :], img.get_frame_array(z=5, c=1))
+        print(f'  {y} XZ planes of {x} x {z} pixels in {elapsed * 1000:8.1f} ms')
+
+
+def _legacy_rescale(ar, black_value, white_value, max_val, pixel_type, chunk_v=32):
+    """The float rescaling loop from LifClass.convert_image() before it was replaced by rescale.apply_lut()."""
+    rescaled = np.empty(ar.shape, dtype=pixel_type)
+    scale = 1.0 / (white_value - black_value)
+    offset1 = round(black_value * max_val)
+    row = 0
+    while row < ar.shape[0]:
+        one_row = ar[row:row + chunk_v, ].astype(float)
+        one_row = (one_row - offset1) * scale
+        one_row[one_row < 0] = 0
+        one_row[one_row > max_val] = max_val
+        rescaled[row:row + chunk_v, ] = one_row.astype(pixel_type)
+        row += chunk_v
+    return rescaled
+
+
+def bench_rescale(size=4096):
+    """Compares throughput of the float rescaling loop and the lookup table, on a size x size frame."""
+    rng = np.random.default_rng(0)
+    for pixel_type, max_val, high in [(np.uint8, 255, 256), (np.uint16, 65535, 65536), (np.uint16, 65535, 4096)]:
+        ar = rng.integers(0, high, (size, size)).astype(pixel_type)
+        for black_value, white_value in [(0.0, 1.0), (0.1, 0.8), (0.013, 0.0625)]:
+            start = time.perf_counter()
+            expected = _legacy_rescale(ar, black_value, white_value, max_val, pixel_type)
+            legacy_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            lut = rescale.get_lut(black_value, white_value, max_val, pixel_type)
+            out = rescale.apply_lut(ar, lut, out=np.empty_like(ar))
+            lut_time = time.perf_counter() - start
+
+            assert np.array_equal(out, expected), "Rescaled pixels differ"
+            megapixels = ar.size / 1e6
+            print(f'  {np.dtype(pixel_type).name:6s} values < {high:5d}, black {black_value:5.3f} white '
+                  f'{white_value:6.4f}: float {megapixels / legacy_time:7.1f} MP/s, '
+                  f'table {megapixels / lut_time:7.1f} MP/s')
+
+
+_RSS_SCRIPT = """
+import contextlib, io, sys
+from LifClass import LifClass
+options = LifClass.Options()
+# Several formats, e.g. "jpg+tiff", are written in a single pass
+formats = [LifClass.Options.Format[name] for name in sys.argv[2].split("+")]
+options.convert_format = formats[0]
+options.extra_targets = [LifClass.Options.Target(f, options.color_format, options.zstack_format) for f in formats[1:]]
+if len(sys.argv) > 3:
+    options.stream_tiff = True
+    options.memory_budget = int(sys.argv[3])
+lif = LifClass(conversion_options=options)
+with contextlib.redirect_stdout(io.StringIO()):
+    lif.open_file(sys.argv[1])
+    lif.convert()
+# Peak RSS of this process. Unlike ru_maxrss, VmHWM doesn't include memory of the parent before exec.
+with open("/proc/self/status") as f:
+    print([line.split()[1] for line in f if line.startswith("VmHWM:")][0])
+"""
+
+
+def bench_convert_rss(size=6000, c=3, stream_budget=64 * 1024 ** 2):
+    """
+    Peak resident memory of converting a size x size image with c channels, in a fresh process each time (Linux).
+    "tiff strips" is TIFF written in strips within a memory budget of stream_budget bytes. "jpg + tiff" writes
+    both formats in a single pass, which can be compared with the sum of the first two. Pages of the
+    LIF file that have been read are counted too, although the OS can reclaim them.
+    """
+    import subprocess
+
+    with tempfile.TemporaryDirectory() as folder:
+        for bit_depth in [8, 16]:
+            path = os.path.join(folder, f"convert{bit_depth}.lif")
+            write_synthetic_lif(path, x=size, y=size, c=c, bit_depth=bit_depth)
+            for label, args in [("tiff", ["tiff"]), ("jpg", ["jpg"]), ("tiff strips", ["tiff", str(stream_budget)]),
+                                ("jpg + tiff", ["jpg+tiff"])]:
+                start = time.perf_counter()
+                result = subprocess.run([sys.executable, "-c", _RSS_SCRIPT, path] + args,
+                                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        env=dict(os.environ, XDG_CACHE_HOME=folder),
+                                        capture_output=True, text=True, check=True)
+                elapsed = time.perf_counter() - start
+                # VmHWM is in kilobytes
+                peak = int(result.stdout.split()[-1]) / 1024
+                print(f'  {bit_depth:2d}-bit to {label:11s}: peak RSS {peak:7.1f} MB, {elapsed:5.1f} s')
+
+
+def bench_memory_estimate(size=4000, c=3):
+    """
+    Estimated peak memory of converting a file of size x size images (LifClass.estimate_memory(), plus
+    batch.PROCESS_MEMORY), against the peak resident memory measured in a fresh process (Linux). Measured
+    memory includes pages of the LIF file that have been read, which the estimate leaves out.
+    """
+    import contextlib
+    import subprocess
+    from LifClass import LifClass
+    from batch import PROCESS_MEMORY
+
+    with tempfile.TemporaryDirectory() as folder:
+        for bit_depth, z in [(8, 1), (16, 1), (16, 8)]:
+            path = os.path.join(folder, f"estimate{bit_depth}_{z}.lif")
+            # Several images, so that the write pool fills up
+            write_synthetic_lif(path, n_images=3, x=size, y=size, z=z, c=c, bit_depth=bit_depth)
+            for convert_format in ["jpg", "tiff"]:
+                options = LifClass.Options()
+                options.convert_format = LifClass.Options.Format[convert_format]
+                lif = LifClass(conversion_options=options)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    lif.open_file(path)
+                images = lif.lif_file_object.get_iter_image()
+                estimate = PROCESS_MEMORY + max(lif.estimate_memory(img) for img in images)
+                lif.close_file()
+
+                result = subprocess.run([sys.executable, "-c", _RSS_SCRIPT, path, convert_format],
+                                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        env=dict(os.environ, XDG_CACHE_HOME=folder),
+                                        capture_output=True, text=True, check=True)
+                # VmHWM is in kilobytes
+                peak = int(result.stdout.split()[-1]) / 1024
+                print(f'  {bit_depth:2d}-bit, z = {z} to {convert_format:4s}: estimate {estimate / 1024 ** 2:7.1f} MB, '
+                      f'peak RSS {peak:7.1f} MB')
+
+
+def bench_write_pool(n_images=8, size=3000, c=3):
+    """
+    Converting a file of n_images size x size images, with whole images written on the conversion
+    thread (write_workers = 0) and in the background while the next image is read (see write_pool.py).
+    Gains need more than one CPU.
+    """
+    import contextlib
+    from LifClass import LifClass
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "write_pool.lif")
+        write_synthetic_lif(path, n_images=n_images, x=size, y=size, c=c, bit_depth=16)
+        for convert_format in [LifClass.Options.Format.jpg, LifClass.Options.Format.tiff]:
+            for workers in [0, 2, 4]:
+                options = LifClass.Options()
+                options.convert_format = convert_format
+                options.write_workers = workers
+                options.use_index_cache = False
+                lif = LifClass(conversion_options=options)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    lif.open_file(path)
+                    lif.convert()
+                    lif.close_file()
+                elapsed = time.perf_counter() - start
+                assert lif.num_images_converted == n_images, "Not all images were converted"
+                print(f'  {convert_format.name:4s} with {workers} write workers: {elapsed:5.2f} s, '
+                      f'{n_images / elapsed:5.1f} images/s ({os.cpu_count()} CPUs)')
+
+
+def bench_batch(n_files=6, n_images=4, size=2000, c=3):
+    """
+    Converting a folder of n_files files, each of n_images size x size images, file after file in this
+    process, and on worker processes (see batch.py), by file and by image. Gains need more than one CPU.
+    """
+    import contextlib
+    from LifClass import LifClass
+    from batch import BatchConverter
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for k in range(n_files):
+            paths.append(os.path.join(folder, f"batch{k}.lif"))
+            write_synthetic_lif(paths[-1], n_images=n_images, x=size, y=size, c=c, bit_depth=16, seed=k)
+        for workers, split_images in [(1, False), (2, False), (4, False), (4, True)]:
+            options = LifClass.Options()
+            options.use_index_cache = False
+            batch = BatchConverter(options, workers=workers, split_images=split_images)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                batch.convert_files(paths)
+            elapsed = time.perf_counter() - start
+            assert batch.num_images_converted == n_files * n_images, "Not all images were converted"
+            jobs = "images" if split_images else "files"
+            print(f'  {workers} workers, jobs of {jobs:6s}: {elapsed:5.2f} s, '
+                  f'{n_files * n_images / elapsed:5.1f} images/s ({os.cpu_count()} CPUs)')
+
+
+def _makespan(costs, workers):
+    """Returns time at which the last job finishes, when each worker that becomes free takes the next job."""
+    import heapq
+
+    free = [0] * workers
+    for cost in costs:
+        heapq.heappush(free, heapq.heappop(free) + cost)
+    return max(free)
+
+
+def bench_batch_plan(n_small=8, n_big_images=6, workers=4):
+    """
+    A folder of n_small small files, followed by one file of n_big_images big z-stacks, on workers worker
+    processes. Shows the makespan predicted by batch.image_cost() for jobs in directory order, ordered longest
+    first (LPT), and with the big file split into a job per image, relative to directory order, and the time
+    measured for the last two. Measured gains need more than one CPU.
+    """
+    import contextlib
+    from LifClass import LifClass
+    from batch import BatchConverter
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for k in range(n_small):
+            paths.append(os.path.join(folder, f"small{k}.lif"))
+            write_synthetic_lif(paths[-1], x=1000, y=1000, c=2, bit_depth=8, seed=k)
+        paths.append(os.path.join(folder, "zbig.lif"))
+        write_synthetic_lif(paths[-1], n_images=n_big_images, x=2000, y=2000, z=8, c=3, bit_depth=16)
+
+        options = LifClass.Options()
+        unsplit = BatchConverter(options, workers=workers, split_images=False).plan_jobs(paths)
+        in_order = sorted(unsplit, key=lambda job: paths.index(job.path))
+        base = _makespan([job.cost for job in in_order], workers)
+        print(f'  directory order:       predicted {1:4.2f}')
+        for label, split_images in [("longest first:", False), ("longest first, split:", None)]:
+            batch = BatchConverter(options, workers=workers, split_images=split_images)
+            predicted = _makespan([job.cost for job in batch.plan_jobs(paths)], workers) / base
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                batch.convert_files(paths)
+            elapsed = time.perf_counter() - start
+            print(f'  {label:22s} predicted {predicted:4.2f}, measured {elapsed:5.2f} s ({os.cpu_count()} CPUs)')
+
+
+BENCHMARKS = {
+    "block_scan": bench_block_scan,
+    "xml_parse": bench_xml_parse,
+    "reslice": bench_reslice,
+    "rescale": bench_rescale,
+    "convert_rss": bench_convert_rss,
+    "memory_estimate": bench_memory_estimate,
+    "write_pool": bench_write_pool,
+    "batch": bench_batch,
+    "batch_plan": bench_batch_plan,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for bench_name in names:
+        print(f'\n{bench_name}: {BENCHMARKS[bench_name].__doc__}')
+        BENCHMARKS[bench_name]()
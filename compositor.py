@@ -0,0 +1,220 @@
+"""
+Merges image channels into BGR output images.
+
+Each channel's LUTName is mapped to a weight for each of the blue, green and red output
+components. Output images are then built by adding every channel into its components,
+in strips of rows, with saturating adds straight into a preallocated interleaved buffer.
+Rescaling with respect to the black and white levels is fused into the same pass, see rescale.py.
+"""
+import numpy as np
+import cv2  # install with pip install opencv-python
+
+from rescale import apply_lut
+
+# Weights of (blue, green, red) output components for LUT names used by LASX.
+# cv2.imwrite requires BGR order, backwards from usual RGB.
+LUT_WEIGHTS = {
+    "Red": (0, 0, 1),
+    "Green": (0, 1, 0),
+    "Blue": (1, 0, 0),
+    "Cyan": (1, 1, 0),
+    "Magenta": (1, 0, 1),
+    "Yellow": (0, 1, 1),
+    "Gray": (1, 1, 1),
+    "Grey": (1, 1, 1),
+}
+
+_COMPONENT_NAMES = ("blue", "green", "red")
+
+# Approximate size of the strips of rows that are processed at once, small enough to stay in cache
+STRIP_BYTES = 1024 * 1024
+
+
+def lut_weights(lut_name):
+    """
+    Returns (blue, green, red) weights of a channel, from its LUTName.
+
+    Besides the names in LUT_WEIGHTS, arbitrary colors given as hex RGB values,
+    e.g. "#FF8000", are supported. Returns None if the name is not recognized.
+    """
+    if lut_name in LUT_WEIGHTS:
+        return LUT_WEIGHTS[lut_name]
+
+    hex_value = lut_name.lstrip("#")
+    if len(hex_value) == 6:
+        try:
+            r, g, b = (int(hex_value[k:k + 2], 16) / 255 for k in (0, 2, 4))
+        except ValueError:
+            return None
+        if r + g + b > 0:
+            return b, g, r
+
+    return None
+
+
+def channel_suffix(lut_name, m):
+    """Returns file name suffix for an image with channel m only."""
+    if lut_name.isalpha():
+        return lut_name.lower()
+    return f"channel{m + 1}"
+
+
+def plan_composites(lut_names, separate_all=False, separate_overlaps=True):
+    """
+    Decides which channels go into which output image, and with what weights.
+
+    Channels with a single component (red, green, blue) are placed first, then the others in
+    channel order. A channel whose components are all still free is merged at full intensity.
+    If a two-component channel (e.g. cyan) overlaps only one occupied component, it is put into
+    the free one only. Otherwise, overlapping channels get their own image if separate_overlaps
+    is True, or are merged at half intensity.
+
+    Args:
+        lut_names (list): LUTName of each channel
+        separate_all (bool): write every channel to its own image instead of merging
+        separate_overlaps (bool): write overlapping channels to their own image
+
+    Returns:
+        List of (suffix, [(channel index, (blue, green, red) weights), ...]), one per output image.
+        Suffix of the merged image is "RGB".
+    """
+    weights = []
+    for name in lut_names:
+        w = lut_weights(name)
+        if w is None:
+            print(f'        Unrecognized color {name}, will treat as Gray')
+            w = LUT_WEIGHTS["Gray"]
+        weights.append(w)
+
+    if separate_all:
+        return [(channel_suffix(name, m), [(m, weights[m])]) for m, name in enumerate(lut_names)]
+
+    merged = []
+    separate = []
+    occupied = [False, False, False]
+
+    for m in sorted(range(len(lut_names)), key=lambda n: (np.count_nonzero(weights[n]), n)):
+        w = weights[m]
+        components = [k for k in range(3) if w[k] > 0]
+        free = [k for k in components if not occupied[k]]
+
+        if len(free) == len(components):
+            merged.append((m, w))
+        elif free and len(components) == 2:
+            names = " and ".join(_COMPONENT_NAMES[k] for k in free)
+            print(f'    Converting {lut_names[m].lower()} to {names}, to avoid overlap with other channels')
+            merged.append((m, tuple(w[k] if k in free else 0 for k in range(3))))
+        elif separate_overlaps:
+            separate.append((channel_suffix(lut_names[m], m), [(m, w)]))
+            continue
+        else:
+            # Add to the existing colors at reduced intensity
+            merged.append((m, tuple(x / 2 for x in w)))
+
+        for k in components:
+            occupied[k] = True
+
+    return ([("RGB", merged)] if merged else []) + separate
+
+
+def composite(sources, out, rotate180=False):
+    """
+    Adds channels into a BGR image, with saturation.
+
+    Args:
+        sources (list): (raw pixels, [blue lut, green lut, red lut]) for each channel. Raw pixels
+            are arrays of shape (y, x). A lut is None if the channel doesn't contribute to that
+            component. Luts map raw values to weighted output values, see rescale.get_lut().
+        out (numpy array): preallocated output of shape (y, x, 3)
+        rotate180 (bool): rotate image by 180 degrees while writing it into out
+
+    Returns:
+        out
+    """
+    height, width = out.shape[:2]
+    rows = max(1, STRIP_BYTES // max(1, width * out.itemsize * 3))
+
+    # One contiguous strip per component, so that OpenCV can add into it in place
+    strips = np.empty((3, min(rows, height), width), dtype=out.dtype)
+    temp = np.empty((min(rows, height), width), dtype=out.dtype)
+
+    for row in range(0, height, rows):
+        n = min(rows, height - row)
+        for k in range(3):
+            acc = strips[k, :n]
+            first = True
+            for raw, luts in sources:
+                if luts[k] is None:
+                    continue
+                if first:
+                    apply_lut(raw[row:row + n], luts[k], out=acc)
+                    first = False
+                else:
+                    apply_lut(raw[row:row + n], luts[k], out=temp[:n])
+                    # Saturating add, so no promotion to a wider type is needed
+                    cv2.add(acc, temp[:n], dst=acc)
+            if first:
+                acc[:] = 0
+
+        # Interleave components into output, reversing rows and columns if rotating
+        if rotate180:
+            out[height - row - n:height - row] = strips[:, n - 1::-1, ::-1].transpose(1, 2, 0)
+        else:
+            out[row:row + n] = strips[:, :n].transpose(1, 2, 0)
+
+    return out
+
+
+def depth_colors(n_planes, dtype, coded=True):
+    """
+    Returns (n_planes, 3) array with the BGR color of each z plane, in the range of dtype.
+
+    Args:
+        n_planes (int): number of z planes
+        dtype: numpy dtype of output, uint8 or uint16
+        coded (bool): if True, planes go from blue (first) to red (last) through green and yellow.
+            If False, planes go from black (first) to white (last).
+    """
+    max_value = np.iinfo(dtype).max
+    ramp = np.linspace(0, 255, n_planes).round().astype(np.uint8).reshape(-1, 1)
+    if coded:
+        colors = cv2.applyColorMap(ramp, cv2.COLORMAP_JET).reshape(-1, 3)
+    else:
+        colors = np.repeat(ramp, 3, axis=1)
+    return np.rint(colors * (max_value / 255)).astype(dtype)
+
+
+def composite_depth(index, colors, out, raw=None, lut=None, rotate180=False):
+    """
+    Colors each pixel by the z plane it came from, e.g. the plane with the brightest value.
+
+    Args:
+        index (numpy array): z plane of each pixel, shape (y, x), uint8 or uint16
+        colors (numpy array): color of each plane, from depth_colors()
+        out (numpy array): preallocated output of shape (y, x, 3)
+        raw (numpy array): if given, color is scaled by the brightness of these raw pixels, e.g. the
+            maximum intensity projection. Otherwise all pixels are at full brightness.
+        lut (numpy array): table mapping raw values to output values, see rescale.get_lut()
+        rotate180 (bool): rotate image by 180 degrees while writing it into out
+
+    Returns:
+        out
+    """
+    height, width = out.shape[:2]
+    max_value = np.iinfo(out.dtype).max
+    rows = max(1, STRIP_BYTES // max(1, width * out.itemsize * 3))
+
+    for row in range(0, height, rows):
+        n = min(rows, height - row)
+        # (n, width, 3) colors of this strip
+        strip = np.take(colors, index[row:row + n], axis=0)
+        if raw is not None:
+            brightness = apply_lut(raw[row:row + n], lut).astype(np.float32) / max_value
+            strip = (strip * brightness[:, :, np.newaxis]).astype(out.dtype)
+
+        if rotate180:
+            out[height - row - n:height - row] = strip[::-1, ::-1]
+        else:
+            out[row:row + n] = strip
+
+    return out
@@ -0,0 +1,194 @@
+"""
+Writers for images that are saved with OpenCV's imwrite(), in a single piece.
+
+They take rows in the same way as the writers in tiff_writer.py and jpeg_writer.py, so that
+one pass over an image can feed every output file, whatever its format.
+WholeImageWriter writes the image once all rows have arrived. ThumbnailWriter shrinks rows as
+they arrive, so thumbnails of images too big for memory only hold the small image.
+"""
+import numpy as np
+import cv2  # install with pip install opencv-python
+
+
+class WholeImageWriter:
+    """
+    Writes an image with cv2.imwrite(), once all rows have been written.
+
+    If all rows are written in a single call, they are written straight to disk without copying.
+    Otherwise they are collected into a buffer of the whole image.
+
+    Args:
+        path (str): output file. Format is given by the extension.
+        width (int): image width in pixels
+        height (int): image height in pixels
+        dtype: numpy dtype of pixels
+        params (list): parameters for cv2.imwrite(), e.g. JPG quality
+        pool (WriteGroup): if given, the image is written on a background thread, see write_pool.py.
+            Rows written in a single call must then come from WritePool.get_buffer(), so they aren't
+            changed before they have been written.
+    """
+
+    def __init__(self, path, width, height, dtype, params=(), pool=None):
+        self.path = path
+        self.width = int(width)
+        self.height = int(height)
+        self.dtype = np.dtype(dtype)
+        self.params = list(params)
+        self.pool = pool
+        self.rows_written = 0
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, rows):
+        """
+        Appends rows to the image.
+
+        Args:
+            rows (numpy array): shape (n, width, 3) in BGR order
+        """
+        n = rows.shape[0]
+        if rows.shape[1:] != (self.width, 3) or rows.dtype != self.dtype:
+            raise ValueError(f"Expected {self.dtype} rows of shape (n, {self.width}, 3), "
+                             f"got {rows.shape} and {rows.dtype}")
+        if self.rows_written + n > self.height:
+            raise ValueError(f"Too many rows, image height is {self.height}")
+
+        if n == self.height:
+            # Whole image at once, so no need to copy it
+            self._save(rows, rows)
+        else:
+            if self._buffer is None:
+                self._buffer = np.empty((self.height, self.width, 3), dtype=self.dtype)
+            self._buffer[self.rows_written:self.rows_written + n] = rows
+            if self.rows_written + n == self.height:
+                # Private buffer, so nothing else can change it while it is written
+                self._save(self._buffer, None)
+                self._buffer = None
+
+        self.rows_written += n
+
+    def _save(self, image, buffer):
+        """Encodes and writes the image, in the background if there is a pool (private)."""
+        if self.pool is not None:
+            self.pool.submit(lambda: self._imwrite(image), buffer)
+        else:
+            self._imwrite(image)
+
+    def _imwrite(self, image):
+        if not cv2.imwrite(self.path, image, self.params):
+            raise IOError(f'Unable to write "{self.path}"')
+
+    def close(self):
+        """
+        Checks that the image is complete. It was written when its last row arrived,
+        or handed to the pool, which reports when it has been written.
+        """
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+
+    def abort(self):
+        """Discards rows that have not been written yet."""
+        self._buffer = None
+
+
+class ThumbnailWriter:
+    """
+    Shrinks an image as its rows arrive, and writes it with cv2.imwrite() when complete.
+
+    The image is shrunk by a whole number, so that it fits within size x size pixels.
+    Each thumbnail pixel is the mean of a block of image pixels, which is like cv2.INTER_AREA,
+    but doesn't need the whole image at once. Blocks at the right and bottom edges may be smaller.
+
+    Args:
+        path (str): output file. Format is given by the extension.
+        width (int): width of the full size image, in pixels
+        height (int): height of the full size image, in pixels
+        size (int): largest width or height of the thumbnail
+        params (list): parameters for cv2.imwrite(), e.g. JPG quality
+    """
+
+    def __init__(self, path, width, height, size, params=()):
+        self.path = path
+        self.width = int(width)
+        self.height = int(height)
+        self.params = list(params)
+        self.factor = max(1, -(-max(self.width, self.height) // int(size)))
+        self.rows_written = 0
+
+        # Left edge of each block of columns, and the number of columns in each
+        self._columns = np.arange(0, self.width, self.factor)
+        self._column_counts = np.diff(np.append(self._columns, self.width)).reshape(-1, 1)
+
+        self._image = None
+        self._sum = np.zeros((len(self._columns), 3), dtype=np.float64)
+        self._block_rows = 0
+        self._out_row = 0
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, rows):
+        """
+        Appends rows to the image.
+
+        Args:
+            rows (numpy array): shape (n, width, 3) in BGR order, any number of rows
+        """
+        n = rows.shape[0]
+        if rows.shape[1:] != (self.width, 3):
+            raise ValueError(f"Expected rows of shape (n, {self.width}, 3), got {rows.shape}")
+        if self.rows_written + n > self.height:
+            raise ValueError(f"Too many rows, image height is {self.height}")
+
+        if self._image is None:
+            self._image = np.zeros((-(-self.height // self.factor), len(self._columns), 3), dtype=rows.dtype)
+
+        start = 0
+        while start < n:
+            count = min(n - start, self.factor - self._block_rows)
+            # Sum of each block of columns, then of the rows
+            sums = np.add.reduceat(rows[start:start + count], self._columns, axis=1, dtype=np.float64)
+            self._sum += sums.sum(axis=0)
+            self._block_rows += count
+            start += count
+            if self._block_rows == self.factor or self.rows_written + start == self.height:
+                self._image[self._out_row] = np.rint(self._sum / (self._block_rows * self._column_counts))
+                self._out_row += 1
+                self._sum[:] = 0
+                self._block_rows = 0
+
+        self.rows_written += n
+
+    def close(self):
+        """Writes the thumbnail. All rows must have been written."""
+        if self._closed:
+            return
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+        image = self._image
+        self._image = None
+        self._closed = True
+        if not cv2.imwrite(self.path, image, self.params):
+            raise IOError(f'Unable to write "{self.path}"')
+
+    def abort(self):
+        """Discards the thumbnail. Nothing is written until close(), so there is no file to delete."""
+        self._image = None
+        self._closed = True
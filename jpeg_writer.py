@@ -0,0 +1,162 @@
+"""
+Writes images too big for a single JPG file as a grid of JPG tiles.
+
+JPG is limited to 65,535 x 65,535 pixels. Bigger images are split into tiles, which are
+encoded in parallel as soon as each row of tiles is complete, so the whole image is never
+held in memory. The writer takes rows in the same way as the writers in tiff_writer.py.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2  # install with pip install opencv-python
+
+# Largest width or height of a JPG file
+JPG_MAX_SIZE = 65535
+
+# Width and height of tiles
+DEFAULT_TILE_SIZE = 4096
+
+
+def needs_tiles(width, height):
+    """Returns True if image is too big for a single JPG file."""
+    return width > JPG_MAX_SIZE or height > JPG_MAX_SIZE
+
+
+def grid_size(width, height, tile_size=DEFAULT_TILE_SIZE):
+    """Returns (columns, rows) of tiles needed for an image."""
+    return -(-width // tile_size), -(-height // tile_size)
+
+
+def tile_path(path, column, row):
+    """Returns file name of the tile in the given column and row, counting from 0 at the top left."""
+    root, ext = os.path.splitext(path)
+    return f"{root}_X{column + 1}_Y{row + 1}{ext}"
+
+
+class TiledJpegWriter:
+    """
+    Writes an image as a grid of JPG tiles, one block of rows at a time, from top to bottom.
+
+    Rows are collected until a row of tiles is complete. Its tiles are then encoded on a pool of
+    threads while the next row of tiles is collected. OpenCV releases the GIL while encoding, so
+    tiles are encoded in parallel. At most two rows of tiles are held in memory.
+
+    Args:
+        path (str): name of the whole image. Tiles are named by tile_path().
+        width (int): image width in pixels
+        height (int): image height in pixels
+        tile_size (int): width and height of tiles. Tiles at the right and bottom edges may be smaller.
+        quality (int): JPG quality, from 0 to 100
+        workers (int): encoding threads. None uses one per CPU.
+    """
+
+    def __init__(self, path, width, height, tile_size=DEFAULT_TILE_SIZE, quality=90, workers=None):
+        if tile_size > JPG_MAX_SIZE:
+            raise ValueError(f"Tile size can't be more than {JPG_MAX_SIZE}")
+
+        self.path = path
+        self.width = int(width)
+        self.height = int(height)
+        self.tile_size = tile_size
+        self.quality = quality
+        self.columns, self.rows = grid_size(self.width, self.height, tile_size)
+
+        self.rows_written = 0
+        self.tile_paths = []
+        self._buffer = None
+        self._rows_filled = 0
+        self._tile_row = 0
+        self._pending = []
+        self._executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, rows):
+        """
+        Appends rows to the image.
+
+        Args:
+            rows (numpy array): shape (n, width, 3) in BGR order, uint8, any number of rows
+        """
+        n = rows.shape[0]
+        if rows.shape[1:] != (self.width, 3) or rows.dtype != np.uint8:
+            raise ValueError(f"Expected uint8 rows of shape (n, {self.width}, 3), got {rows.shape} and {rows.dtype}")
+        if self.rows_written + n > self.height:
+            raise ValueError(f"Too many rows, image height is {self.height}")
+
+        start = 0
+        while start < n:
+            if self._buffer is None:
+                # New buffer for each row of tiles, because the previous one may still be encoding
+                buffer_rows = min(self.tile_size, self.height - self._tile_row * self.tile_size)
+                self._buffer = np.empty((buffer_rows, self.width, 3), dtype=np.uint8)
+            count = min(n - start, self._buffer.shape[0] - self._rows_filled)
+            self._buffer[self._rows_filled:self._rows_filled + count] = rows[start:start + count]
+            self._rows_filled += count
+            start += count
+            if self._rows_filled == self._buffer.shape[0]:
+                self._encode_row()
+
+        self.rows_written += n
+
+    def _encode_row(self):
+        """Starts encoding the tiles of the completed row of tiles (private)."""
+        # Wait for the previous row, so no more than two are in memory
+        self._wait()
+
+        buffer = self._buffer
+        self._buffer = None
+        self._rows_filled = 0
+        for column in range(self.columns):
+            path = tile_path(self.path, column, self._tile_row)
+            tile = buffer[:, column * self.tile_size:(column + 1) * self.tile_size]
+            self.tile_paths.append(path)
+            self._pending.append(self._executor.submit(self._write_tile, path, tile))
+        self._tile_row += 1
+
+    def _write_tile(self, path, tile):
+        """Encodes and writes one tile, on a worker thread (private)."""
+        if not cv2.imwrite(path, tile, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]):
+            raise IOError(f'Unable to write "{path}"')
+
+    def _wait(self):
+        """Waits for tiles being encoded, re-raising any error (private)."""
+        pending = self._pending
+        self._pending = []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """Waits for the last tiles to be written. All rows must have been written."""
+        if self._executor is None:
+            return
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+        try:
+            self._wait()
+        except BaseException:
+            self.abort()
+            raise
+        self._executor.shutdown()
+        self._executor = None
+
+    def abort(self):
+        """Stops encoding and deletes any tiles written, so they can't be mistaken for a converted image."""
+        if self._executor is None:
+            return
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        for path in self.tile_paths:
+            if os.path.exists(path):
+                os.remove(path)
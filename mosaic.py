@@ -0,0 +1,116 @@
+"""
+Stitching of tile scans, i.e. images with dims.m > 1, into a single image.
+
+Tiles are placed at the stage positions recorded by LASX, one tile at a time, into a canvas
+that is memory-mapped to a temporary file. Only one tile is held in memory, so tile scans
+much bigger than RAM can be stitched. Where tiles overlap, later tiles are drawn over earlier ones.
+"""
+import tempfile
+
+import numpy as np
+
+
+def tile_positions(img):
+    """
+    Returns pixel position (x, y) of the top left corner of each tile, relative to the top left of the mosaic.
+
+    Positions come from PosX and PosY in mosaic_position (in meters), converted to pixels using the
+    pixel size from scale_n. If the pixel size is unknown, tiles are placed side by side, using FieldX and FieldY.
+
+    Raises:
+        ValueError if the LIF file doesn't contain a position for every tile
+    """
+    positions = img.mosaic_position
+    if len(positions) != img.dims.m:
+        raise ValueError(f"Found positions of {len(positions)} tiles, expected {img.dims.m}")
+
+    scale_x = img.scale_n.get(1)
+    scale_y = img.scale_n.get(2)
+    if scale_x and scale_y:
+        # scale_n is in pixels per micrometer
+        xs = [pos_x * 1e6 * scale_x for field_x, field_y, pos_x, pos_y in positions]
+        ys = [pos_y * 1e6 * scale_y for field_x, field_y, pos_x, pos_y in positions]
+    else:
+        xs = [field_x * img.dims.x for field_x, field_y, pos_x, pos_y in positions]
+        ys = [field_y * img.dims.y for field_x, field_y, pos_x, pos_y in positions]
+
+    x0 = min(xs)
+    y0 = min(ys)
+    return [(int(round(x - x0)), int(round(y - y0))) for x, y in zip(xs, ys)]
+
+
+def mosaic_size(img, positions):
+    """Returns (width, height) of mosaic, in pixels."""
+    width = max(x for x, y in positions) + img.dims.x
+    height = max(y for x, y in positions) + img.dims.y
+    return width, height
+
+
+def new_canvas(shape, dtype, temp_dir=None):
+    """
+    Returns zero-filled numpy memmap of the given shape, backed by an anonymous temporary file.
+
+    The file is deleted as soon as the memmap is garbage collected.
+
+    Args:
+        temp_dir (str): folder for temporary file. If None, the system default is used.
+    """
+    with tempfile.TemporaryFile(dir=temp_dir, prefix="mosaic_") as f:
+        # The mapping keeps the file open after this file object is closed
+        return np.memmap(f, dtype=dtype, mode="w+", shape=shape)
+
+
+def tiles_in_region(positions, tile_size, region):
+    """
+    Returns indices of tiles that overlap region (x, y, width, height) of the mosaic.
+
+    Args:
+        positions (list): (x, y) position of each tile, from tile_positions()
+        tile_size (tuple): (width, height) of each tile
+    """
+    rx, ry, width, height = region
+    tile_w, tile_h = tile_size
+    return [m for m, (x, y) in enumerate(positions)
+            if x < rx + width and x + tile_w > rx and y < ry + height and y + tile_h > ry]
+
+
+def stitch(get_tile, positions, tile_size, region, temp_dir=None, progress=None):
+    """
+    Places tiles into memory-mapped canvases, one tile at a time.
+
+    Only tiles that overlap region are read, and only the overlapping part of each is copied.
+
+    Args:
+        get_tile (function): get_tile(m) returns a dictionary of (c, y, x) arrays for tile m,
+            e.g. {"max": maximum projection}. Each entry is stitched into its own canvas.
+        positions (list): (x, y) position of each tile, from tile_positions()
+        tile_size (tuple): (width, height) of each tile
+        region (tuple): (x, y, width, height) of the part of the mosaic to stitch.
+            Use (0, 0) + mosaic_size() for the whole mosaic.
+        temp_dir (str): folder for temporary files holding the canvases
+        progress (function): called before each tile is read, e.g. to check for cancellation
+
+    Returns:
+        Dictionary of memmaps of shape (c, height, width), with the same keys and dtypes as the tiles.
+        Empty if no tiles overlap region.
+    """
+    rx, ry, width, height = region
+    tile_w, tile_h = tile_size
+    canvases = {}
+
+    for m in tiles_in_region(positions, tile_size, region):
+        if progress is not None:
+            progress()
+
+        # Position of tile relative to region, and the part of the tile that falls inside it
+        x = positions[m][0] - rx
+        y = positions[m][1] - ry
+        x0, x1 = max(0, -x), min(tile_w, width - x)
+        y0, y1 = max(0, -y), min(tile_h, height - y)
+
+        for name, tile in get_tile(m).items():
+            if name not in canvases:
+                canvases[name] = new_canvas((tile.shape[0], height, width), tile.dtype, temp_dir)
+            canvases[name][:, y + y0:y + y1, x + x0:x + x1] = tile[:, y0:y1, x0:x1]
+
+    return canvases
@@ -0,0 +1,191 @@
+"""
+Projections of z-stacks, e.g. maximum intensity projection.
+
+All channels are projected together, from (c, y, x) planes read in on-disk order, so the
+memory block of the stack is read only once. Several reducers can be calculated in the same pass.
+"""
+import numpy as np
+
+# Reducers supported by StackProjector. "argmax" is the index of the plane with the brightest
+# value of each pixel, i.e. a depth map. If several planes are equally bright, the first one wins.
+REDUCERS = ("max", "min", "mean", "sum", "std", "argmax")
+
+
+def projection_bytes(reducers, dtype, n_planes=None):
+    """
+    Returns approximate peak memory of StackProjector per pixel of each channel, in bytes: its
+    accumulators, plus the temporaries and projections of result(). Used to fit bands of rows
+    within a memory budget.
+
+    Args:
+        reducers (tuple): names of projections, from REDUCERS
+        dtype: numpy dtype of planes
+        n_planes (int): number of planes, if known, see StackProjector
+    """
+    dtype = np.dtype(dtype)
+    size = dtype.itemsize
+    total = 0
+    if "max" in reducers or "argmax" in reducers:
+        total += size
+    if "argmax" in reducers:
+        # Index of brightest plane, and comparison mask
+        total += (1 if n_planes is not None and n_planes <= 256 else 2) + 1
+    if "min" in reducers:
+        total += size
+    if {"mean", "sum", "std"} & set(reducers):
+        if dtype.kind in "ui" and n_planes is not None and np.iinfo(dtype).max * n_planes < 2 ** 32:
+            sum_size = 4
+        else:
+            sum_size = 8
+        total += sum_size
+        if "sum" in reducers:
+            # Saturated sum, and result
+            total += sum_size + size
+        if "mean" in reducers or "std" in reducers:
+            # Mean and its rounded copy, and result
+            total += 16 + size
+        if "std" in reducers:
+            # Sum of squares, temporary for squares, and variance
+            total += 24 + size
+    return total
+
+
+class StackProjector:
+    """
+    Accumulates projections of a z-stack, one (c, y, x) plane at a time. Accumulators are
+    updated in place, so no memory is allocated after the first plane.
+
+    Example:
+        projector = StackProjector(("max", "mean"))
+        for plane in img.get_stack():
+            projector.add(plane)
+        projections = projector.result()
+
+    Args:
+        reducers (tuple): names of projections to calculate, from REDUCERS
+        n_planes (int): number of planes that will be added, if known. Used to select
+            a smaller integer accumulator for sums when it can't overflow.
+    """
+
+    def __init__(self, reducers, n_planes=None):
+        unknown = [r for r in reducers if r not in REDUCERS]
+        if unknown:
+            raise ValueError(f"Unknown projection {unknown}, must be one of {REDUCERS}")
+
+        self.reducers = tuple(reducers)
+        self.n_planes = n_planes
+        self.count = 0
+        self._max = None
+        self._min = None
+        self._sum = None
+        self._sum_sq = None
+        self._temp = None
+        self._argmax = None
+        self._brighter = None
+
+    def add(self, plane):
+        """Adds one plane of shape (c, y, x), or (y, x), to all projections."""
+        if self.count == 0:
+            self._allocate(plane)
+        else:
+            if self._argmax is not None:
+                # Must be done before updating maximum
+                np.greater(plane, self._max, out=self._brighter)
+                np.copyto(self._argmax, self.count, where=self._brighter, casting="unsafe")
+            if self._max is not None:
+                np.maximum(self._max, plane, out=self._max)
+            if self._min is not None:
+                np.minimum(self._min, plane, out=self._min)
+            if self._sum is not None:
+                np.add(self._sum, plane, out=self._sum)
+            if self._sum_sq is not None:
+                np.multiply(plane, plane, out=self._temp, dtype=self._temp.dtype)
+                np.add(self._sum_sq, self._temp, out=self._sum_sq)
+        self.count += 1
+
+    def _allocate(self, plane):
+        """Creates accumulators, initialized from the first plane (private)."""
+        self.dtype = plane.dtype
+        max_value = np.iinfo(plane.dtype).max if plane.dtype.kind in "ui" else None
+
+        if "max" in self.reducers or "argmax" in self.reducers:
+            self._max = np.array(plane)
+        if "argmax" in self.reducers:
+            # Smallest index type that can hold all planes, uint16 if number of planes isn't known
+            index_type = np.uint8 if self.n_planes is not None and self.n_planes <= 256 else np.uint16
+            self._argmax = np.zeros(plane.shape, dtype=index_type)
+            self._brighter = np.empty(plane.shape, dtype=bool)
+        if "min" in self.reducers:
+            self._min = np.array(plane)
+
+        if {"mean", "sum", "std"} & set(self.reducers):
+            if max_value is not None and self.n_planes is not None and max_value * self.n_planes < 2 ** 32:
+                sum_type = np.uint32
+            elif max_value is not None:
+                sum_type = np.uint64
+            else:
+                sum_type = np.float64
+            self._sum = plane.astype(sum_type)
+
+        if "std" in self.reducers:
+            # Squares of 16-bit values overflow 32 bits after a single plane
+            square_type = np.uint64 if max_value is not None else np.float64
+            self._temp = np.empty(plane.shape, dtype=square_type)
+            self._sum_sq = np.multiply(plane, plane, dtype=square_type)
+
+    def result(self):
+        """
+        Returns dictionary of projections, with same shape and dtype as the planes.
+        Mean and standard deviation are rounded to the nearest integer. Sums saturate
+        at the maximum value of the dtype. Argmax is uint8 or uint16.
+        """
+        if self.count == 0:
+            raise ValueError("No planes were added to projection")
+
+        results = {}
+        if "max" in self.reducers:
+            results["max"] = self._max
+        if self._argmax is not None:
+            results["argmax"] = self._argmax
+        if self._min is not None:
+            results["min"] = self._min
+
+        integer = self.dtype.kind in "ui"
+        if "sum" in self.reducers:
+            if integer:
+                results["sum"] = np.minimum(self._sum, np.iinfo(self.dtype).max).astype(self.dtype)
+            else:
+                results["sum"] = self._sum.astype(self.dtype)
+
+        if "mean" in self.reducers or "std" in self.reducers:
+            mean = self._sum / self.count
+            if "mean" in self.reducers:
+                results["mean"] = (np.rint(mean) if integer else mean).astype(self.dtype)
+            if "std" in self.reducers:
+                # Population standard deviation, from sum of squares. Rounding can make variance slightly negative.
+                variance = self._sum_sq / self.count - mean * mean
+                std = np.sqrt(np.maximum(variance, 0, out=variance), out=variance)
+                results["std"] = (np.rint(std) if integer else std).astype(self.dtype)
+
+        return results
+
+
+def project_stack(planes, reducers=("max",), n_planes=None, progress=None):
+    """
+    Calculates projections of a z-stack in one pass.
+
+    Args:
+        planes (iterable): (c, y, x) arrays, one per z position, e.g. from LifImage.get_stack()
+        reducers (tuple): names of projections to calculate, from REDUCERS
+        n_planes (int): number of planes, if known
+        progress (function): called before each plane is added, e.g. to check for cancellation
+
+    Returns:
+        Dictionary of projections, each of shape (c, y, x)
+    """
+    projector = StackProjector(reducers, n_planes)
+    for plane in planes:
+        if progress is not None:
+            progress()
+        projector.add(plane)
+    return projector.result()
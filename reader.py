@@ -1,15 +1,222 @@
+import codecs
+import hashlib
 import io
+import json
+import mmap
 import os
 import struct
+import threading
 import warnings
 import xml.etree.ElementTree as ET
 from collections import namedtuple
-from functools import reduce
+from contextlib import contextmanager
+from functools import partial, reduce
 
+import numpy as np
 from PIL import Image   # Install Pillow rather than PIL
 
 LIF_MAGIC = b"\x70\x00\x00\x00"
 
+# Maximum number of file descriptors a LifFile keeps open at the same time.
+# Single-threaded use only ever needs one.
+DEFAULT_MAX_HANDLES = 4
+
+# Default upper limit on memory used by LifImage.iter_stack_chunks()
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+# Size of reads when parsing the XML header in lazy_xml mode
+XML_CHUNK_BYTES = 1024 * 1024
+
+# Parts of the XML header that are needed to build LifFile.image_list. In lazy_xml mode,
+# everything else is discarded while parsing. Keys are parent tags, values are child tags.
+_INDEX_XML_TAGS = {
+    "Element": ("Data", "Memory", "Children"),
+    "Children": ("Element",),
+    "Data": ("Image",),
+    "Image": ("ImageDescription", "Attachment"),
+    "ImageDescription": ("Channels", "Dimensions"),
+    "Channels": ("ChannelDescription",),
+    "Dimensions": ("DimensionDescription",),
+    "Attachment": ("ChannelScalingInfo", "Tile"),
+}
+
+# Size of reads when scanning memory block headers of files that can't be memory-mapped
+SCAN_WINDOW_BYTES = 1024 * 1024
+
+# 4 magic + 4 unused + 1 memory byte + 8 length + 1 memory byte + 4 description length
+_MAX_BLOCK_HEADER_LEN = 22
+
+# Increment this whenever the format of the index cache changes, to invalidate old cache files
+INDEX_CACHE_VERSION = 3
+
+Dims = namedtuple("Dims", "x y z t m")
+
+
+class _HandlePool:
+    """
+    Bounded pool of open file handles shared by a LifFile and all of its
+    LifImage objects (private).
+
+    Handles are opened lazily and returned to the pool after use, so reading
+    many frames from the same file reuses the same descriptor instead of
+    opening (and leaking) a new one per frame. If more than `max_handles`
+    threads read at once, the extra threads wait for a handle to be returned.
+
+    Frames are mapped through a single read-only mmap of the whole file, which
+    is likewise created once and shared.
+
+    If the LifFile was given an already-open io.IOBase object, that object is
+    the only handle in the pool, and it is never closed by the pool.
+
+    Attributes:
+        num_opens (int): Number of times a file descriptor was opened
+        num_reads (int): Number of read() calls issued through the pool
+        num_maps (int): Number of times the file was memory-mapped
+    """
+
+    def __init__(self, filename, max_handles=DEFAULT_MAX_HANDLES):
+        if isinstance(filename, (str, bytes, os.PathLike)):
+            self._owns_handles = True
+        elif isinstance(filename, io.IOBase):
+            self._owns_handles = False
+            max_handles = 1
+        else:
+            raise TypeError(
+                f"expected str, bytes, os.PathLike, or io.IOBase, " f"not {type(filename)}"
+            )
+
+        self.filename = filename
+        self.max_handles = max(1, int(max_handles))
+        self.num_opens = 0
+        self.num_reads = 0
+        self.num_maps = 0
+
+        self._idle = []  # Handles not currently borrowed. Used as a stack, so the same one is reused.
+        self._num_handles = 0  # Idle plus borrowed
+        self._mmap = None
+        self._mmap_failed = False
+        self._lock = threading.Condition()
+
+    def _acquire(self):
+        with self._lock:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._num_handles < self.max_handles:
+                    self._num_handles += 1
+                    break
+                self._lock.wait()
+
+        if not self._owns_handles:
+            return self.filename
+
+        try:
+            handle = open(self.filename, "rb")
+        except BaseException:
+            with self._lock:
+                self._num_handles -= 1
+                self._lock.notify()
+            raise
+        self.num_opens += 1
+        return handle
+
+    def _release(self, handle):
+        with self._lock:
+            self._idle.append(handle)
+            self._lock.notify()
+
+    @contextmanager
+    def borrow(self):
+        """Context manager that lends out an open handle, and returns it to the pool afterwards."""
+        handle = self._acquire()
+        try:
+            yield handle
+        finally:
+            self._release(handle)
+
+    def read_at(self, offset, length):
+        """Reads `length` bytes starting at byte position `offset`."""
+        with self.borrow() as handle:
+            handle.seek(offset)
+            self.num_reads += 1
+            return handle.read(length)
+
+    def readinto_at(self, offset, buffer):
+        """Fills `buffer` with bytes starting at byte position `offset`. Returns number of bytes read."""
+        with self.borrow() as handle:
+            handle.seek(offset)
+            self.num_reads += 1
+            return handle.readinto(buffer)
+
+    def _get_mmap(self):
+        """Returns a read-only mmap of the whole file, or None if the file can't be mapped."""
+        with self._lock:
+            if self._mmap is not None or self._mmap_failed:
+                return self._mmap
+
+        with self.borrow() as handle:
+            try:
+                mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                # E.g. BytesIO objects have no file descriptor, and empty files can't be mapped
+                mm = None
+
+        with self._lock:
+            if mm is None:
+                self._mmap_failed = True
+            elif self._mmap is None:
+                self._mmap = mm
+                self.num_maps += 1
+            else:
+                # Another thread got there first
+                mm.close()
+            return self._mmap
+
+    def map_array(self, offset, dtype, shape):
+        """
+        Returns a read-only numpy array of the given dtype and shape, starting
+        at byte position `offset`. This is a view into the shared mmap whenever
+        possible, so no data is read until it is accessed.
+        """
+        dtype = np.dtype(dtype)
+        mm = self._get_mmap()
+        if mm is not None:
+            return np.ndarray(shape, dtype=dtype, buffer=mm, offset=offset)
+
+        data = self.read_at(offset, int(np.prod(shape)) * dtype.itemsize)
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+    def close(self):
+        """
+        Closes all idle handles and the shared mmap. Handles that are currently
+        borrowed remain open. The pool can still be used afterwards, in which
+        case handles are reopened on demand.
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+            self._num_handles -= len(idle)
+            mm = self._mmap
+            self._mmap = None
+            self._mmap_failed = False
+            self._lock.notify_all()
+
+        if self._owns_handles:
+            for handle in idle:
+                handle.close()
+
+        if mm is not None:
+            try:
+                mm.close()
+            except BufferError:
+                # Arrays returned by map_array() still point into the mmap. It will be
+                # closed automatically once they are garbage collected.
+                pass
+
+    def stats(self):
+        """Returns counters as a dict, e.g. to confirm that only one descriptor was opened."""
+        return {"opens": self.num_opens, "reads": self.num_reads, "maps": self.num_maps}
+
 
 class LifImage:
     """
@@ -91,7 +298,13 @@ class LifImage:
 
     """
 
-    def __init__(self, image_info, offsets, filename):
+    def __init__(self, image_info, offsets, filename, handle_pool=None, xml_loader=None):
+        # File handles are borrowed from the parent LifFile, so that all images in a
+        # file share one descriptor. A standalone LifImage gets its own pool.
+        if handle_pool is None:
+            handle_pool = _HandlePool(filename)
+        self._handle_pool = handle_pool
+
         self.dims = image_info["dims"]  # Named tuple (x, y, z, t, m)
         self.display_dims = image_info["display_dims"]  # Tuple with two numbered values
         self.dims_n = image_info["dims_n"]
@@ -109,7 +322,23 @@ class LifImage:
         self.mosaic_position = image_info["mosaic_position"]
         self.n_mosaic = int(image_info["dims"].m)
         self.channel_as_second_dim = bool(image_info["channel_as_second_dim"])
-        self.settings = image_info["settings"]
+        # Function that returns the XML element of this image, see metadata_xml
+        self._xml_loader = xml_loader
+
+    @property
+    def metadata_xml(self):
+        """XML element of this image. If the LifFile was opened in lazy_xml mode, this parses the full header."""
+        if self._xml_loader is None:
+            raise ValueError("XML metadata is only available for images created by LifFile")
+        return self._xml_loader()
+
+    @property
+    def settings(self):
+        """ATLConfocalSettingDefinition attributes. Loaded from metadata_xml on first access in lazy_xml mode."""
+        if "settings" not in self.info:
+            settings = self.metadata_xml.find("./Data/Image/Attachment/ATLConfocalSettingDefinition")
+            self.info["settings"] = dict(settings.attrib) if settings is not None else {}
+        return self.info["settings"]
 
     def __repr__(self):
         return repr("LifImage object with dimensions: " + str(self.dims))
@@ -147,15 +376,6 @@ class LifImage:
         if n >= seek_distance:
             raise ValueError("Invalid item trying to be retrieved.")
 
-        if isinstance(self.filename, (str, bytes, os.PathLike)):
-            image = open(self.filename, "rb")
-        elif isinstance(self.filename, io.IOBase):
-            image = self.filename
-        else:
-            raise TypeError(
-                f"expected str, bytes, os.PathLike, or io.IOBase, " f"not {type(self.filename)}"
-            )
-
         # self.offsets[1] is the length of the image
         if self.offsets[1] == 0:
             # In the case of a blank image, we can calculate the length from
@@ -165,14 +385,12 @@ class LifImage:
         else:
             image_len = int(self.offsets[1] / seek_distance)
 
-        # self.offsets[0] is the offset in the file
-        image.seek(self.offsets[0] + image_len * n)
-
         # Todo: Update this for 16-bit images if there is a test file
         if self.offsets[1] == 0:
             data = b"\00" * image_len
         else:
-            data = image.read(image_len)
+            # self.offsets[0] is the offset in the file
+            data = self._handle_pool.read_at(self.offsets[0] + image_len * n, image_len)
 
         # LIF files can be either 8-bit of 16-bit.
         # Because of how the image is read in, all of the raw
@@ -193,23 +411,101 @@ class LifImage:
         else:
             raise ValueError("Unknown bit-depth, please submit a bug report" " on Github")
 
-    def get_plane(self, display_dims=None, c=0, requested_dims=None):
+    def _get_dtype(self):
+        """Returns the NumPy dtype of one pixel, based on the bit depth (private)."""
+        if self.bit_depth[0] == 8:
+            return np.dtype(np.uint8)
+        elif self.bit_depth[0] <= 16:
+            # 12-bit images are stored in 16-bit little-endian containers
+            return np.dtype("<u2")
+        else:
+            raise ValueError("Unknown bit-depth, please submit a bug report" " on Github")
+
+    def _get_item_array(self, n):
         """
-        Gets the specified frame from image.
+        Gets specified item from the image set as a NumPy array (private).
+
+        This is the NumPy equivalent of _get_item(). Rather than reading the plane
+        into a bytes object and wrapping it in a PIL image, this returns a
+        read-only view straight into the LIF memory block.
+
+        Args:
+            n (int): what item (n item in the block) to retrieve
+
+        Returns:
+            Read-only numpy array of shape (y, x)
+        """
+        n = int(n)
+
+        seek_distance = self.channels * self._get_len_nondisplay_dims()
+
+        if n >= seek_distance:
+            raise ValueError("Invalid item trying to be retrieved.")
+
+        shape = (self.dims_n[self.display_dims[1]], self.dims_n[self.display_dims[0]])
+
+        if self.offsets[1] == 0:
+            # Blank (truncated) image. Return zeros, read-only for consistency
+            # with the memory-mapped case.
+            data = np.zeros(shape, dtype=self._get_dtype())
+            data.flags.writeable = False
+            return data
+
+        image_len = int(self.offsets[1] / seek_distance)
+
+        return self._handle_pool.map_array(self.offsets[0] + image_len * n, self._get_dtype(), shape)
+
+    def _get_bytes_inc(self):
+        """
+        Gets the byte increment of each dimension and the byte offset of each channel
+        within the memory block (private).
+
+        These are the BytesInc values from the XML. If they are missing, they are
+        calculated from the usual layout: x, y, then channel (or z then channel
+        if channel_as_second_dim), then the remaining dimensions.
 
-        Known issue: LASX Navigator saves channel as the second channel, this reader
-        will fail in that case.
+        Returns:
+            (dict of {dimension: bytes}, list of channel offsets in bytes)
+        """
+        bytes_inc = self.info.get("bytes_inc_n") or {}
+        channel_inc = [int(d.get("BytesInc", -1)) for d in self.info.get("channel_descriptions", [])]
+        if all(k in bytes_inc for k in self.dims_n) and len(channel_inc) == self.channels \
+                and min(channel_inc, default=0) >= 0:
+            return bytes_inc, channel_inc
+
+        bytes_inc = {}
+        inc = self._get_dtype().itemsize
+        channel_step = None
+        for key, n in self.dims_n.items():
+            if channel_step is None and key not in (1, 2) and not (key == 3 and self.channel_as_second_dim):
+                channel_step = inc
+                inc *= self.channels
+            bytes_inc[key] = inc
+            inc *= n
+        if channel_step is None:
+            channel_step = inc
+
+        return bytes_inc, [k * channel_step for k in range(self.channels)]
+
+    def get_plane_array(self, display_dims=None, c=0, requested_dims=None):
+        """
+        Gets an arbitrary 2D plane (e.g. XY, XZ, YZ or XT) from image as a NumPy array.
+
+        The plane is gathered with one strided view over the memory block, using the
+        byte increments of each dimension, so only the pages containing the plane
+        are read. This works for 16-bit images and channel_as_second_dim layouts.
 
         Args:
             display_dims (tuple): Two value tuple (1, 2) specifying the
                 two dimension plane to return. This will default to the first
                 two dimensions in the LifFile, specified by LifFile.display_dims
             c (int): channel
-            requested_dims (dict): Dictionary indicating the item to be returned,
-                as described by a numerical dictionary, ex: {3: 0, 4: 1}
+            requested_dims (dict): Dictionary indicating the position in the other
+                dimensions, ex: {3: 0, 4: 1}. Missing dimensions default to 0.
 
         Returns:
-            Pillow Image object
+            numpy array of shape (length of display_dims[1], length of display_dims[0]),
+            dtype uint8 or uint16
         """
         c = int(c)
         if requested_dims is None:
@@ -220,107 +516,67 @@ class LifImage:
         elif type(display_dims) is not tuple or len(display_dims) != 2:
             raise ValueError("display_dims must be a two value tuple")
 
-        if requested_dims.keys() in display_dims:
-            warnings.warn(
-                "One or more of the display_dims is in the "
-                "requested_dims dictionary. Currently this has no "
-                "effect. All data from the display_dims will be "
-                "returned."
-            )
+        if display_dims[0] == display_dims[1] or any(d not in self.dims_n for d in display_dims):
+            raise ValueError(f"display_dims {display_dims} must be two different dimensions "
+                             f"of the image {tuple(self.dims_n)}")
 
-        if display_dims != self.display_dims:
-            raise NotImplementedError("Arbitrary dimensions are not yet supported")
-
-        # Set all requested dims to 0:
-        for i in range(1, 11):
-            requested_dims[i] = int(requested_dims.get(i, 0))
+        if c < 0 or c >= self.channels:
+            raise ValueError("Requested channel doesn't exist.")
 
         # Check if any of the dims exceeds what is in the image
-        for i in self.dims_n.keys():
-            if (requested_dims[i] + 1) > self.dims_n.get(i, 0):
+        requested_dims = {int(k): int(v) for k, v in requested_dims.items()}
+        for i, n in requested_dims.items():
+            if i not in display_dims and (n < 0 or n + 1 > self.dims_n.get(i, 1)):
                 raise ValueError(f"Requested frame in dimension {str(i)} " f"doesn't exist")
 
-        if isinstance(self.filename, (str, bytes, os.PathLike)):
-            image = open(self.filename, "rb")
-        elif isinstance(self.filename, io.IOBase):
-            image = self.filename
-        else:
-            raise TypeError(
-                f"expected str, bytes, os.PathLike, or io.IOBase, " f"not {type(self.filename)}"
-            )
-
-        bytes_per_pixel = self.bit_depth[0] // 8
+        dtype = self._get_dtype()
+        shape = (self.dims_n[display_dims[1]], self.dims_n[display_dims[0]])
+        if self.offsets[1] == 0:
+            return np.zeros(shape, dtype=dtype)
+
+        bytes_inc, channel_inc = self._get_bytes_inc()
+        strides = (bytes_inc[display_dims[1]], bytes_inc[display_dims[0]])
+        start = channel_inc[c] + sum(
+            requested_dims.get(k, 0) * bytes_inc[k] for k in self.dims_n if k not in display_dims
+        )
+        span = (shape[0] - 1) * strides[0] + (shape[1] - 1) * strides[1] + dtype.itemsize
+        if start + span > self.offsets[1]:
+            raise ValueError("Requested plane extends beyond the end of the memory block")
+
+        # Map only the bytes spanned by the plane, then gather it with a strided view
+        block = self._handle_pool.map_array(self.offsets[0] + start, np.uint8, (span,))
+        plane = np.ndarray(shape, dtype=dtype, buffer=block, strides=strides)
+        return np.array(plane)
 
-        # Read the specified data into the buffer
-        with open(self.filename, "rb") as image:
-            # Start at the beginning of the specified image
-            image.seek(self.offsets[0])
-            data = b""
+    def get_plane(self, display_dims=None, c=0, requested_dims=None):
+        """
+        Gets the specified frame from image.
 
-            # This code is here for future flexibility, to define a range to return
-            display_x = range(0, self.dims_n[display_dims[0]])
-            display_y = range(0, self.dims_n[display_dims[1]])
+        See get_plane_array(), which returns the same data as a NumPy array.
 
-            dim_len = [
-                self.dims_n[i] for i in self.dims_n.keys()
-            ]  # For calculations below - list of dimension lengths
-            key_idx = range(0, len(dim_len))  # For calculations below
+        Args:
+            display_dims (tuple): Two value tuple (1, 2) specifying the
+                two dimension plane to return. This will default to the first
+                two dimensions in the LifFile, specified by LifFile.display_dims
+            c (int): channel
+            requested_dims (dict): Dictionary indicating the item to be returned,
+                as described by a numerical dictionary, ex: {3: 0, 4: 1}
 
-            # Note, this does not include the first dim, need to index i - 1 later
-            precalc_dim_prod = tuple(
-                [reduce(lambda x, y: x * y, dim_len[:i]) for i in key_idx if len(dim_len[:i]) > 0]
-            )
+        Returns:
+            Pillow Image object
+        """
+        if display_dims is None:
+            display_dims = self.display_dims
 
-            # Define the size of the plane to return
-            total_len = (
-                self.dims_n[display_dims[0]] * self.dims_n[display_dims[1]] * bytes_per_pixel
+        if requested_dims is not None and any(k in display_dims for k in requested_dims):
+            warnings.warn(
+                "One or more of the display_dims is in the "
+                "requested_dims dictionary. Currently this has no "
+                "effect. All data from the display_dims will be "
+                "returned."
             )
-            channel_offset = c * total_len
-
-            # Speedup for the common case where the display_dims are the first two dims
-            if display_dims == self.display_dims:
-                px_pos = 0
-                px_pos += channel_offset
-                for key, i in zip(self.dims_n.keys(), key_idx):
-                    # Multiply requested n by the length of all dims < than n
-                    remaining_dims = dim_len[:i]
-
-                    if len(remaining_dims) > 0:
-                        px_pos += requested_dims[key] * precalc_dim_prod[i - 1] * self.channels
-                    else:
-                        px_pos += requested_dims[key] * self.channels
 
-                if self.offsets[1] == 0:
-                    data = data + b"\00" * total_len
-                else:
-                    image.seek(self.offsets[0] + px_pos * bytes_per_pixel)
-                    data = data + image.read(total_len)
-
-            # Handle the less common case, where the display_dims are arbitrary
-            else:
-                # Todo: Fix channel offset problems
-                for pos_y in display_y:
-                    for pos_x in display_x:
-                        px_pos = 0  # Reset position on every loop
-                        px_pos += channel_offset
-
-                        requested_dims[display_dims[0]] = pos_x
-                        requested_dims[display_dims[1]] = pos_y
-                        for key, i in zip(self.dims_n.keys(), key_idx):
-                            # Multiply requested n dims by the length of all dims below n
-                            # in the hierarchy
-                            remaining_dims = dim_len[:i]
-                            if len(remaining_dims) > 0:
-                                px_pos += (
-                                    requested_dims[key] * precalc_dim_prod[i - 1] * self.channels
-                                )
-                            else:
-                                px_pos += requested_dims[key] * self.channels
-                        if self.offsets[1] == 0:
-                            data = data + b"\00" * 1
-                        else:
-                            image.seek(self.offsets[0] + px_pos)
-                            data = data + image.read(1)
+        data = self.get_plane_array(display_dims, c, requested_dims).tobytes()
 
         # LIF files can be either 8-bit of 16-bit.
         # Because of how the image is read in, all of the raw
@@ -354,6 +610,170 @@ class LifImage:
         Returns:
             Pillow Image object
         """
+        return self._get_item(self._get_frame_item(z, t, c, m))
+
+    def get_frame_array(self, z=0, t=0, c=0, m=0):
+        """
+        Gets the specified frame (z, t, c, m) from image as a NumPy array.
+
+        Unlike get_frame(), this does not copy any data. The returned array is a
+        plain read-only ndarray viewing the file's shared memory map (see
+        _HandlePool.map_array()), so reading costs nothing until pixels are
+        touched. It is not an np.memmap, so it has no filename, offset or
+        flush(). If the file can't be memory-mapped, the frame is read into
+        memory instead. Use np.array() on the result if a writable copy is needed.
+
+        Args:
+            z (int): z position
+            t (int): time point
+            c (int): channel
+            m (int): mosaic image
+
+        Returns:
+            Read-only numpy array of shape (y, x), dtype uint8 or uint16
+        """
+        return self._get_item_array(self._get_frame_item(z, t, c, m))
+
+    def get_region(self, x, y, w, h, z=0, t=0, c=0, m=0):
+        """
+        Gets a rectangular region of the specified frame (z, t, c, m) as a NumPy array.
+
+        Only the rows that intersect the region are read from disk, so this is much
+        faster than get_frame() when looking at a small part of a large tile scan.
+
+        Args:
+            x (int): left edge of region, in pixels
+            y (int): top edge of region, in pixels
+            w (int): width of region, in pixels
+            h (int): height of region, in pixels
+            z (int): z position
+            t (int): time point
+            c (int): channel
+            m (int): mosaic image
+
+        Returns:
+            numpy array of shape (h, w), dtype uint8 or uint16
+        """
+        x, y, w, h = int(x), int(y), int(w), int(h)
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > self.dims.x or y + h > self.dims.y:
+            raise ValueError(f"Requested region ({x}, {y}, {w}, {h}) is outside of image "
+                             f"of size {self.dims.x} x {self.dims.y}")
+
+        frame = self.get_frame_array(z=z, t=t, c=c, m=m)
+        # Copying the slice touches only the pages of the rows within the region
+        return np.array(frame[y:y + h, x:x + w])
+
+    def _get_stack_shape(self):
+        """Returns (z, c, y, x) shape of one z-stack (private)."""
+        return (self.nz, self.channels, self.dims_n[self.display_dims[1]], self.dims_n[self.display_dims[0]])
+
+    def _get_stack_offset(self, t, m):
+        """Returns byte position of the first plane of the z-stack at time t, mosaic tile m (private)."""
+        item = self._get_frame_item(0, t, 0, m)
+        image_len = int(self.offsets[1] / (self.channels * self._get_len_nondisplay_dims()))
+        return self.offsets[0] + image_len * item
+
+    def get_stack(self, c=None, t=0, m=0):
+        """
+        Gets the entire z-stack at time t and mosaic tile m as a NumPy array.
+
+        Like get_frame_array(), this is a read-only view into the LIF memory block,
+        so nothing is read until pixels are accessed. Files where the channel is
+        stored as the second dimension are returned in the same (z, c, y, x) order,
+        as a strided view.
+
+        Args:
+            c (int): channel, or None to return all channels
+            t (int): time point
+            m (int): mosaic image
+
+        Returns:
+            Read-only numpy array of shape (z, c, y, x), or (z, y, x) if c is given
+        """
+        if c is not None:
+            c = int(c)
+            if c >= self.channels:
+                raise ValueError("Requested channel doesn't exist.")
+
+        nz, nc, ny, nx = self._get_stack_shape()
+
+        if self.offsets[1] == 0:
+            # Blank (truncated) image
+            stack = np.zeros((nz, nc, ny, nx), dtype=self._get_dtype())
+            stack.flags.writeable = False
+        elif self.channel_as_second_dim:
+            stack = self._handle_pool.map_array(
+                self._get_stack_offset(t, m), self._get_dtype(), (nc, nz, ny, nx)
+            ).transpose(1, 0, 2, 3)
+        else:
+            stack = self._handle_pool.map_array(
+                self._get_stack_offset(t, m), self._get_dtype(), (nz, nc, ny, nx)
+            )
+
+        if c is None:
+            return stack
+        return stack[:, c]
+
+    def iter_stack_chunks(self, t=0, m=0, max_bytes=DEFAULT_CHUNK_BYTES):
+        """
+        Returns an iterator over the z-stack at time t and mosaic tile m, in chunks
+        of consecutive z-planes, reading the memory block once from start to end.
+
+        Unlike get_stack(), which maps the whole stack, this reads each chunk into a
+        buffer of at most `max_bytes` (but always at least one z-plane with all
+        channels). The same buffer is reused for every chunk, so copy the data
+        if it is needed after the next iteration.
+
+        Args:
+            t (int): time point
+            m (int): mosaic image
+            max_bytes (int): Upper limit on chunk size
+
+        Returns:
+            Iterator of (z_start, chunk) tuples, where chunk is a numpy array of
+            shape (n, c, y, x) holding planes z_start to z_start + n - 1
+        """
+        nz, nc, ny, nx = self._get_stack_shape()
+        dtype = self._get_dtype()
+        plane_bytes = ny * nx * dtype.itemsize
+        chunk_z = int(min(nz, max(1, max_bytes // (plane_bytes * nc))))
+
+        buffer = np.empty((chunk_z, nc, ny, nx), dtype=dtype)
+        if self.channel_as_second_dim:
+            # Channels are not interleaved on disk, so each channel is read separately into here first
+            channel_buffer = np.empty((chunk_z, ny, nx), dtype=dtype)
+
+        if self.offsets[1] == 0:
+            # Blank (truncated) image
+            buffer[:] = 0
+
+        start = self._get_stack_offset(t, m) if self.offsets[1] != 0 else 0
+
+        z = 0
+        while z < nz:
+            n = min(chunk_z, nz - z)
+            chunk = buffer[:n]
+
+            if self.offsets[1] != 0:
+                if self.channel_as_second_dim:
+                    # Each channel is a separate contiguous run of z-planes
+                    for c in range(nc):
+                        self._read_exact(start + (c * nz + z) * plane_bytes, channel_buffer[:n])
+                        chunk[:, c] = channel_buffer[:n]
+                else:
+                    self._read_exact(start + z * nc * plane_bytes, chunk)
+
+            yield z, chunk
+            z += n
+
+    def _read_exact(self, offset, array):
+        """Reads bytes at `offset` into a contiguous array, raising an error if the file is too short (private)."""
+        n = self._handle_pool.readinto_at(offset, memoryview(array).cast("B"))
+        if n != array.nbytes:
+            raise ValueError(f"Unexpected end of file: expected {array.nbytes} bytes at {offset}, found {n}")
+
+    def _get_frame_item(self, z, t, c, m):
+        """Converts (z, t, c, m) to item number within the memory block (private)."""
         if self.display_dims != (1, 2):
             raise ValueError(
                 "Atypical imaging experiment, please use " "get_plane() instead of get_frame()"
@@ -396,7 +816,7 @@ class LifImage:
         if item_requested > total_items:
             raise ValueError("The requested item is after the end of the image")
 
-        return self._get_item(item_requested)
+        return item_requested
 
     def get_iter_t(self, z=0, c=0, m=0):
         """
@@ -535,6 +955,194 @@ def _get_len(handle):
     return file_len
 
 
+class _ScanWindow:
+    """
+    Random access to the bytes of a file, used by the memory block scanner (Private).
+
+    The file is memory-mapped if possible. Otherwise, it is read in large windows,
+    so that parsing many small block headers costs one read() per window rather
+    than several read() and seek() calls per block.
+    """
+
+    def __init__(self, handle, f_len, use_mmap=True, window_bytes=SCAN_WINDOW_BYTES):
+        self._handle = handle
+        self._f_len = f_len
+        self._window_bytes = window_bytes
+        self._buffer = b""
+        self._buffer_start = 0
+        self._mmap = None
+
+        if use_mmap and f_len > 0:
+            try:
+                self._mmap = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                pass
+
+    def get(self, pos, n):
+        """Returns n bytes starting at pos, or fewer if that would go past the end of the file."""
+        if self._mmap is not None:
+            return self._mmap[pos:pos + n]
+
+        buffer_end = self._buffer_start + len(self._buffer)
+        if pos < self._buffer_start or (pos + n > buffer_end and buffer_end < self._f_len):
+            self._handle.seek(pos)
+            self._buffer = self._handle.read(max(n, self._window_bytes))
+            self._buffer_start = pos
+
+        offset = pos - self._buffer_start
+        return self._buffer[offset:offset + n]
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+def _scan_memory_blocks(handle, pos, f_len, use_mmap=True):
+    """
+    Finds byte offsets of all memory blocks, starting at byte position pos (Private).
+
+    Each memory block header is:
+
+        4 bytes     LIF magic bytes
+        4 bytes     (ignored)
+        1 byte      memory byte 0x2a
+        4 or 8 bytes    block length. Older files use 4 bytes, newer ones 8.
+        1 byte      memory byte 0x2a
+        4 bytes     description length, in UTF-16 characters
+        n bytes     description
+        n bytes     block data
+
+    Headers are fetched through _ScanWindow and parsed with struct.unpack_from().
+    The logic is otherwise the same as the original readlif, which read each
+    field with separate read() and seek() calls. Positions are tracked as if we
+    were still reading from a file, i.e. reads stop at the end of the file but
+    seeks can go past it, so that truncated files are handled the same way.
+
+    Returns:
+        (offsets, truncated), where offsets is a list of (data position, block length)
+    """
+    offsets = []
+    truncated = False
+    window = _ScanWindow(handle, f_len, use_mmap)
+
+    try:
+        while pos < f_len:
+            # The longest possible header, so that all fields below can be parsed from one buffer
+            header = window.get(pos, _MAX_BLOCK_HEADER_LEN)
+            i = 0
+            try:
+                # To find offsets, read magic byte
+                check = header[i:i + 4]
+                i += len(check)
+                if check != LIF_MAGIC:
+                    if check == b"\x00\x00\x00\x00" and len(offsets) > 0:
+                        # Newer .lif file, remainder is all 0. This is OK.
+                        break
+                    else:
+                        raise ValueError(f"Invalid memory block: magic bytes at location {pos + i}: expected {LIF_MAGIC}, found {check}")
+
+                i += 4
+                # check for memory byte
+                if header[i:i + 1] != b"\x2a":
+                    i += len(header[i:i + 1])
+                    raise ValueError("Expected LIF memory byte at " + str(pos + i))
+                i += 1
+
+                (block_len,) = struct.unpack_from("<I", header, i)  # will throw struct.error if not enough bytes
+                i += 4
+
+                # Not sure if this works, as I don't have a file to test it on
+                # This is based on the OpenMicroscopy LIF reader written in in java
+                if header[i:i + 1] != b"\x2a":
+                    (block_len,) = struct.unpack_from("<Q", header, i - 4)  # will throw struct.error if not enough bytes
+                    i += 4
+                    if header[i:i + 1] != b"\x2a":
+                        i += len(header[i:i + 1])
+                        raise ValueError("Expected LIF memory byte at " + str(pos + i))
+                i += 1
+
+                (description_len,) = struct.unpack_from("<I", header, i)
+                description_len *= 2
+                i += 4
+
+                if block_len > 0:
+                    offsets.append((pos + i + description_len, block_len))
+
+                pos += i + description_len + block_len
+
+            except ValueError:
+                if pos + i > f_len:  # Seek went past end of file
+                    warnings.warn(
+                        "LIF file is likely truncated. Be advised, "
+                        "it appears that some images are blank. ",
+                        UserWarning
+                    )
+                    truncated = True
+                    pos = f_len
+
+                else:
+                    raise
+    finally:
+        window.close()
+
+    return offsets, truncated
+
+
+def default_cache_dir():
+    """Returns the default folder for the LifFile index cache."""
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "LIFconverter", "index")
+
+
+def clear_index_cache(cache_dir=None):
+    """Deletes all LifFile index cache files. Returns the number of files deleted."""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return 0
+    count = 0
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".json"):
+            os.remove(entry.path)
+            count += 1
+    return count
+
+
+def _cache_path(cache_dir, filename):
+    """Returns name of the index cache file for a given LIF file (Private)."""
+    full_path = os.path.abspath(os.fsdecode(filename))
+    key = hashlib.sha1(os.path.normcase(full_path).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, key + ".json")
+
+
+def _image_info_to_json(info):
+    """Converts an image_list entry into something json can store (Private)."""
+    d = dict(info)
+    # json converts integer dictionary keys to strings, so store these as lists of pairs
+    d["dims_n"] = list(info["dims_n"].items())
+    d["scale_n"] = list(info["scale_n"].items())
+    d["bytes_inc_n"] = list(info["bytes_inc_n"].items())
+    return d
+
+
+def _image_info_from_json(d):
+    """Inverse of _image_info_to_json() (Private)."""
+    info = dict(d)
+    info["dims"] = Dims(*d["dims"])
+    info["display_dims"] = tuple(d["display_dims"])
+    info["dims_n"] = {int(k): v for k, v in d["dims_n"]}
+    info["scale_n"] = {int(k): v for k, v in d["scale_n"]}
+    info["bytes_inc_n"] = {int(k): v for k, v in d["bytes_inc_n"]}
+    info["scale"] = tuple(d["scale"])
+    info["bit_depth"] = tuple(d["bit_depth"])
+    info["mosaic_position"] = [tuple(p) for p in d["mosaic_position"]]
+    return info
+
+
 class LifFile:
     """
     Given a path or buffer to a lif file, returns objects containing
@@ -544,6 +1152,16 @@ class LifFile:
     that is here:
     https://github.com/openmicroscopy/bioformats/blob/master/components/formats-gpl/src/loci/formats/in/LIFReader.java
 
+    To make reopening fast, pass use_cache=True. The offsets and image list are
+    then stored in an index cache, keyed by file name, size and modification
+    time. By default this is ~/.cache/LIFconverter/index (%LOCALAPPDATA% on
+    Windows, see default_cache_dir()), or pass cache_dir to choose another folder.
+
+    For very large XML headers, pass lazy_xml=True. The header is then parsed
+    incrementally, keeping only what image_list needs. The full header is read
+    and parsed again if xml_header, xml_root, LifImage.settings or
+    LifImage.metadata_xml are accessed.
+
     Attributes:
         xml_header (string): The LIF xml header with tons of data
         xml_root (ElementTree): ElementTree XML representation
@@ -551,12 +1169,18 @@ class LifFile:
         num_images (int): Number of images
         image_list (dict): Has the keys: path, folder_name, folder_uuid,
             name, image_id, frames
+        loaded_from_cache (bool): True if the XML header was not parsed because
+            offsets and image list were found in the index cache
 
 
     Example:
         >>> from readlif.reader import LifFile
         >>> new = LifFile('./path/to/file.lif')
 
+        >>> # Or, to make sure the file handle is closed afterwards
+        >>> with LifFile('./path/to/file.lif') as new:
+        >>>     img_0 = new.get_image(0)
+
         >>> for image in new.get_iter_image():
         >>>     for frame in image.get_iter_t():
         >>>         frame.image_info['name']
@@ -568,31 +1192,21 @@ class LifFile:
         >>>     plane = img_0.get_plane(requested_dims = {4: i})
     """
 
-    def _recursive_memblock_is_image(self, tree, return_list=None):
-        """Creates list of TRUE or FALSE if memblock is image"""
-
-        if return_list is None:
-            return_list = []
-
-        children = tree.findall("./Children/Element")
-        if len(children) < 1:  # Fix for 'first round'
-            children = tree.findall("./Element")
-        for item in children:
-            has_sub_children = len(item.findall("./Children/Element/Data")) > 0
-            is_image = len(item.findall("./Data/Image")) > 0
-
-            # Check to see if the Memblock idnetified in the XML actually has a size,
-            # otherwise it won't have an offset
-            if int(item.find("./Memory").attrib["Size"]) > 0:
-                return_list.append(is_image)
-
-            if has_sub_children:
-                self._recursive_memblock_is_image(item, return_list)
-
-        return return_list
-
-    def _recursive_image_find(self, tree, return_list=None, path=""):
-        """Creates list of images by parsing the XML header recursively"""
+    def _build_element_index(self, tree, return_list=None, path=""):
+        """
+        Creates a list with one entry for every element in the XML header, by
+        parsing it recursively (private).
+
+        This is the only place the XML tree is walked. Each element is visited
+        once, and each entry is a dict with the keys:
+
+            node: The XML element
+            path: Path of the element within the LIF file
+            memory_size (int): Size of its memory block. Elements with size 0
+                have no memory block, and hence no offset.
+            image (dict): Image descriptor, as stored in image_list, or None if
+                this element is not an image.
+        """
 
         if return_list is None:
             return_list = []
@@ -607,215 +1221,428 @@ class LifFile:
                 appended_path = folder_name
             else:
                 appended_path = path + "/" + folder_name
+
+            # Check to see if the Memblock identified in the XML actually has a size,
+            # otherwise it won't have an offset
+            memory = item.find("./Memory")
+            memory_size = int(memory.attrib["Size"]) if memory is not None else 0
+
+            image_node = item.find("./Data/Image")
+
+            return_list.append({
+                "node": item,
+                "path": appended_path,
+                "memory_size": memory_size,
+                "image": self._parse_image(item, image_node, path, memory_size) if image_node is not None else None,
+            })
+
             # This finds empty folders
-            has_sub_children = len(item.findall("./Children/Element/Data")) > 0
-
-            is_image = len(item.findall("./Data/Image")) > 0
-
-            if is_image:
-                # If additional XML data extraction is needed, add it here.
-
-                # Find the dimensions, get them in order
-                dims = item.findall("./Data/Image/ImageDescription/" "Dimensions/")
-
-                # Get first two dims, if that fails, set X, Y
-                # Todo: Check a 1-d image
-                try:
-                    dim1 = int(dims[0].attrib["DimID"])
-                    dim2 = int(dims[1].attrib["DimID"])
-                except (AttributeError, IndexError):
-                    dim1 = 1
-                    dim2 = 2
-
-                dims_dict = {
-                    int(d.attrib["DimID"]): int(d.attrib["NumberOfElements"]) for d in dims
-                }
-
-                # Get the scale from each image
-                scale_dict = {}
-                for d in dims:
-                    # Length is not always present, need a try-except
-                    dim_n = int(d.attrib["DimID"])
-                    try:
-                        len_n = float(d.attrib["Length"])
-
-                        # other conversion factor for times needed
-                        # returns scale in frames per second
-                        if dim_n == 4:
-                            scale_dict[dim_n] = (int(dims_dict[dim_n]) - 1) / float(len_n)
-                        # Convert from meters to micrometers
-                        else:
-                            scale_dict[dim_n] = (int(dims_dict[dim_n]) - 1) / (float(len_n) * 10**6)
-                    except (AttributeError, ZeroDivisionError):
-                        scale_dict[dim_n] = None
-
-                # Hack-y fix to determine if the channel dimension cones after Z
-                # Check if there even is a z dimension
-                if 3 in dims_dict.keys() and len(dims) > 2:
-                    channels = item.findall(
-                        "./Data/Image/ImageDescription/Channels/ChannelDescription"
-                    )
-                    channel_max = max([int(c.attrib["BytesInc"]) for c in channels])
+            has_sub_children = item.find("./Children/Element/Data") is not None
+
+            # An image can have sub_children, it is not mutually exclusive
+            if has_sub_children:
+                self._build_element_index(item, return_list, appended_path)
 
-                    bytes_inc_channel = channel_max
-                    cytes_inc_z = int(dims[2].attrib["BytesInc"])
+        return return_list
 
-                    channel_as_second_dim = bytes_inc_channel > cytes_inc_z
+    def _stream_element_index(self, f, n_bytes):
+        """
+        Same as _build_element_index(), but parses the XML header incrementally
+        while reading it from the file, for lazy_xml mode (private).
+
+        Only the parts of the tree that _parse_image() needs are kept (see
+        _INDEX_XML_TAGS), and each element is discarded as soon as its entry is
+        complete, so memory use does not grow with the size of the header. As a
+        result, entries have no XML node, and image descriptors have no
+        "settings". Both are loaded from the full header when first requested.
+        """
+        parser = ET.XMLPullParser(events=("start", "end"))
+        # LIF headers are little-endian UTF-16, normally without byte order mark
+        decoder = None
+
+        return_list = []
+        # One item per open XML element: [element, keep element?, entry context if this is an Element]
+        stack = []
+
+        def handle_events():
+            for event, elem in parser.read_events():
+                if event == "start":
+                    if not stack:
+                        stack.append([elem, True, None])
+                        continue
+
+                    parent, parent_keep, _ = stack[-1]
+                    if len(stack) == 1:
+                        # Root only has Element children we care about. Fix for 'first round'.
+                        keep = elem.tag == "Element"
+                    else:
+                        keep = parent_keep and elem.tag in _INDEX_XML_TAGS.get(parent.tag, ())
+
+                    context = None
+                    if keep and elem.tag == "Element":
+                        # Reserve slot, so that entries are in the same order as _build_element_index()
+                        parent_context = stack[-2][2] if len(stack) >= 2 else None
+                        if parent_context is None:
+                            path = ""
+                        else:
+                            path = parent_context["path"]
+                        folder_name = elem.attrib["Name"]
+                        context = {
+                            "index": len(return_list),
+                            "parent_path": path,
+                            "path": folder_name if path == "" else path + "/" + folder_name,
+                            "has_sub_children": False,
+                            "parent": parent_context,
+                        }
+                        return_list.append(None)
+                    stack.append([elem, keep, context])
 
                 else:
-                    channel_as_second_dim = False
-
-                # This code block is to maintain compatibility with programs
-                # written before 0.5.0
-
-                # Known LIF dims:
-                # 1: x
-                # 2: y
-                # 3: z
-                # 4: t
-                # 5: detection wavelength
-                # 6: Unknown
-                # 7: Unknown
-                # 8: Unknown
-                # 9: illumination wavelength
-                # 10: Mosaic tile
-
-                # The default value needs to be 1, because even if a dimension
-                # is missing, it still has to exist. For example, an image that
-                # is an x-scan still has one y-dimension.
-                dim_x = dims_dict.get(1, 1)
-                dim_y = dims_dict.get(2, 1)
-                dim_z = dims_dict.get(3, 1)
-                dim_t = dims_dict.get(4, 1)
-                dim_m = dims_dict.get(10, 1)
-
-                scale_x = scale_dict.get(1, None)
-                scale_y = scale_dict.get(2, None)
-                scale_z = scale_dict.get(3, None)
-                scale_t = scale_dict.get(4, None)
-
-                # Determine number of channels
-                channel_list = item.findall(
-                    "./Data/Image/ImageDescription/Channels/ChannelDescription"
-                )
-                n_channels = int(len(channel_list))
-                # Iterate over each channel, get the resolution
-                bit_depth = tuple([int(c.attrib["Resolution"]) for c in channel_list])
-
-                # Get the position data if the image is tiled
-                m_pos_list = []
-                if dim_m > 1:
-                    for tile in item.findall("./Data/Image/Attachment/Tile"):
-                        FieldX = int(tile.attrib["FieldX"])
-                        FieldY = int(tile.attrib["FieldY"])
-                        PosX = float(tile.attrib["PosX"])
-                        PosY = float(tile.attrib["PosY"])
+                    elem, keep, context = stack.pop()
+
+                    if context is not None:
+                        memory = elem.find("./Memory")
+                        memory_size = int(memory.attrib["Size"]) if memory is not None else 0
+                        image_node = elem.find("./Data/Image")
+                        has_data = elem.find("./Data") is not None
+
+                        return_list[context["index"]] = {
+                            "node": None,
+                            "path": context["path"],
+                            "memory_size": memory_size,
+                            "image": self._parse_image(elem, image_node, context["parent_path"], memory_size)
+                            if image_node is not None else None,
+                        }
+                        if image_node is not None:
+                            # Will be read from the full XML on first access, see LifImage.settings
+                            del return_list[context["index"]]["image"]["settings"]
+
+                        if not context["has_sub_children"]:
+                            # _build_element_index() doesn't descend into elements without sub-children
+                            del return_list[context["index"] + 1:]
+
+                        if has_data and context["parent"] is not None:
+                            context["parent"]["has_sub_children"] = True
+
+                    if stack and (context is not None or not keep):
+                        # Done with this element. The parser may already have attached later siblings to the
+                        # parent, so remove the element itself rather than the parent's last child
+                        stack[-1][0].remove(elem)
+
+        remaining = n_bytes
+        while remaining > 0:
+            data = f.read(min(remaining, XML_CHUNK_BYTES))
+            if not data:
+                break
+            remaining -= len(data)
+            if decoder is None:
+                has_bom = data[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+                decoder = codecs.getincrementaldecoder("utf-16" if has_bom else "utf-16-le")()
+            parser.feed(decoder.decode(data, final=(remaining <= 0)))
+            handle_events()
+
+        parser.close()
+        handle_events()
 
-                        m_pos_list.append((FieldX, FieldY, PosX, PosY))
+        return return_list
 
-                Dims = namedtuple("Dims", "x y z t m")
+    @staticmethod
+    def _parse_image(item, image_node, path, memory_size):
+        """Creates image descriptor from the Data/Image XML element of an image (private)."""
+
+        # If additional XML data extraction is needed, add it here.
+
+        # Find the dimensions, get them in order
+        dims = image_node.findall("./ImageDescription/Dimensions/")
+
+        # Get first two dims, if that fails, set X, Y
+        # Todo: Check a 1-d image
+        try:
+            dim1 = int(dims[0].attrib["DimID"])
+            dim2 = int(dims[1].attrib["DimID"])
+        except (AttributeError, IndexError):
+            dim1 = 1
+            dim2 = 2
+
+        dims_dict = {
+            int(d.attrib["DimID"]): int(d.attrib["NumberOfElements"]) for d in dims
+        }
+
+        # Byte increment of each dimension within the memory block
+        bytes_inc_dict = {
+            int(d.attrib["DimID"]): int(d.attrib["BytesInc"]) for d in dims if "BytesInc" in d.attrib
+        }
+
+        # Get the scale from each image
+        scale_dict = {}
+        for d in dims:
+            # Length is not always present, need a try-except
+            dim_n = int(d.attrib["DimID"])
+            try:
+                len_n = float(d.attrib["Length"])
 
-                settings = item.findall("./Data/Image/Attachment/ATLConfocalSettingDefinition")
-                if len(settings) > 0:
-                    settings = settings[0].attrib
+                # other conversion factor for times needed
+                # returns scale in frames per second
+                if dim_n == 4:
+                    scale_dict[dim_n] = (int(dims_dict[dim_n]) - 1) / float(len_n)
+                # Convert from meters to micrometers
                 else:
-                    settings = {}
-
-                data_dict = {
-                    "dims": Dims(dim_x, dim_y, dim_z, dim_t, dim_m),
-                    "display_dims": (dim1, dim2),
-                    "dims_n": dims_dict,
-                    "scale_n": scale_dict,
-                    "path": str(path + "/"),
-                    "name": "/".join((str(path + "/") + item.attrib["Name"]).split("/")[1:]),
-                    "channels": n_channels,
-                    "scale": (scale_x, scale_y, scale_z, scale_t),
-                    "bit_depth": bit_depth,
-                    "mosaic_position": m_pos_list,
-                    "channel_as_second_dim": channel_as_second_dim,
-                    "settings": settings,
-                    # "metadata_xml": item
-                }
-
-                return_list.append(data_dict)
+                    scale_dict[dim_n] = (int(dims_dict[dim_n]) - 1) / (float(len_n) * 10**6)
+            except (AttributeError, ZeroDivisionError):
+                scale_dict[dim_n] = None
 
-            # An image can have sub_children, it is not mutually exclusive
-            if has_sub_children:
-                self._recursive_image_find(item, return_list, appended_path)
+        channel_list = image_node.findall("./ImageDescription/Channels/ChannelDescription")
 
-        return return_list
+        # Hack-y fix to determine if the channel dimension cones after Z
+        # Check if there even is a z dimension
+        if 3 in dims_dict.keys() and len(dims) > 2:
+            channel_max = max([int(c.attrib["BytesInc"]) for c in channel_list])
 
-    def __init__(self, filename):
-        self.filename = filename
+            bytes_inc_channel = channel_max
+            cytes_inc_z = int(dims[2].attrib["BytesInc"])
+
+            channel_as_second_dim = bytes_inc_channel > cytes_inc_z
 
-        if isinstance(filename, (str, bytes, os.PathLike)):
-            f = open(filename, "rb")
-        elif isinstance(filename, io.IOBase):
-            f = filename
         else:
-            raise TypeError(
-                f"expected str, bytes, os.PathLike, or io.IOBase, " f"not {type(filename)}"
-            )
-        f_len = _get_len(f)
+            channel_as_second_dim = False
+
+        # This code block is to maintain compatibility with programs
+        # written before 0.5.0
+
+        # Known LIF dims:
+        # 1: x
+        # 2: y
+        # 3: z
+        # 4: t
+        # 5: detection wavelength
+        # 6: Unknown
+        # 7: Unknown
+        # 8: Unknown
+        # 9: illumination wavelength
+        # 10: Mosaic tile
+
+        # The default value needs to be 1, because even if a dimension
+        # is missing, it still has to exist. For example, an image that
+        # is an x-scan still has one y-dimension.
+        dim_x = dims_dict.get(1, 1)
+        dim_y = dims_dict.get(2, 1)
+        dim_z = dims_dict.get(3, 1)
+        dim_t = dims_dict.get(4, 1)
+        dim_m = dims_dict.get(10, 1)
+
+        scale_x = scale_dict.get(1, None)
+        scale_y = scale_dict.get(2, None)
+        scale_z = scale_dict.get(3, None)
+        scale_t = scale_dict.get(4, None)
+
+        # Determine number of channels
+        n_channels = int(len(channel_list))
+        # Iterate over each channel, get the resolution
+        bit_depth = tuple([int(c.attrib["Resolution"]) for c in channel_list])
+
+        # Attachments hold tile positions, display scaling and microscope settings
+        m_pos_list = []
+        channel_scaling = []
+        settings = None
+        for attachment in image_node.findall("./Attachment"):
+            for child in attachment:
+                if child.tag == "Tile":
+                    # Get the position data if the image is tiled
+                    if dim_m > 1:
+                        FieldX = int(child.attrib["FieldX"])
+                        FieldY = int(child.attrib["FieldY"])
+                        PosX = float(child.attrib["PosX"])
+                        PosY = float(child.attrib["PosY"])
 
-        _check_magic(f)  # read 4 byte, check for magic bytes
-        f.seek(8)
-        _check_mem(f)  # read 1 byte, check for memory byte
+                        m_pos_list.append((FieldX, FieldY, PosX, PosY))
+                elif child.tag == "ChannelScalingInfo":
+                    channel_scaling.append(dict(child.attrib))
+                elif child.tag == "ATLConfocalSettingDefinition" and settings is None:
+                    settings = dict(child.attrib)
+
+        if settings is None:
+            settings = {}
+
+        data_dict = {
+            "dims": Dims(dim_x, dim_y, dim_z, dim_t, dim_m),
+            "display_dims": (dim1, dim2),
+            "dims_n": dims_dict,
+            "bytes_inc_n": bytes_inc_dict,
+            "scale_n": scale_dict,
+            "path": str(path + "/"),
+            "name": "/".join((str(path + "/") + item.attrib["Name"]).split("/")[1:]),
+            "channels": n_channels,
+            "scale": (scale_x, scale_y, scale_z, scale_t),
+            "bit_depth": bit_depth,
+            "mosaic_position": m_pos_list,
+            "channel_as_second_dim": channel_as_second_dim,
+            "settings": settings,
+            # Attributes of each ChannelDescription, e.g. LUTName
+            "channel_descriptions": [dict(c.attrib) for c in channel_list],
+            # Attributes of each ChannelScalingInfo, e.g. BlackValue and WhiteValue
+            "channel_scaling": channel_scaling,
+            "memory_size": memory_size,
+        }
+
+        return data_dict
+
+    def __init__(self, filename, max_handles=DEFAULT_MAX_HANDLES, use_cache=False, cache_dir=None, lazy_xml=False):
+        self.filename = filename
+        self._lazy_xml = lazy_xml
+
+        # The XML header is only read and parsed when first needed, see xml_header and xml_root
+        self._xml_header = None
+        self._xml_root = None
+        self._element_index = None
+        self._image_nodes = None
+
+        # All file access by this object and its LifImages goes through this pool,
+        # so the file is opened once and the descriptor is reused. Call close(), or
+        # use LifFile as a context manager, to release it.
+        self._handle_pool = _HandlePool(filename, max_handles)
+
+        # Only files given by name can be cached, since we need the name, size and timestamp as key
+        if use_cache and isinstance(filename, (str, bytes, os.PathLike)):
+            if cache_dir is None:
+                cache_dir = default_cache_dir()
+            self._cache_path = _cache_path(cache_dir, filename)
+        else:
+            self._cache_path = None
 
-        header_len = _read_int(f)  # length of the xml header
-        self.xml_header = f.read(header_len * 2).decode("utf-16")
-        self.xml_root = ET.fromstring(self.xml_header)
+        self.loaded_from_cache = self._load_cache()
+        if self.loaded_from_cache:
+            return
 
-        self.offsets = []
-        truncated = False
-        while f.tell() < f_len:
-            try:
-                # To find offsets, read magic byte
-                check = f.read(4)
-                if check != LIF_MAGIC:
-                    if check == b"\x00\x00\x00\x00" and len(self.offsets) > 0:
-                        # Newer .lif file, remainder is all 0. This is OK.
-                        break
-                    else:
-                        raise ValueError(f"Invalid memory block: magic bytes at location {f.tell()}: expected {LIF_MAGIC}, found {check}")
+        try:
+            with self._handle_pool.borrow() as f:
+                self._scan_file(f)
+        except BaseException:
+            self._handle_pool.close()
+            raise
 
-                f.seek(4, 1)
-                _check_mem(f)  # read 1 byte, check for memory byte
+        self._save_cache()
 
-                block_len = _read_int(f)
+    def _get_cache_key(self):
+        """Returns (size, modification time) of the file, used to detect stale cache entries (private)."""
+        st = os.stat(self.filename)
+        return st.st_size, st.st_mtime_ns
 
-                # Not sure if this works, as I don't have a file to test it on
-                # This is based on the OpenMicroscopy LIF reader written in in java
-                if not _check_mem(f, True):
-                    f.seek(-5, 1)
-                    block_len = _read_long(f) # will throw struct.error if not enough bytes
-                    _check_mem(f)
+    def _load_cache(self):
+        """
+        Loads offsets and image list from the index cache (private). This skips
+        the XML parsing and memory block scanning in _scan_file().
 
-                description_len = _read_int(f) * 2
+        Returns:
+            True if successful, False if there is no valid cache entry for this file.
+        """
+        if self._cache_path is None:
+            return False
 
-                if block_len > 0:
-                    self.offsets.append((f.tell() + description_len, block_len))
+        try:
+            with open(self._cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
 
-                f.seek(description_len + block_len, 1)
+            if cache["version"] != INDEX_CACHE_VERSION or \
+                    (cache["size"], cache["mtime_ns"]) != self._get_cache_key():
+                # File has changed since it was cached
+                return False
 
-            except ValueError:
-                if f.tell() > f_len:  # Seek went past end of file
-                    truncation_begin = f_len
-                    warnings.warn(
-                    	"LIF file is likely truncated. Be advised, "
-                    	"it appears that some images are blank. ",
-                    	UserWarning
-                    )
-                    truncated = True
-                    f.seek(0, 2)
+            self._header_pos = tuple(cache["header_pos"])
+            self.offsets = [tuple(o) for o in cache["offsets"]]
+            self.image_list = [_image_info_from_json(d) for d in cache["image_list"]]
+            self.num_images = len(self.image_list)
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing or corrupted cache file
+            return False
 
-                else:
-                    raise
+        return True
 
-        if isinstance(filename, (str, bytes, os.PathLike)):
-            f.close()
+    def _save_cache(self):
+        """Writes offsets and image list to the index cache (private). Failure is not an error."""
+        if self._cache_path is None:
+            return
+
+        size, mtime_ns = self._get_cache_key()
+        cache = {
+            "version": INDEX_CACHE_VERSION,
+            "path": os.path.abspath(os.fsdecode(self.filename)),
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "header_pos": self._header_pos,
+            "offsets": self.offsets,
+            "image_list": [_image_info_to_json(d) for d in self.image_list],
+        }
+
+        try:
+            os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+            # Write to temporary file first, so that other processes never see a partially written file
+            tmp_path = f"{self._cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self._cache_path)
+        except OSError as e:
+            warnings.warn(f"Unable to write LIF index cache: {e}")
+
+    @property
+    def xml_header(self):
+        """The LIF xml header with tons of data. Read from file on first access."""
+        if self._xml_header is None:
+            pos, length = self._header_pos
+            self._xml_header = self._handle_pool.read_at(pos, length).decode("utf-16")
+        return self._xml_header
+
+    @property
+    def element_index(self):
+        """
+        List with one dict per XML element, see _build_element_index(). Built on
+        first access if the file was loaded from the index cache.
+        """
+        if self._element_index is None:
+            self._element_index = self._build_element_index(self.xml_root)
+        return self._element_index
+
+    def get_image_xml(self, img_n=0):
+        """
+        Returns the XML element of the specified image, e.g. to read metadata
+        that is not part of image_list.
+        """
+        img_n = int(img_n)
+        if img_n >= len(self.image_list):
+            raise ValueError("There are not that many images!")
+        if self._image_nodes is None:
+            self._image_nodes = [e["node"] for e in self.element_index if e["image"] is not None]
+        return self._image_nodes[img_n]
+
+    @property
+    def xml_root(self):
+        """ElementTree XML representation of xml_header. Parsed on first access."""
+        if self._xml_root is None:
+            self._xml_root = ET.fromstring(self.xml_header)
+        return self._xml_root
+
+    def _scan_file(self, f):
+        """Reads the XML header and memory block offsets, and builds the image list (private)."""
+        f_len = _get_len(f)
+
+        _check_magic(f)  # read 4 byte, check for magic bytes
+        f.seek(8)
+        _check_mem(f)  # read 1 byte, check for memory byte
+
+        header_len = _read_int(f)  # length of the xml header
+        self._header_pos = (f.tell(), header_len * 2)
+        if self._lazy_xml:
+            # Extract only what image_list needs, without keeping the header or building the full tree
+            element_index = self._stream_element_index(f, header_len * 2)
+        else:
+            self._xml_header = f.read(header_len * 2).decode("utf-16")
+            self._xml_root = ET.fromstring(self._xml_header)
+            element_index = self._build_element_index(self.xml_root)
+            self._element_index = element_index
+
+        self.offsets, truncated = _scan_memory_blocks(f, sum(self._header_pos), f_len)
+        truncation_begin = f_len
 
-        self.image_list = self._recursive_image_find(self.xml_root)
+        self.image_list = [e["image"] for e in element_index if e["image"] is not None]
 
         # If the image is truncated we need to manually add the offsets because
         # the LIF magic bytes aren't present to guide the location.
@@ -829,7 +1656,7 @@ class LifFile:
 
         # Fix for new LASX version
         if len(self.offsets) - len(self.image_list) > 0:
-            is_image_bool_list = self._recursive_memblock_is_image(self.xml_root)
+            is_image_bool_list = [e["image"] is not None for e in element_index if e["memory_size"] > 0]
             if False in is_image_bool_list:
                 from itertools import compress
                 self.offsets = list(compress(self.offsets, is_image_bool_list))
@@ -843,6 +1670,27 @@ class LifFile:
         else:
             self.num_images = len(self.image_list)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the file handles held by this object. Arrays returned by
+        get_frame_array() stay valid until they are garbage collected.
+
+        The object can still be used after closing, in which case the file is
+        reopened on demand.
+        """
+        self._handle_pool.close()
+
+    @property
+    def io_stats(self):
+        """Dict with the number of file opens, reads and memory maps made so far for this file."""
+        return self._handle_pool.stats()
+
     def __repr__(self):
         if self.num_images == 1:
             return repr("LifFile object with " + str(self.num_images) + " image")
@@ -865,7 +1713,8 @@ class LifFile:
             raise ValueError("There are not that many images!")
         offsets = self.offsets[img_n]
         image_info = self.image_list[img_n]
-        return LifImage(image_info, offsets, self.filename)
+        return LifImage(image_info, offsets, self.filename, self._handle_pool,
+                        partial(self.get_image_xml, img_n))
 
     def get_image_by_name(self, name):
         """
@@ -900,5 +1749,6 @@ class LifFile:
         while img_n < len(self.image_list) and img_n < len(self.offsets):
             offsets = self.offsets[img_n]
             image_info = self.image_list[img_n]
-            yield LifImage(image_info, offsets, self.filename)
+            yield LifImage(image_info, offsets, self.filename, self._handle_pool,
+                           partial(self.get_image_xml, img_n))
             img_n += 1
@@ -0,0 +1,84 @@
+"""
+Lookup tables for rescaling image intensity with respect to the black and white levels set in LASX.
+
+Pixels are 8 or 16 bits, so every possible input value fits in a table of 256 or 65536 entries.
+Building the table once and indexing it is faster than converting every pixel to float,
+and the tables are cached so that images with the same scaling share them.
+"""
+from functools import lru_cache
+
+import numpy as np
+import cv2  # install with pip install opencv-python
+
+
+@lru_cache(maxsize=64)
+def get_lut(black_value, white_value, max_val, dtype, depth_factor=1, out_dtype=None, weight=1):
+    """
+    Returns read-only lookup table mapping every raw pixel value to its output value.
+
+    Values are calculated exactly as the old per-pixel float path did:
+    (value - round(black_value * max_val)) / (white_value - black_value), clipped to [0, max_val],
+    then truncated to dtype. If depth_factor is not 1, the result is then multiplied by it,
+    clipped to the range of out_dtype and truncated again, which is how write_file() used to
+    reduce 16 and 12-bit images to 8-bit for JPG, and expand 12-bit images for TIFF.
+    Finally, the result is multiplied by weight and truncated, for merging channels.
+
+    Args:
+        black_value (float): BlackValue from ChannelScalingInfo, in range 0-1
+        white_value (float): WhiteValue from ChannelScalingInfo, in range 0-1
+        max_val (int): maximum rescaled value, e.g. 255 or 65535
+        dtype: numpy dtype of the raw pixels, uint8 or uint16
+        depth_factor (float): factor for converting bit depth, e.g. 1/256 for 16 to 8-bit
+        out_dtype: numpy dtype of the output. Defaults to dtype.
+        weight (float): weight of this channel in an output component, in range 0-1, see compositor.py
+
+    Returns:
+        numpy array with one entry per possible value of dtype
+    """
+    dtype = np.dtype(dtype)
+    out_dtype = dtype if out_dtype is None else np.dtype(out_dtype)
+    scale = 1.0 / (white_value - black_value)
+    offset1 = round(black_value * max_val)  # Using round() because that seems to match LASX
+
+    table = (np.arange(np.iinfo(dtype).max + 1, dtype=float) - offset1) * scale
+    # Truncate underflow and overflow values.
+    table[table < 0] = 0
+    table[table > max_val] = max_val
+    table = table.astype(dtype)
+
+    if depth_factor != 1:
+        out_max = np.iinfo(out_dtype).max
+        table = table * depth_factor
+        table[table > out_max] = out_max
+    lut = table.astype(out_dtype)
+
+    if weight != 1:
+        lut = (lut * weight).astype(out_dtype)
+
+    # Shared between callers, so must not be modified
+    lut.flags.writeable = False
+    return lut
+
+
+def apply_lut(ar, lut, out=None):
+    """
+    Maps every pixel of ar through lut with a single np.take().
+
+    Args:
+        ar (numpy array): raw pixels, uint8 or uint16
+        lut (numpy array): table from get_lut()
+        out (numpy array): preallocated output of the same shape as ar, with dtype of lut.
+            May be ar itself, to rescale in place. If None, a new array is allocated.
+
+    Returns:
+        Rescaled array (out, if given)
+    """
+    if lut.dtype == np.uint8 and ar.dtype == np.uint8:
+        # OpenCV's table lookup is several times faster than numpy, but only supports 8-bit input
+        if out is None:
+            return cv2.LUT(ar, lut)
+        cv2.LUT(ar, lut, dst=out)
+        return out
+
+    # mode="clip" avoids buffering the output. Indices are always within the table anyway.
+    return np.take(lut, ar, out=out, mode="clip")
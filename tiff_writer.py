@@ -0,0 +1,468 @@
+"""
+Streaming TIFF writer, for images too big to hold in memory.
+
+OpenCV's imwrite() needs the whole image at once. These writers instead take the image a few rows
+at a time, write each strip or tile to disk as soon as it is complete, and write the directory of
+offsets at the end. StripTiffWriter writes a plain TIFF, as BigTIFF if the file could reach 4 GB.
+PyramidTiffWriter writes a tiled, multi-resolution OME-TIFF for viewers of huge images.
+"""
+import os
+import struct
+import zlib
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+# TIFF field types
+ASCII = 2
+SHORT = 3
+LONG = 4
+LONG8 = 16
+IFD8 = 18
+_TYPE_FORMATS = {SHORT: "H", LONG: "I", LONG8: "Q", IFD8: "Q"}
+
+COMPRESSION_NONE = 1
+COMPRESSION_DEFLATE = 8
+
+# Approximate size of each strip of rows in the file, before compression
+DEFAULT_STRIP_BYTES = 256 * 1024
+
+# Width and height of tiles in pyramidal files
+DEFAULT_TILE_SIZE = 256
+
+# Leave room for the directory and for compressed data that ends up bigger than raw data
+_CLASSIC_LIMIT = 2 ** 32 - 2 ** 26
+
+
+class StripTiffWriter:
+    """
+    Writes a TIFF file one block of rows at a time, from top to bottom.
+
+    Example:
+        with StripTiffWriter(path, width, height, np.uint16) as writer:
+            for row in range(0, height, writer.rows_per_strip):
+                writer.write(image_rows(row, writer.rows_per_strip))
+
+    Args:
+        path (str): output file
+        width (int): image width in pixels
+        height (int): image height in pixels
+        dtype: numpy dtype of pixels, uint8 or uint16
+        samples (int): 3 for color images, 1 for grayscale
+        bgr (bool): color rows are in OpenCV's BGR order, and will be reversed to RGB when written
+        compression (str): None, or "deflate" for zlib compression of each strip
+        compress_level (int): zlib level, from 1 (fastest) to 9 (smallest)
+        rows_per_strip (int): rows in each strip of the file. Default is about DEFAULT_STRIP_BYTES per strip.
+        bigtiff (bool): write BigTIFF. If None, BigTIFF is only used if the file could exceed 4 GB.
+    """
+
+    def __init__(self, path, width, height, dtype, samples=3, bgr=True, compression=None, compress_level=1,
+                 rows_per_strip=None, bigtiff=None):
+        if compression not in (None, "deflate"):
+            raise ValueError(f"Unsupported compression {compression}")
+
+        self.path = path
+        self.width = int(width)
+        self.height = int(height)
+        self.dtype = np.dtype(dtype)
+        self.samples = samples
+        self.bgr = bgr and samples == 3
+        self.compression = compression
+        self.compress_level = compress_level
+
+        row_bytes = self.width * self.samples * self.dtype.itemsize
+        if rows_per_strip is None:
+            rows_per_strip = DEFAULT_STRIP_BYTES // max(1, row_bytes)
+        self.rows_per_strip = max(1, min(int(rows_per_strip), self.height))
+
+        if bigtiff is None:
+            bigtiff = row_bytes * self.height >= _CLASSIC_LIMIT
+        self.bigtiff = bigtiff
+
+        self.rows_written = 0
+        self._strip_offsets = []
+        self._strip_byte_counts = []
+
+        self._file = open(path, "wb")
+        _write_header(self._file, self.bigtiff)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, rows):
+        """
+        Appends rows to the image.
+
+        Args:
+            rows (numpy array): shape (n, width, samples), or (n, width) for grayscale.
+                n must be a multiple of rows_per_strip, except for the last rows of the image.
+        """
+        n = rows.shape[0]
+        if rows.shape[1] != self.width or rows.dtype != self.dtype:
+            raise ValueError(f"Expected rows of width {self.width} and type {self.dtype}, "
+                             f"got width {rows.shape[1]} and type {rows.dtype}")
+        if self.rows_written + n > self.height:
+            raise ValueError(f"Too many rows, image height is {self.height}")
+        if n % self.rows_per_strip != 0 and self.rows_written + n != self.height:
+            raise ValueError(f"Number of rows must be a multiple of {self.rows_per_strip}, except at end of image")
+
+        for start in range(0, n, self.rows_per_strip):
+            data = _encode(rows[start:start + self.rows_per_strip], self.bgr, self.compression, self.compress_level)
+            self._strip_offsets.append(self._file.tell())
+            self._strip_byte_counts.append(len(data))
+            self._file.write(data)
+
+        self.rows_written += n
+
+    def close(self):
+        """Writes the image directory and closes the file. All rows must have been written."""
+        if self._file is None:
+            return
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+
+        offset_type = LONG8 if self.bigtiff else LONG
+        bits = [self.dtype.itemsize * 8] * self.samples
+        compression = COMPRESSION_DEFLATE if self.compression == "deflate" else COMPRESSION_NONE
+        photometric = 2 if self.samples == 3 else 1  # RGB, or grayscale with 0 as black
+
+        # Must be sorted by tag number
+        tags = [
+            (256, LONG, [self.width]),  # ImageWidth
+            (257, LONG, [self.height]),  # ImageLength
+            (258, SHORT, bits),  # BitsPerSample
+            (259, SHORT, [compression]),  # Compression
+            (262, SHORT, [photometric]),  # PhotometricInterpretation
+            (273, offset_type, self._strip_offsets),  # StripOffsets
+            (277, SHORT, [self.samples]),  # SamplesPerPixel
+            (278, LONG, [self.rows_per_strip]),  # RowsPerStrip
+            (279, offset_type, self._strip_byte_counts),  # StripByteCounts
+            (284, SHORT, [1]),  # PlanarConfiguration: contiguous
+        ]
+        try:
+            _set_first_directory(self._file, _write_directory(self._file, tags, self.bigtiff), self.bigtiff)
+        except BaseException:
+            self.abort()
+            raise
+
+        self._file.close()
+        self._file = None
+
+    def abort(self):
+        """Closes and deletes an unfinished file, so it can't be mistaken for a converted image."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self.path)
+
+
+class PyramidTiffWriter:
+    """
+    Writes a tiled, multi-resolution OME-TIFF file, one block of rows at a time, from top to bottom.
+
+    Viewers like QuPath and napari only read the tiles they display, at the resolution they display
+    them, so even huge images open instantly. Each reduced resolution level is half the size of the
+    previous one, made by averaging 2 x 2 pixels. Levels are built as rows arrive, so only one row of
+    tiles per level is held in memory. Levels are stored as SubIFDs of the full resolution image,
+    as specified by OME-TIFF. The file is always BigTIFF.
+
+    Args:
+        path (str): output file, usually ending in .ome.tif
+        width (int): image width in pixels
+        height (int): image height in pixels
+        dtype: numpy dtype of pixels, uint8 or uint16
+        tile_size (int): width and height of tiles, a multiple of 16
+        bgr (bool): rows are in OpenCV's BGR order, and will be reversed to RGB when written
+        compression (str): None, or "deflate" for zlib compression of each tile
+        compress_level (int): zlib level, from 1 (fastest) to 9 (smallest)
+        name (str): image name, stored in the OME-XML metadata
+        pixel_size (tuple): (x, y) size of pixels in micrometers, or None if unknown
+    """
+
+    def __init__(self, path, width, height, dtype, tile_size=DEFAULT_TILE_SIZE, bgr=True, compression=None,
+                 compress_level=1, name="", pixel_size=None):
+        if compression not in (None, "deflate"):
+            raise ValueError(f"Unsupported compression {compression}")
+        if tile_size % 16:
+            raise ValueError("Tile size must be a multiple of 16")
+
+        self.path = path
+        self.width = int(width)
+        self.height = int(height)
+        self.dtype = np.dtype(dtype)
+        self.tile_size = tile_size
+        self.bgr = bgr
+        self.compression = compression
+        self.compress_level = compress_level
+        self.name = name
+        self.pixel_size = pixel_size
+
+        # Halve until the whole image fits in one tile
+        self.levels = [_PyramidLevel(self.width, self.height, tile_size, self.dtype)]
+        while max(self.levels[-1].width, self.levels[-1].height) > tile_size:
+            previous = self.levels[-1]
+            self.levels.append(_PyramidLevel((previous.width + 1) // 2, (previous.height + 1) // 2,
+                                             tile_size, self.dtype))
+
+        self._file = open(path, "wb")
+        _write_header(self._file, bigtiff=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def rows_written(self):
+        return self.levels[0].rows_received
+
+    def write(self, rows):
+        """
+        Appends rows to the image.
+
+        Args:
+            rows (numpy array): shape (n, width, 3), any number of rows
+        """
+        if rows.shape[1:] != (self.width, 3) or rows.dtype != self.dtype:
+            raise ValueError(f"Expected rows of shape (n, {self.width}, 3) and type {self.dtype}, "
+                             f"got {rows.shape} and {rows.dtype}")
+        if self.rows_written + rows.shape[0] > self.height:
+            raise ValueError(f"Too many rows, image height is {self.height}")
+        self._add_rows(0, rows)
+
+    def _add_rows(self, k, rows):
+        """Adds rows to level k, writing tiles and passing averaged rows down as each row of tiles fills (private)."""
+        level = self.levels[k]
+        start = 0
+        while start < rows.shape[0]:
+            n = level.add(rows[start:])
+            start += n
+            if level.is_full():
+                self._flush(k)
+
+    def _flush(self, k):
+        """Writes the buffered row of tiles of level k, and adds its average to level k + 1 (private)."""
+        level = self.levels[k]
+        n = level.rows_filled
+        if n < self.tile_size:
+            # Last row of tiles. Clear rows left over from the previous one.
+            level.buffer[n:] = 0
+        for x in range(0, level.width, self.tile_size):
+            # Edge tiles are written at full size, padded with zeros
+            tile = level.buffer[:, x:x + self.tile_size]
+            data = _encode(tile, self.bgr, self.compression, self.compress_level)
+            level.tile_offsets.append(self._file.tell())
+            level.tile_byte_counts.append(len(data))
+            self._file.write(data)
+
+        if k + 1 < len(self.levels):
+            self._add_rows(k + 1, _average_2x2(level.buffer[:n, :level.width]))
+        level.clear()
+
+    def close(self):
+        """Writes any remaining tiles and the image directories, and closes the file. All rows must have been written."""
+        if self._file is None:
+            return
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+
+        try:
+            # Last rows of tiles are only partly filled. Flushing each level adds the last rows of the next.
+            for k, level in enumerate(self.levels):
+                if level.rows_filled:
+                    self._flush(k)
+
+            sub_ifds = [_write_directory(self._file, self._tags(level, reduced=True), bigtiff=True)
+                        for level in self.levels[1:]]
+            tags = self._tags(self.levels[0], reduced=False, sub_ifds=sub_ifds)
+            _set_first_directory(self._file, _write_directory(self._file, tags, bigtiff=True), bigtiff=True)
+        except BaseException:
+            self.abort()
+            raise
+
+        self._file.close()
+        self._file = None
+
+    def abort(self):
+        """Closes and deletes an unfinished file, so it can't be mistaken for a converted image."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self.path)
+
+    def _tags(self, level, reduced, sub_ifds=None):
+        """Returns directory entries of one resolution level, sorted by tag number (private)."""
+        compression = COMPRESSION_DEFLATE if self.compression == "deflate" else COMPRESSION_NONE
+        tags = [
+            (254, LONG, [1 if reduced else 0]),  # NewSubfileType: 1 for reduced resolution
+            (256, LONG, [level.width]),  # ImageWidth
+            (257, LONG, [level.height]),  # ImageLength
+            (258, SHORT, [self.dtype.itemsize * 8] * 3),  # BitsPerSample
+            (259, SHORT, [compression]),  # Compression
+            (262, SHORT, [2]),  # PhotometricInterpretation: RGB
+        ]
+        if not reduced:
+            tags.append((270, ASCII, self._ome_xml()))  # ImageDescription
+        tags += [
+            (277, SHORT, [3]),  # SamplesPerPixel
+            (284, SHORT, [1]),  # PlanarConfiguration: contiguous
+            (322, LONG, [self.tile_size]),  # TileWidth
+            (323, LONG, [self.tile_size]),  # TileLength
+            (324, LONG8, level.tile_offsets),  # TileOffsets
+            (325, LONG8, level.tile_byte_counts),  # TileByteCounts
+        ]
+        if sub_ifds:
+            tags.append((330, IFD8, sub_ifds))  # SubIFDs
+        return tags
+
+    def _ome_xml(self):
+        """Returns OME-XML metadata describing the full resolution image as one interleaved RGB plane (private)."""
+        name = escape(self.name, {'"': "&quot;"})
+        physical_size = ""
+        if self.pixel_size is not None:
+            physical_size = (f' PhysicalSizeX="{self.pixel_size[0]}" PhysicalSizeXUnit="\u00b5m"'
+                             f' PhysicalSizeY="{self.pixel_size[1]}" PhysicalSizeYUnit="\u00b5m"')
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            'xsi:schemaLocation="http://www.openmicroscopy.org/Schemas/OME/2016-06 '
+            'http://www.openmicroscopy.org/Schemas/OME/2016-06/ome.xsd">'
+            f'<Image ID="Image:0" Name="{name}">'
+            f'<Pixels ID="Pixels:0" DimensionOrder="XYCZT" Type="{self.dtype.name}" Interleaved="true" '
+            f'SizeX="{self.width}" SizeY="{self.height}" SizeC="3" SizeZ="1" SizeT="1"{physical_size}>'
+            '<Channel ID="Channel:0:0" SamplesPerPixel="3"/>'
+            '<TiffData IFD="0" PlaneCount="1"/>'
+            '</Pixels></Image></OME>'
+        ).encode("utf-8")
+
+
+class _PyramidLevel:
+    """One resolution level of a PyramidTiffWriter, with a buffer for one row of tiles (private)."""
+
+    def __init__(self, width, height, tile_size, dtype):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        # Rounded up to whole tiles, so that edge tiles can be written straight from the buffer
+        padded_width = -(-width // tile_size) * tile_size
+        self.buffer = np.zeros((tile_size, padded_width, 3), dtype=dtype)
+        self.rows_filled = 0
+        self.rows_received = 0
+        self.tile_offsets = []
+        self.tile_byte_counts = []
+
+    def add(self, rows):
+        """Copies as many rows as fit into the buffer, and returns how many that was."""
+        n = min(rows.shape[0], self.tile_size - self.rows_filled)
+        self.buffer[self.rows_filled:self.rows_filled + n, :self.width] = rows[:n]
+        self.rows_filled += n
+        self.rows_received += n
+        return n
+
+    def is_full(self):
+        return self.rows_filled == self.tile_size
+
+    def clear(self):
+        self.rows_filled = 0
+
+
+def _average_2x2(rows):
+    """Returns rows downsampled by 2 in each direction, by averaging each 2 x 2 block. Odd edges are repeated."""
+    if rows.shape[0] % 2:
+        rows = np.concatenate((rows, rows[-1:]))
+    if rows.shape[1] % 2:
+        rows = np.concatenate((rows, rows[:, -1:]), axis=1)
+    total = rows[0::2].astype(np.uint32)
+    total += rows[1::2]
+    total = total[:, 0::2] + total[:, 1::2]
+    # Add 2 so that the division rounds to nearest
+    total += 2
+    total >>= 2
+    return total.astype(rows.dtype)
+
+
+def _encode(rows, bgr, compression, compress_level):
+    """Returns bytes of a strip or tile, in RGB order and little-endian, optionally compressed (private)."""
+    if bgr and rows.ndim == 3 and rows.shape[2] == 3:
+        rows = rows[..., ::-1]
+    # TIFF header says little-endian
+    rows = rows.astype(rows.dtype.newbyteorder("<"), copy=False)
+    data = np.ascontiguousarray(rows).tobytes()
+    if compression == "deflate":
+        data = zlib.compress(data, compress_level)
+    return data
+
+
+def _write_header(f, bigtiff):
+    """Writes TIFF header. Offset of the first directory is filled in later by _set_first_directory() (private)."""
+    if bigtiff:
+        # Byte order, version 43, offset size 8, reserved, offset of first directory
+        f.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+    else:
+        f.write(b"II" + struct.pack("<HI", 42, 0))
+
+
+def _set_first_directory(f, directory_offset, bigtiff):
+    """Points the header to the first directory (private)."""
+    f.seek(8 if bigtiff else 4)
+    f.write(struct.pack("<Q" if bigtiff else "<I", directory_offset))
+    f.seek(0, os.SEEK_END)
+
+
+def _write_directory(f, tags, bigtiff):
+    """
+    Writes values that don't fit in the directory entries, then the directory itself, at the end of the file (private).
+
+    Args:
+        tags (list): (tag, field type, values) sorted by tag. Values are a list of numbers, or bytes for ASCII.
+
+    Returns:
+        Offset of the directory
+    """
+    inline_bytes = 8 if bigtiff else 4
+    offset_format = "Q" if bigtiff else "I"
+
+    entries = []
+    for tag, field_type, values in tags:
+        if field_type == ASCII:
+            data = values + b"\0"
+        else:
+            data = struct.pack(f"<{len(values)}{_TYPE_FORMATS[field_type]}", *values)
+        count = len(data) if field_type == ASCII else len(values)
+        if len(data) <= inline_bytes:
+            value = data.ljust(inline_bytes, b"\0")
+        else:
+            # Directory entry points to the values, which must start on a word boundary
+            if f.tell() % 2:
+                f.write(b"\0")
+            value = struct.pack(f"<{offset_format}", f.tell())
+            f.write(data)
+        entries.append(struct.pack(f"<HH{offset_format}", tag, field_type, count) + value)
+
+    if f.tell() % 2:
+        f.write(b"\0")
+    directory_offset = f.tell()
+    if bigtiff:
+        f.write(struct.pack("<Q", len(entries)) + b"".join(entries) + struct.pack("<Q", 0))
+    else:
+        f.write(struct.pack("<H", len(entries)) + b"".join(entries) + struct.pack("<I", 0))
+
+    if not bigtiff and f.tell() >= 2 ** 32:
+        raise ValueError("File exceeds 4 GB, use bigtiff=True")
+
+    return directory_offset
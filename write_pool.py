@@ -0,0 +1,193 @@
+"""
+Background threads that encode and write whole images, so that the next image is read and
+composited while the previous one is being written.
+
+cv2.imwrite() releases the GIL while it encodes, so encoding runs in parallel with reading,
+rescaling and compositing on the conversion thread. The pool holds a limited number of image
+buffers. Once all of them are waiting to be written, get_buffer() blocks until one has been
+written, so a slow disk slows down reading instead of filling memory. Buffers of written
+images are reused for the next images of the same size.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class WritePool:
+    """
+    Pool of threads writing whole images in the background.
+
+    Example:
+        with WritePool(workers=2, max_pending=2) as pool:
+            group = pool.group()
+            buffer = pool.get_buffer((height, width, 3), np.uint8)
+            ...  # Build image in buffer
+            group.submit(lambda: cv2.imwrite(path, buffer), buffer)
+            pool.release(buffer)
+            group.close(callback)
+
+    Args:
+        workers (int): writing threads. None uses one per CPU.
+        max_pending (int): images that can wait to be written. One more buffer can be in use for
+            building the next image, so up to max_pending + 1 images are held in memory.
+    """
+
+    def __init__(self, workers=None, max_pending=2):
+        self._executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                            thread_name_prefix="writer")
+        self._slots = threading.Semaphore(max_pending + 1)
+        self._lock = threading.Lock()
+        self._max_buffers = max_pending + 1
+        self._free = []
+        # Number of users of each buffer in use, i.e. the builder plus unfinished writes, by id()
+        self._users = {}
+        # Number of writes that have been submitted but not finished
+        self._running = 0
+        self._idle = threading.Condition(self._lock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_buffer(self, shape, dtype):
+        """
+        Returns array for building an image, which can then be handed to writes with WriteGroup.submit().
+        Blocks while all buffers are in use. Call release() when the image has been submitted.
+        """
+        # Backpressure: wait here until an image has been written
+        self._slots.acquire()
+        dtype = np.dtype(dtype)
+        with self._lock:
+            buffer = None
+            for k, free in enumerate(self._free):
+                if free.shape == shape and free.dtype == dtype:
+                    buffer = self._free.pop(k)
+                    break
+            if buffer is None:
+                if len(self._free) >= self._max_buffers:
+                    # Release a buffer of another size, to keep memory down
+                    self._free.pop(0)
+                buffer = np.empty(shape, dtype=dtype)
+            self._users[id(buffer)] = [buffer, 1]
+        return buffer
+
+    def release(self, buffer):
+        """Releases buffer from get_buffer(). It is reused once all writes submitted with it have finished."""
+        with self._lock:
+            entry = self._users[id(buffer)]
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._users[id(buffer)]
+            self._free.append(buffer)
+        self._slots.release()
+
+    def _submit(self, fn, buffer=None, done=None):
+        """
+        Runs fn() on a writing thread. buffer is not reused until fn has finished. done(error) is then
+        called on the same thread, with the exception raised by fn, or None (private).
+        """
+        with self._lock:
+            if buffer is not None:
+                if id(buffer) not in self._users:
+                    raise ValueError("Buffer must come from get_buffer(), and not be released yet")
+                self._users[id(buffer)][1] += 1
+            self._running += 1
+
+        def run():
+            error = None
+            try:
+                fn()
+            except Exception as e:
+                error = e
+            finally:
+                if buffer is not None:
+                    self.release(buffer)
+                try:
+                    if done is not None:
+                        done(error)
+                finally:
+                    # Counted as finished only after done(), so that wait() sees its results
+                    with self._idle:
+                        self._running -= 1
+                        self._idle.notify_all()
+
+        self._executor.submit(run)
+
+    def group(self):
+        """Returns WriteGroup for the writes of one image."""
+        return WriteGroup(self)
+
+    def wait(self):
+        """Waits for all writes submitted so far. Errors are reported to the callback of their WriteGroup."""
+        with self._idle:
+            self._idle.wait_for(lambda: self._running == 0)
+
+    def close(self):
+        """Waits for all writes, and stops the threads."""
+        self.wait()
+        self._executor.shutdown()
+
+
+class WriteGroup:
+    """
+    Writes of the files of one image. close() sets a callback that is called once all of them have finished.
+
+    Args:
+        pool (WritePool): pool that runs the writes
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._closed = False
+        self._error = None
+        self._callback = None
+
+    def submit(self, fn, buffer=None):
+        """Runs fn() on a writing thread of the pool, see WritePool. buffer is not reused until fn has finished."""
+        with self._lock:
+            if self._closed:
+                raise ValueError("Can't submit to a closed WriteGroup")
+            self._pending += 1
+        try:
+            self.pool._submit(fn, buffer, self._done)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+    def _done(self, error):
+        """Called when a write has finished, on its writing thread (private)."""
+        with self._lock:
+            if self._error is None:
+                self._error = error
+            self._pending -= 1
+            finished = self._closed and self._pending == 0
+        if finished:
+            self._finish()
+
+    def close(self, callback=None):
+        """
+        Marks the end of the writes of this image.
+
+        Args:
+            callback (function): callback(error) is called once all writes have finished, on the writing
+                thread of the last one, or on this thread if they have already finished. error is the
+                first exception raised by a write, or None.
+        """
+        with self._lock:
+            self._closed = True
+            self._callback = callback
+            finished = self._pending == 0
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        if self._callback is not None:
+            self._callback(self._error)